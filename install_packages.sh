@@ -15,6 +15,7 @@ pytools          ""
 torch            "1.4" 
 torchtext        "0.6.0" 
 numpy            "1.18.2" 
+scipy            "" 
 bs4              "" 
 thrift           "0.13.0" 
 spacy            "2.2.3" 
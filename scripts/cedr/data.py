@@ -4,21 +4,243 @@
 # It's distributed under the MIT License
 # MIT License is compatible with Apache 2 license for the code in this repo.
 #
+import os
+import time
+import queue
 import random
+import hashlib
+import traceback
 from tqdm import tqdm
+import numpy as np
 import torch
 import pickle
 
 from collections import Counter
 
+from scripts.config import DEVICE_CPU
+
 PAD_CODE=-1
 DEFAULT_MAX_QUERY_LEN=32
 DEFAULT_MAX_DOC_LEN=512 - DEFAULT_MAX_QUERY_LEN - 4
+DEFAULT_PREFETCH_QTY=16
+# How often (in seconds) the consumer checks if data workers are alive
+WORKER_POLL_TIMEOUT=1.0
+
+SORT_BY_LEN_QUERY = 'query'
+SORT_BY_LEN_RUN = 'run'
+SORT_BY_LEN_CHOICES = [SORT_BY_LEN_QUERY, SORT_BY_LEN_RUN]
+
+STORE_OFFS_SUFF = '.offs'
+STORE_KEYS_SUFF = '.keys'
+STORE_TMP_SUFF = '.tmp'
+STORE_QUERY_PREF = 'query'
+STORE_DOC_PREF = 'doc'
+
+TOKEN_CACHE_IDS_SUFF = '.ids'
+DOC_STORE_TEXT_SUFF = '.text'
+
+
+class MmapOffsetStore:
+    """A base class for a read-only memory-mapped storage. Values of all entries
+       (queries or documents) are stored in a flat array, which is accompanied
+       by an array of offsets and a list of entry IDs. It supports a subset of
+       the (read-only) dictionary interface, which is used by data iterators.
+       Because the data is memory-mapped, all processes opening the same
+       store share the page cache rather than keeping private copies of the data.
+    """
+    DATA_SUFF = None
+    DTYPE = None
+
+    def __init__(self, file_pref):
+        self.file_pref = file_pref
+        self._open()
+
+    def _open(self):
+        data_file = self.file_pref + self.DATA_SUFF
+        # numpy cannot memory-map empty files
+        if os.path.getsize(data_file) > 0:
+            self.data = np.memmap(data_file, dtype=self.DTYPE, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=self.DTYPE)
+        self.offs = np.load(self.file_pref + STORE_OFFS_SUFF, mmap_mode='r')
+        with open(self.file_pref + STORE_KEYS_SUFF) as f:
+            self.index = {line.rstrip('\n') : i for i, line in enumerate(f)}
+
+    def _decode(self, arr):
+        return arr
+
+    def _get(self, i):
+        return self._decode(self.data[self.offs[i] : self.offs[i + 1]])
+
+    # Memory-mapped arrays should not be pickled (e.g., when passed to spawned
+    # training processes): a child process needs to re-open the files instead.
+    def __getstate__(self):
+        return {'file_pref': self.file_pref}
+
+    def __setstate__(self, state):
+        self.file_pref = state['file_pref']
+        self._open()
+
+    def __getitem__(self, key):
+        return self._get(self.index[key])
+
+    def get(self, key, default=None):
+        i = self.index.get(key)
+        if i is None:
+            return default
+        return self._get(i)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def entry_len(self, key):
+        """Return the number of data elements (e.g., tokens) in the entry."""
+        i = self.index[key]
+        return int(self.offs[i + 1] - self.offs[i])
+
+    def items(self):
+        for key, i in self.index.items():
+            yield key, self._get(i)
+
+    @classmethod
+    def exists(cls, file_pref):
+        # The key file is written last, so its presence indicates that the store is complete
+        return os.path.exists(file_pref + STORE_KEYS_SUFF)
+
+
+class MmapOffsetStoreWriter:
+    """A writer for MmapOffsetStore files. All files are written
+       under temporary names and are renamed only in the end.
+    """
+    def __init__(self, file_pref, data_suff):
+        self.file_pref = file_pref
+        self.data_suff = data_suff
+        self.offs = [0]
+        self.f_data = open(file_pref + data_suff + STORE_TMP_SUFF, 'wb')
+        self.f_keys = open(file_pref + STORE_KEYS_SUFF + STORE_TMP_SUFF, 'w')
+
+    def add(self, key, buf, qty):
+        """Add an entry.
+
+        :param key:   an entry ID
+        :param buf:   entry data (bytes)
+        :param qty:   the number of elements (of the store data type) in the data
+        """
+        self.f_data.write(buf)
+        self.f_keys.write(key + '\n')
+        self.offs.append(self.offs[-1] + qty)
+
+    def close(self):
+        self.f_data.close()
+        self.f_keys.close()
+        with open(self.file_pref + STORE_OFFS_SUFF + STORE_TMP_SUFF, 'wb') as f_offs:
+            np.save(f_offs, np.array(self.offs, dtype=np.int64))
+
+        for suff in [self.data_suff, STORE_OFFS_SUFF, STORE_KEYS_SUFF]:
+            os.replace(self.file_pref + suff + STORE_TMP_SUFF, self.file_pref + suff)
+
+
+class TokenIdCache(MmapOffsetStore):
+    """A read-only memory-mapped cache of token IDs (stored as int32)."""
+    DATA_SUFF = TOKEN_CACHE_IDS_SUFF
+    DTYPE = np.int32
+
+    @staticmethod
+    def build(file_pref, tokenize_func, data_dict, desc):
+        """Tokenize all entries and save the cache.
+
+        :param file_pref:       a prefix of cache files
+        :param tokenize_func:   a function that converts text to a list of token IDs
+        :param data_dict:       a dictionary (or a document store) of texts indexed by their IDs
+        :param desc:            a progress bar description
+        :return: an opened cache object
+        """
+        writer = MmapOffsetStoreWriter(file_pref, TOKEN_CACHE_IDS_SUFF)
+        for entry_id, text in tqdm(data_dict.items(), total=len(data_dict), desc=desc, leave=False):
+            toks = np.array(tokenize_func(text), dtype=np.int32)
+            writer.add(entry_id, toks.tobytes(), len(toks))
+        writer.close()
+
+        return TokenIdCache(file_pref)
+
+
+class DocTextStore(MmapOffsetStore):
+    """A read-only memory-mapped storage of query or document texts (UTF-8 encoded)."""
+    DATA_SUFF = DOC_STORE_TEXT_SUFF
+    DTYPE = np.uint8
+
+    def _decode(self, arr):
+        return arr.tobytes().decode('utf-8')
+
+
+def build_doc_stores(files, file_pref):
+    """Convert CEDR data files to memory-mapped query & document stores.
+       Data is streamed and it is never fully loaded into memory.
+
+    :param files:       a list of data files (opened)
+    :param file_pref:   a prefix of the store files (without query/doc suffixes)
+    :return: a tuple of query and document stores
+    """
+    query_pref = f'{file_pref}.{STORE_QUERY_PREF}'
+    doc_pref = f'{file_pref}.{STORE_DOC_PREF}'
+    writers = {'query': MmapOffsetStoreWriter(query_pref, DOC_STORE_TEXT_SUFF),
+               'doc': MmapOffsetStoreWriter(doc_pref, DOC_STORE_TEXT_SUFF)}
+    for c_type, c_id, c_text in _iter_datafiles(files):
+        buf = c_text.encode('utf-8')
+        writers[c_type].add(c_id, buf, len(buf))
+    # The query store is completed last: read_datafiles checks only the query store
+    writers['doc'].close()
+    writers['query'].close()
+
+    return DocTextStore(query_pref), DocTextStore(doc_pref)
+
+
+def _hash_datafiles(h, files):
+    for file in files:
+        st = os.stat(file.name)
+        h.update(f'{os.path.abspath(file.name)}\t{st.st_size}\t{st.st_mtime_ns}\n'.encode())
+
+
+def get_token_cache_pref(model, files, token_cache_dir):
+    """Generate a token cache file prefix, which is unique for a given
+       tokenizer vocabulary and a set of data files.
+
+    :param model:           a model with a BERT tokenizer
+    :param files:           a list of data files (opened)
+    :param token_cache_dir: a cache directory
+    :return: a file prefix (without query/doc suffixes)
+    """
+    h = hashlib.md5()
+    tokenizer = model.tokenizer
+    for tok, tok_id in tokenizer.vocab.items():
+        h.update(f'{tok}\t{tok_id}\n'.encode())
+    basic_tokenizer = getattr(tokenizer, 'basic_tokenizer', None)
+    h.update(str(getattr(basic_tokenizer, 'do_lower_case', None)).encode())
+    _hash_datafiles(h, files)
+
+    return os.path.join(token_cache_dir, h.hexdigest())
+
+
+def get_doc_store_pref(files, doc_store_dir):
+    """Generate a document store file prefix, which is unique for a given set of data files.
 
+    :param files:           a list of data files (opened)
+    :param doc_store_dir:   a store directory
+    :return: a file prefix (without query/doc suffixes)
+    """
+    h = hashlib.md5()
+    _hash_datafiles(h, files)
 
-def read_datafiles(files):
-    queries = {}
-    docs = {}
+    return os.path.join(doc_store_dir, h.hexdigest())
+
+
+def _iter_datafiles(files):
     for file in files:
         for line in tqdm(file, desc='loading datafile (by line)', leave=False):
             cols = line.rstrip().split('\t')
@@ -27,10 +249,56 @@ def read_datafiles(files):
                 continue
             c_type, c_id, c_text = cols
             assert c_type in ('query', 'doc')
+            yield c_type, c_id, c_text
+
+
+def read_datafiles(files, model=None, token_cache_dir=None, doc_store_dir=None):
+    """Read queries and documents from data files.
+
+    :param files:           a list of data files (opened)
+    :param model:           a model, which is used to tokenize data (only when the token cache is used)
+    :param token_cache_dir: an optional directory to store a token-ID cache. If the cache
+                            for a given tokenizer vocabulary and data files exists, data files are
+                            not read at all. Otherwise, the cache is created.
+    :param doc_store_dir:   an optional directory to store memory-mapped query & document texts.
+                            If the store for given data files exists, data files are not read.
+                            Otherwise, the store is created.
+    :return: a tuple of query and document dictionaries (or memory-mapped stores)
+    """
+    if token_cache_dir is not None:
+        assert model is not None, 'The token cache requires a model (to tokenize data)'
+        cache_pref = get_token_cache_pref(model, files, token_cache_dir)
+        query_cache_pref = f'{cache_pref}.{STORE_QUERY_PREF}'
+        doc_cache_pref = f'{cache_pref}.{STORE_DOC_PREF}'
+        if TokenIdCache.exists(query_cache_pref) and TokenIdCache.exists(doc_cache_pref):
+            print('Loading the token cache:', cache_pref)
+            return TokenIdCache(query_cache_pref), TokenIdCache(doc_cache_pref)
+
+    if doc_store_dir is not None:
+        store_pref = get_doc_store_pref(files, doc_store_dir)
+        if DocTextStore.exists(f'{store_pref}.{STORE_QUERY_PREF}'):
+            print('Opening the document store:', store_pref)
+            queries = DocTextStore(f'{store_pref}.{STORE_QUERY_PREF}')
+            docs = DocTextStore(f'{store_pref}.{STORE_DOC_PREF}')
+        else:
+            print('Creating the document store:', store_pref)
+            os.makedirs(doc_store_dir, exist_ok=True)
+            queries, docs = build_doc_stores(files, store_pref)
+    else:
+        queries = {}
+        docs = {}
+        for c_type, c_id, c_text in _iter_datafiles(files):
             if c_type == 'query':
                 queries[c_id] = c_text
             if c_type == 'doc':
                 docs[c_id] = c_text
+
+    if token_cache_dir is not None:
+        print('Creating the token cache:', cache_pref)
+        os.makedirs(token_cache_dir, exist_ok=True)
+        return TokenIdCache.build(query_cache_pref, model.tokenize, queries, 'tokenizing queries'), \
+               TokenIdCache.build(doc_cache_pref, model.tokenize, docs, 'tokenizing documents')
+
     return queries, docs
 
 
@@ -43,115 +311,423 @@ def read_pairs_dict(file):
 
 
 def iter_train_pairs(model, device_name, dataset, train_pairs, do_shuffle, qrels,
-                     batch_size, max_query_len, max_doc_len):
-    batch = {'query_id': [], 'doc_id': [], 'query_tok': [], 'doc_tok': []}
-    for qid, did, query_tok, doc_tok in _iter_train_pairs(model, dataset, train_pairs, do_shuffle, qrels):
-        batch['query_id'].append(qid)
-        batch['doc_id'].append(did)
-        batch['query_tok'].append(query_tok)
-        batch['doc_tok'].append(doc_tok)
-        if len(batch['query_id']) // 2 == batch_size:
-            yield _pack_n_ship(batch, device_name, max_query_len, max_doc_len)
-            batch = {'query_id': [], 'doc_id': [], 'query_tok': [], 'doc_tok': []}
+                     batch_size, max_query_len, max_doc_len,
+                     worker_qty=0, prefetch_qty=DEFAULT_PREFETCH_QTY, pin_memory=False):
+    """Create an (infinite) iterator over training batches. Each batch contains
+       pairs of positive and negative documents.
+
+       When worker_qty > 0, batches are produced by background worker processes
+       (see BatchPrefetcher). Note that the dataset is passed to worker processes:
+       memory-mapped datasets (see read_datafiles) are cheap to pass, but in-memory
+       dictionaries are copied.
+    """
+    # The generator of training pairs is seeded from the global random generator,
+    # which keeps runs reproducible and yet produces different samples in different epochs.
+    rnd = random.Random(random.randrange(1 << 31))
+    batch_func_kwargs = {'tokenizer': ModelTokenizer(model), 'dataset': dataset,
+                         'train_pairs': train_pairs, 'do_shuffle': do_shuffle,
+                         'qrels': qrels, 'batch_size': batch_size, 'rnd': rnd}
+    return BatchPrefetcher(_iter_train_batches, batch_func_kwargs,
+                           device_name=device_name,
+                           max_query_len=max_query_len, max_doc_len=max_doc_len,
+                           worker_qty=worker_qty, prefetch_qty=prefetch_qty, pin_memory=pin_memory)
 
 
 def train_item_qty(train_pairs):
     return len(list(train_pairs.keys()))
 
 
-def _iter_train_pairs(model, dataset, train_pairs, do_shuffle, qrels):
+def _iter_train_pair_ids(dataset, train_pairs, do_shuffle, qrels, rnd, verbose=True):
     ds_queries, ds_docs = dataset
     while True:
         qids = list(train_pairs.keys())
         if do_shuffle:
-            random.shuffle(qids)
+            rnd.shuffle(qids)
         for qid in qids:
             pos_ids = [did for did in train_pairs[qid] if qrels.get(qid, {}).get(did, 0) > 0]
             if len(pos_ids) == 0:
                 continue
-            pos_id = random.choice(pos_ids)
+            pos_id = rnd.choice(pos_ids)
             pos_ids_lookup = set(pos_ids)
 
             neg_ids = [did for did in train_pairs[qid] if did not in pos_ids_lookup]
             if len(neg_ids) == 0:
                 continue
-            neg_id = random.choice(neg_ids)
-            query_tok = model.tokenize(ds_queries[qid])
-            pos_doc = ds_docs.get(pos_id)
-            neg_doc = ds_docs.get(neg_id)
-            if pos_doc is None:
-                tqdm.write(f'missing doc {pos_id}! Skipping')
+            neg_id = rnd.choice(neg_ids)
+            if pos_id not in ds_docs:
+                if verbose:
+                    tqdm.write(f'missing doc {pos_id}! Skipping')
                 continue
-            if neg_doc is None:
-                tqdm.write(f'missing doc {neg_id}! Skipping')
+            if neg_id not in ds_docs:
+                if verbose:
+                    tqdm.write(f'missing doc {neg_id}! Skipping')
                 continue
-            yield qid, pos_id, query_tok, model.tokenize(pos_doc)
-            yield qid, neg_id, query_tok, model.tokenize(neg_doc)
+            yield qid, pos_id, neg_id
+
+
+def _iter_train_batches(tokenizer, dataset, train_pairs, do_shuffle, qrels, batch_size, rnd,
+                        worker_id=0, worker_qty=1):
+    """Generate training batches (not yet padded). Sampling of training pairs
+       is cheap and it is carried out by every worker, but only every worker_qty-th
+       batch (starting from worker_id) is tokenized.
+    """
+    batch_pairs = []
+    batch_id = 0
+    for qid, pos_id, neg_id in _iter_train_pair_ids(dataset, train_pairs, do_shuffle, qrels, rnd,
+                                                    verbose=worker_id == 0):
+        batch_pairs.append((qid, pos_id))
+        batch_pairs.append((qid, neg_id))
+        if len(batch_pairs) // 2 == batch_size:
+            if batch_id % worker_qty == worker_id:
+                yield _tokenize_batch(tokenizer, dataset, batch_pairs)
+            batch_id += 1
+            batch_pairs = []
 
 
 def iter_valid_records(model, device_name, dataset, run,
-                       batch_size, max_query_len, max_doc_len):
-    batch = {'query_id': [], 'doc_id': [], 'query_tok': [], 'doc_tok': []}
-    for qid, did, query_tok, doc_tok in _iter_valid_records(model, dataset, run):
-        batch['query_id'].append(qid)
-        batch['doc_id'].append(did)
-        batch['query_tok'].append(query_tok)
-        batch['doc_tok'].append(doc_tok)
-        if len(batch['query_id']) == batch_size:
-            yield _pack_n_ship(batch, device_name, max_query_len, max_doc_len)
-            batch = {'query_id': [], 'doc_id': [], 'query_tok': [], 'doc_tok': []}
-    # final batch
-    if len(batch['query_id']) > 0:
-        yield _pack_n_ship(batch, device_name, max_query_len, max_doc_len)
-
-
-def _iter_valid_records(model, dataset, run):
+                       batch_size, max_query_len, max_doc_len,
+                       worker_qty=0, prefetch_qty=DEFAULT_PREFETCH_QTY, pin_memory=False,
+                       sort_by_len=None):
+    """Create an iterator over validation (or test) batches. By default, the order of records
+       follows the order of queries and documents in the run.
+       When worker_qty > 0, batches are produced by background worker processes (see BatchPrefetcher).
+
+       If sort_by_len is SORT_BY_LEN_QUERY (or SORT_BY_LEN_RUN), candidate documents of each query
+       (or of the whole run) are sorted by their token length so that each batch contains documents
+       of similar length, which reduces padding. The callers need to rely on the query and document IDs
+       (rather than on the order of records) to match scores with documents.
+       Sorting requires computing document lengths in advance: it is cheap for the token-ID cache,
+       but otherwise each document is tokenized twice.
+    """
+    tokenizer = ModelTokenizer(model)
+    batch_func_kwargs = {'tokenizer': tokenizer, 'dataset': dataset,
+                         'run': run, 'batch_size': batch_size}
+    if sort_by_len is not None:
+        batch_func_kwargs['run'] = None
+        batch_func_kwargs['record_ids'] = _get_sorted_valid_record_ids(tokenizer, dataset, run,
+                                                                       max_doc_len, sort_by_len)
+    return BatchPrefetcher(_iter_valid_batches, batch_func_kwargs,
+                           device_name=device_name,
+                           max_query_len=max_query_len, max_doc_len=max_doc_len,
+                           worker_qty=worker_qty, prefetch_qty=prefetch_qty, pin_memory=pin_memory)
+
+
+def _iter_valid_record_ids(dataset, run, verbose=True):
     ds_queries, ds_docs = dataset
     for qid in run:
-        query_tok = model.tokenize(ds_queries[qid])
         for did in run[qid]:
-            doc = ds_docs.get(did)
-            if doc is None:
-                tqdm.write(f'missing doc {did}! Skipping')
+            if did not in ds_docs:
+                if verbose:
+                    tqdm.write(f'missing doc {did}! Skipping')
                 continue
-            doc_tok = model.tokenize(doc)
-            yield qid, did, query_tok, doc_tok
+            yield qid, did
+
+
+def _get_sorted_valid_record_ids(tokenizer, dataset, run, max_doc_len, sort_by_len):
+    """Sort (query ID, document ID) pairs by the document token length (the sort is stable).
 
+    :param tokenizer:       a tokenizer
+    :param dataset:         a tuple of query and document dictionaries (or memory-mapped stores)
+    :param run:             a run dictionary
+    :param max_doc_len:     max. document length: all longer documents are considered to have this length
+    :param sort_by_len:     SORT_BY_LEN_QUERY to sort candidates of each query separately,
+                            SORT_BY_LEN_RUN to sort all records of the run
+    :return: a list of (query ID, document ID) pairs
+    """
+    assert sort_by_len in SORT_BY_LEN_CHOICES, f'Invalid sorting mode: {sort_by_len}'
+    ds_queries, ds_docs = dataset
+
+    def doc_len(did):
+        if isinstance(ds_docs, TokenIdCache):
+            elen = ds_docs.entry_len(did)
+        else:
+            elen = len(_tokenize(tokenizer, ds_docs[did]))
+        return min(elen, max_doc_len)
+
+    if sort_by_len == SORT_BY_LEN_RUN:
+        return sorted(_iter_valid_record_ids(dataset, run), key=lambda e: doc_len(e[1]))
 
-def _pack_n_ship(batch, device_name, max_query_len, max_doc_len):
+    res = []
+    for qid in run:
+        res.extend(sorted(_iter_valid_record_ids(dataset, {qid: run[qid]}), key=lambda e: doc_len(e[1])))
+
+    return res
+
+
+def _iter_valid_batches(tokenizer, dataset, run, batch_size, record_ids=None, worker_id=0, worker_qty=1):
+    """Generate validation batches (not yet padded): only every worker_qty-th
+       batch (starting from worker_id) is tokenized. Records are taken either
+       from the run or from the list of (query ID, document ID) pairs.
+    """
+    if record_ids is None:
+        record_ids = _iter_valid_record_ids(dataset, run, verbose=worker_id == 0)
+    batch_pairs = []
+    batch_id = 0
+    # Candidates of the same query typically span several batches:
+    # this cache permits tokenizing the query only once.
+    query_cache = {}
+    for qid, did in record_ids:
+        batch_pairs.append((qid, did))
+        if len(batch_pairs) == batch_size:
+            if batch_id % worker_qty == worker_id:
+                yield _tokenize_batch(tokenizer, dataset, batch_pairs, query_cache)
+            batch_id += 1
+            batch_pairs = []
+    # final batch
+    if batch_pairs and batch_id % worker_qty == worker_id:
+        yield _tokenize_batch(tokenizer, dataset, batch_pairs, query_cache)
+
+
+def _tokenize_batch(tokenizer, dataset, batch_pairs, query_cache=None):
+    """Tokenize a batch of (query ID, document ID) pairs: each query is tokenized only once.
+
+    :param tokenizer:       a tokenizer
+    :param dataset:         a tuple of query and document dictionaries (or memory-mapped stores)
+    :param batch_pairs:     a list of (query ID, document ID) pairs
+    :param query_cache:     an optional cache of tokenized queries shared among batches:
+                            it keeps only the most recent queries.
+    """
+    ds_queries, ds_docs = dataset
+    batch = {'query_id': [], 'doc_id': [], 'query_tok': [], 'doc_tok': []}
+    query_toks = {}
+    if query_cache is not None:
+        query_toks.update(query_cache)
+        query_cache.clear()
+    for qid, did in batch_pairs:
+        if qid not in query_toks:
+            query_toks[qid] = _tokenize(tokenizer, ds_queries[qid])
+        if query_cache is not None:
+            query_cache[qid] = query_toks[qid]
+        batch['query_id'].append(qid)
+        batch['doc_id'].append(did)
+        batch['query_tok'].append(query_toks[qid])
+        batch['doc_tok'].append(_tokenize(tokenizer, ds_docs[did]))
+    return batch
+
+
+def _tokenize(tokenizer, text):
+    """Tokenize text unless it was retrieved from the token-ID cache."""
+    if isinstance(text, str):
+        return tokenizer.tokenize(text)
+    return text
+
+
+class ModelTokenizer:
+    """A light-weight picklable wrapper for the model tokenizer: it is passed
+       to worker processes instead of the complete model. It produces the
+       same output as BertRanker.tokenize.
+    """
+    def __init__(self, model):
+        self.tokenizer = model.tokenizer
+
+    def tokenize(self, text):
+        toks = self.tokenizer.tokenize(text)
+        return [self.tokenizer.vocab[t] for t in toks]
+
+
+def _prefetch_worker(worker_id, worker_qty, seed, out_queue,
+                     batch_func, batch_func_kwargs, max_query_len, max_doc_len):
+    torch.manual_seed(seed + worker_id)
+    np.random.seed(seed + worker_id)
+    random.seed(seed + worker_id)
+    try:
+        for batch in batch_func(worker_id=worker_id, worker_qty=worker_qty, **batch_func_kwargs):
+            batch = _pack_n_ship(batch, DEVICE_CPU, max_query_len, max_doc_len)
+            # Tensors are sent as NumPy arrays: passing shared-memory tensors requires
+            # a producer to be alive until the consumer receives them.
+            out_queue.put({k: v.numpy() if torch.is_tensor(v) else v for k, v in batch.items()})
+        out_queue.put(None)
+    except Exception:
+        out_queue.put(traceback.format_exc())
+
+
+class BatchPrefetcher:
+    """An iterable over padded batches. If worker_qty > 0, the batches are produced by
+       worker processes: the worker i generates batches i, i + worker_qty, i + 2 * worker_qty, ...,
+       and puts them into its own bounded queue. The batches are read from queues in the round-robin
+       fashion, i.e., in exactly the same order as in the single-process mode.
+
+       If worker_qty == 0, batches are produced in the calling process. In both cases,
+       the attribute wait_time accumulates the time the consumer spent waiting for data.
+    """
+    def __init__(self, batch_func, batch_func_kwargs,
+                 device_name, max_query_len, max_doc_len,
+                 worker_qty=0, prefetch_qty=DEFAULT_PREFETCH_QTY, pin_memory=False):
+        """Constructor.
+
+        :param batch_func:          a generator function of (unpadded) batches, which accepts
+                                    worker_id and worker_qty arguments.
+        :param batch_func_kwargs:   remaining generator function arguments (picklable)
+        :param device_name:         a device to move batches to
+        :param max_query_len:       max. query length
+        :param max_doc_len:         max. document length
+        :param worker_qty:          a number of worker processes (0 to produce batches in the calling process)
+        :param prefetch_qty:        a total number of batches to be prefetched by all workers
+        :param pin_memory:          pin CPU memory to speed-up a (non-blocking) copy to GPU
+        """
+        self.batch_func = batch_func
+        self.batch_func_kwargs = batch_func_kwargs
+        self.device_name = device_name
+        self.max_query_len = max_query_len
+        self.max_doc_len = max_doc_len
+        self.worker_qty = worker_qty
+        self.prefetch_qty = prefetch_qty
+        # pinning makes sense only when data is copied to GPU
+        self.pin_memory = pin_memory and device_name != DEVICE_CPU
+        self.wait_time = 0.
+
+    def __iter__(self):
+        if self.worker_qty > 0:
+            return self._iter_workers()
+        else:
+            return self._iter_inline()
+
+    def _to_device(self, batch):
+        for k, v in batch.items():
+            if torch.is_tensor(v):
+                if self.pin_memory:
+                    v = v.pin_memory()
+                batch[k] = v.to(self.device_name, non_blocking=self.pin_memory)
+        return batch
+
+    def _iter_inline(self):
+        batch_iter = self.batch_func(worker_id=0, worker_qty=1, **self.batch_func_kwargs)
+        while True:
+            start_time = time.time()
+            batch = next(batch_iter, None)
+            if batch is None:
+                break
+            batch = _pack_n_ship(batch, self.device_name,
+                                 self.max_query_len, self.max_doc_len,
+                                 pin_memory=self.pin_memory)
+            self.wait_time += time.time() - start_time
+            yield batch
+
+    def _iter_workers(self):
+        ctx = torch.multiprocessing.get_context('spawn')
+        worker_qty = self.worker_qty
+        queue_size = max(1, (self.prefetch_qty + worker_qty - 1) // worker_qty)
+        queues = [ctx.Queue(maxsize=queue_size) for _ in range(worker_qty)]
+        seed = random.randrange(1 << 31)
+        workers = []
+        for worker_id in range(worker_qty):
+            p = ctx.Process(target=_prefetch_worker,
+                            kwargs={'worker_id': worker_id, 'worker_qty': worker_qty, 'seed': seed,
+                                    'out_queue': queues[worker_id],
+                                    'batch_func': self.batch_func, 'batch_func_kwargs': self.batch_func_kwargs,
+                                    'max_query_len': self.max_query_len, 'max_doc_len': self.max_doc_len},
+                            daemon=True)
+            p.start()
+            workers.append(p)
+
+        try:
+            batch_id = 0
+            while True:
+                start_time = time.time()
+                batch = self._get_batch(queues[batch_id % worker_qty], workers[batch_id % worker_qty])
+                self.wait_time += time.time() - start_time
+                # The first worker that has no batch indicates the end of data
+                if batch is None:
+                    break
+                if isinstance(batch, str):
+                    raise Exception('Data worker failure: ' + batch)
+                batch = {k: torch.from_numpy(v) if isinstance(v, np.ndarray) else v for k, v in batch.items()}
+                yield self._to_device(batch)
+                batch_id += 1
+        finally:
+            for p in workers:
+                p.terminate()
+            for p in workers:
+                p.join()
+            for q in queues:
+                q.close()
+
+    @staticmethod
+    def _get_batch(worker_queue, worker):
+        """Get the next batch from the worker queue. A worker can die without sending
+           an error message (e.g., if it is OOM-killed), so instead of waiting for the batch
+           indefinitely, we periodically check if the worker is still alive.
+        """
+        while True:
+            try:
+                return worker_queue.get(timeout=WORKER_POLL_TIMEOUT)
+            except queue.Empty:
+                if not worker.is_alive():
+                    break
+        # A worker flushes its queue before exiting, so the last batch may have arrived right before the check
+        try:
+            return worker_queue.get(timeout=WORKER_POLL_TIMEOUT)
+        except queue.Empty:
+            raise Exception(f'Data worker {worker.name} died unexpectedly (exit code {worker.exitcode})')
+
+
+def _pack_n_ship(batch, device_name, max_query_len, max_doc_len, pin_memory=False):
+    """Pad/crop token sequences, create masks, and move resulting tensors to the device.
+
+    :param batch:           a batch of (unpadded) tokenized queries and documents
+    :param device_name:     a device name
+    :param max_query_len:   max. query length
+    :param max_doc_len:     max. document length
+    :param pin_memory:      allocate batch tensors in the pinned memory and copy them to GPU asynchronously
+    :return: a dictionary of batch tensors, query and document IDs. The flag single_query
+             indicates that all query rows are the same (broadcasted) row.
+    """
     dlen = min(max_doc_len, max(len(b) for b in batch['doc_tok']))
+    pin_memory = pin_memory and device_name != DEVICE_CPU
+    batch_qty = len(batch['query_id'])
+    # If all records have the same query tokens (a typical situation during re-ranking),
+    # the query is padded and copied to the device only once and then broadcasted.
+    # Note that we compare tokens rather than query IDs: the same query ID does not
+    # guarantee identical tokens (e.g., if the caller crops queries differently).
+    single_query = _same_query_toks(batch['query_tok'])
+    query_toks = batch['query_tok'][:1] if single_query else batch['query_tok']
+    query_tok, query_mask = _pad_crop_mask(query_toks, max_query_len, pin_memory)
+    doc_tok, doc_mask = _pad_crop_mask(batch['doc_tok'], dlen, pin_memory)
+    query_tok = query_tok.to(device_name, non_blocking=pin_memory)
+    query_mask = query_mask.to(device_name, non_blocking=pin_memory)
+    if single_query:
+        query_tok = query_tok.expand(batch_qty, -1)
+        query_mask = query_mask.expand(batch_qty, -1)
     return {
         'query_id': batch['query_id'],
         'doc_id': batch['doc_id'],
-        'query_tok': _pad_crop(device_name, batch['query_tok'], max_query_len),
-        'doc_tok': _pad_crop(device_name, batch['doc_tok'], dlen),
-        'query_mask': _mask(device_name, batch['query_tok'], max_query_len),
-        'doc_mask': _mask(device_name, batch['doc_tok'], dlen),
+        'query_tok': query_tok,
+        'doc_tok': doc_tok.to(device_name, non_blocking=pin_memory),
+        'query_mask': query_mask,
+        'doc_mask': doc_mask.to(device_name, non_blocking=pin_memory),
+        'single_query': single_query
     }
 
 
-def _pad_crop(device_name, items, l):
-    result = []
-    for item in items:
-        if len(item) < l:
-            item = item + [PAD_CODE] * (l - len(item))
-        if len(item) > l:
-            item = item[:l]
-        result.append(item)
-    res = torch.tensor(result).long()
+def _same_query_toks(query_toks):
+    """Check if all query token sequences are identical: queries tokenized by _tokenize_batch
+       are typically the same objects, so the check is cheap.
+    """
+    first = query_toks[0]
+    return all(toks is first or np.array_equal(toks, first) for toks in query_toks)
 
-    return res.to(device_name)
 
+def _pad_crop_mask(items, max_len, pin_memory=False):
+    """Pad or crop token sequences and create the respective masks. Token IDs
+       are copied into a single pre-allocated buffer, and the mask is computed from sequence lengths.
 
-def _mask(device_name, items, max_len):
-    result = []
-    for e in items:
-        elen = min(len(e), max_len)
-        result.append([1.] * elen + [0.]*(max_len - elen))
+    :param items:       a list of token ID sequences (lists or NumPy arrays)
+    :param max_len:     a length of padded/cropped sequences
+    :param pin_memory:  true to allocate tensors in the pinned memory
+    :return: a tuple of (long) token ID and (float) mask tensors
+    """
+    toks = torch.full((len(items), max_len), PAD_CODE, dtype=torch.long, pin_memory=pin_memory)
+    toks_np = toks.numpy()
+    lens = torch.empty(len(items), dtype=torch.long)
+    for i, item in enumerate(items):
+        elen = min(len(item), max_len)
+        toks_np[i, :elen] = item[:elen]
+        lens[i] = elen
 
-    res = torch.tensor(result).float()
+    mask = torch.empty((len(items), max_len), dtype=torch.float, pin_memory=pin_memory)
+    torch.lt(torch.arange(max_len).unsqueeze(0), lens.unsqueeze(1), out=mask)
 
-    return res.to(device_name)
+    return toks, mask
 
 
 class VocabBuilder:
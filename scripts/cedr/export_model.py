@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Export a CEDR model to TorchScript and/or ONNX (to be used with cedr_server.py --engine)
+# and check that exported models produce the same scores as the original (eager) model.
+import sys
+import argparse
+import torch
+
+sys.path.append('.')
+
+import scripts.cedr.model_init_utils as model_init_utils
+import scripts.cedr.inference_engine as inference_engine
+
+# Exported models are expected to produce the same scores up to a small rounding error
+SCORE_TOL = 1e-3
+CHECK_BATCH_SIZES = [1, 3, 16]
+
+
+def check_exported(model, exported, max_query_len, max_doc_len):
+    """Compare scores of the exported and the original models on random batches
+       of various sizes and lengths.
+
+    :return: a maximum absolute score difference
+    """
+    max_diff = 0
+    vocab_size = model.bert.config.vocab_size
+    with torch.no_grad():
+        for batch_qty in CHECK_BATCH_SIZES:
+            for doc_len in [1, max_doc_len // 3, max_doc_len]:
+                inputs = inference_engine.gen_example_input(batch_qty, max_query_len, doc_len, vocab_size,
+                                                            seed=batch_qty * max_doc_len + doc_len)
+                scores_orig = model(*inputs)
+                scores_exp = exported(*inputs)
+                assert scores_orig.shape == scores_exp.shape, \
+                    f'Shape mismatch: {scores_orig.shape} vs {scores_exp.shape}'
+                max_diff = max(max_diff, (scores_orig - scores_exp).abs().max().item())
+                # Also check scoring of a single query against a batch of documents
+                scores_orig = model.score_candidates(inputs[0][0], inputs[1][0], inputs[2], inputs[3])
+                scores_exp = exported.score_candidates(inputs[0][0], inputs[1][0], inputs[2], inputs[3])
+                max_diff = max(max_diff, (scores_orig - scores_exp).abs().max().item())
+
+    return max_diff
+
+
+def main_cli():
+    parser = argparse.ArgumentParser('Export CEDR models to TorchScript and ONNX')
+
+    model_init_utils.add_model_init_basic_args(parser, False)
+
+    parser.add_argument('--out_pref', metavar='output prefix',
+                        type=str, required=True,
+                        help='an output file prefix (format-specific suffixes are added automatically)')
+
+    parser.add_argument('--format', metavar='export format',
+                        choices=inference_engine.EXPORT_FORMAT_LIST,
+                        nargs='+', default=inference_engine.EXPORT_FORMAT_LIST,
+                        help='export formats: ' + ' '.join(inference_engine.EXPORT_FORMAT_LIST))
+
+    parser.add_argument('--onnx_opset', metavar='ONNX opset',
+                        type=int, default=inference_engine.DEFAULT_ONNX_OPSET,
+                        help='ONNX opset version')
+
+    parser.add_argument('--no_check', action='store_true',
+                        help='do not check that exported models produce the same scores as the original one')
+
+    args = parser.parse_args()
+
+    try:
+        model = model_init_utils.load_model_for_inference(args)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+
+    model.eval()
+
+    for export_format in args.format:
+        out_file = inference_engine.export_model(model, export_format, args.out_pref,
+                                                 max_query_len=args.max_query_len, max_doc_len=args.max_doc_len,
+                                                 opset=args.onnx_opset)
+        print(f'Exported the model in the format {export_format} to {out_file}')
+
+        if not args.no_check:
+            exported = inference_engine.load_exported_ranker(export_format, args.out_pref)
+            max_diff = check_exported(model, exported, args.max_query_len, args.max_doc_len)
+            print(f'Max. absolute difference with the original model scores: {max_diff:g}')
+            if max_diff > SCORE_TOL:
+                print('The exported model produces different scores!')
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,194 @@
+#
+# Exporting CEDR rankers to TorchScript & ONNX as well as
+# loading exported models for (CPU) inference.
+#
+import pickle
+import torch
+import numpy as np
+
+import scripts.cedr.modeling_util as modeling_util
+from scripts.cedr.data import PAD_CODE
+from scripts.config import DEVICE_CPU
+
+ENGINE_EAGER = 'eager'
+ENGINE_TORCHSCRIPT = 'torchscript'
+ENGINE_ONNXRUNTIME = 'onnxruntime'
+
+ENGINE_LIST = [ENGINE_EAGER, ENGINE_TORCHSCRIPT, ENGINE_ONNXRUNTIME]
+EXPORT_FORMAT_LIST = [ENGINE_TORCHSCRIPT, ENGINE_ONNXRUNTIME]
+
+EXPORT_TORCHSCRIPT_SUFF = '.torchscript'
+EXPORT_ONNX_SUFF = '.onnx'
+EXPORT_TOKENIZER_SUFF = '.tokenizer'
+
+DEFAULT_ONNX_OPSET = 17
+
+QUANTIZE_DYNAMIC_INT8 = 'dynamic-int8'
+QUANTIZE_LIST = [QUANTIZE_DYNAMIC_INT8]
+
+INPUT_NAMES = ['query_tok', 'query_mask', 'doc_tok', 'doc_mask']
+OUTPUT_NAME = 'score'
+DYNAMIC_AXES = {
+    'query_tok': {0: 'batch'},
+    'query_mask': {0: 'batch'},
+    'doc_tok': {0: 'batch', 1: 'doc_len'},
+    'doc_mask': {0: 'batch', 1: 'doc_len'},
+    OUTPUT_NAME: {0: 'batch'}
+}
+
+
+def check_export_lens(model, max_query_len, max_doc_len):
+    """Exported models support only documents that fit into a single BERT input
+       (i.e., they do not support splitting documents into sub-batches).
+    """
+    max_len = model.bert.config.max_position_embeddings
+    if max_query_len + max_doc_len + 3 > max_len:
+        raise Exception(f'max_query_len + max_doc_len + 3 should not exceed {max_len}: ' +
+                        'exported models do not support long documents')
+
+
+def quantize_model(model, quantize):
+    """Quantize a model for CPU inference. Dynamic quantization converts weights
+       of all linear layers (i.e., of the BERT encoder as well as of model heads)
+       to int8, while activations are quantized on the fly.
+
+    :param model:       a model (one of the models in MODEL_MAP)
+    :param quantize:    a quantization mode (one of the QUANTIZE_LIST)
+    :return: a quantized copy of the model (it can be executed only on CPU)
+    """
+    if quantize == QUANTIZE_DYNAMIC_INT8:
+        model.to(DEVICE_CPU)
+        model.eval()
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    raise Exception('Unsupported quantization mode: ' + quantize)
+
+
+def gen_example_input(batch_qty, max_query_len, doc_len, vocab_size, seed=0):
+    """Generate a random input batch (with some padding).
+
+    :param batch_qty:       a batch size
+    :param max_query_len:   max. query length
+    :param doc_len:         a document length
+    :param vocab_size:      a vocabulary size
+    :param seed:            a random seed
+    :return: a tuple of query tokens, query mask, document tokens, document mask.
+    """
+    gen = torch.Generator().manual_seed(seed)
+    query_tok = torch.randint(1000, vocab_size, (batch_qty, max_query_len), generator=gen)
+    doc_tok = torch.randint(1000, vocab_size, (batch_qty, doc_len), generator=gen)
+    for i in range(batch_qty):
+        query_tok[i, 1 + i % max_query_len:] = PAD_CODE
+        doc_tok[i, 1 + (7 * i) % doc_len:] = PAD_CODE
+
+    return query_tok, (query_tok != PAD_CODE).float(), doc_tok, (doc_tok != PAD_CODE).float()
+
+
+def export_model(model, export_format, file_pref, max_query_len, max_doc_len, opset=DEFAULT_ONNX_OPSET):
+    """Export the model (on CPU) and save its tokenizer.
+
+    :param model:           a model (one of the models in MODEL_MAP)
+    :param export_format:   an export format (one of the EXPORT_FORMAT_LIST)
+    :param file_pref:       an output file prefix
+    :param max_query_len:   max. query length (exported models accept queries of only this length)
+    :param max_doc_len:     max. document length (exported models accept documents of variable length)
+    :param opset:           ONNX opset version
+    :return: an exported file name
+    """
+    check_export_lens(model, max_query_len, max_doc_len)
+    model.to(DEVICE_CPU)
+    model.eval()
+
+    example_input = gen_example_input(2, max_query_len, max_doc_len, model.bert.config.vocab_size)
+
+    with torch.no_grad():
+        if export_format == ENGINE_TORCHSCRIPT:
+            out_file = file_pref + EXPORT_TORCHSCRIPT_SUFF
+            traced = torch.jit.trace(model, example_input)
+            torch.jit.save(traced, out_file)
+        elif export_format == ENGINE_ONNXRUNTIME:
+            out_file = file_pref + EXPORT_ONNX_SUFF
+            torch.onnx.export(model, example_input, out_file,
+                              input_names=INPUT_NAMES, output_names=[OUTPUT_NAME],
+                              dynamic_axes=DYNAMIC_AXES, opset_version=opset,
+                              dynamo=False)
+        else:
+            raise Exception('Unsupported export format: ' + export_format)
+
+    with open(file_pref + EXPORT_TOKENIZER_SUFF, 'wb') as f:
+        pickle.dump(model.tokenizer, f)
+
+    return out_file
+
+
+class ExportedRanker:
+    """A base class for exported (CPU-only) rankers. It mimics the part of the BertRanker
+       interface, which is used for inference (e.g., in cedr_server.py).
+    """
+    def __init__(self, file_pref):
+        with open(file_pref + EXPORT_TOKENIZER_SUFF, 'rb') as f:
+            self.tokenizer = pickle.load(f)
+
+    def tokenize(self, text):
+        toks = self.tokenizer.tokenize(text)
+        toks = [self.tokenizer.vocab[t] for t in toks]
+        return toks
+
+    def to(self, device_name):
+        if device_name != DEVICE_CPU:
+            print(f'Exported models are always executed on CPU, ignoring device {device_name}')
+        return self
+
+    def eval(self):
+        return self
+
+    def score_candidates(self, query_tok, query_mask, doc_tok, doc_mask):
+        return modeling_util.score_candidates(self, query_tok, query_mask, doc_tok, doc_mask)
+
+    def __call__(self, query_tok, query_mask, doc_tok, doc_mask):
+        raise NotImplementedError
+
+
+class TorchScriptRanker(ExportedRanker):
+    def __init__(self, file_pref, thread_qty=None):
+        super().__init__(file_pref)
+        if thread_qty is not None:
+            torch.set_num_threads(thread_qty)
+        self.model = torch.jit.load(file_pref + EXPORT_TORCHSCRIPT_SUFF, map_location=DEVICE_CPU)
+        self.model.eval()
+
+    def __call__(self, query_tok, query_mask, doc_tok, doc_mask):
+        return self.model(query_tok.contiguous(), query_mask.contiguous(),
+                          doc_tok.contiguous(), doc_mask.contiguous())
+
+
+class OnnxRuntimeRanker(ExportedRanker):
+    def __init__(self, file_pref, thread_qty=None):
+        super().__init__(file_pref)
+        import onnxruntime
+
+        opts = onnxruntime.SessionOptions()
+        if thread_qty is not None:
+            opts.intra_op_num_threads = thread_qty
+        self.session = onnxruntime.InferenceSession(file_pref + EXPORT_ONNX_SUFF, sess_options=opts,
+                                                    providers=['CPUExecutionProvider'])
+
+    def __call__(self, query_tok, query_mask, doc_tok, doc_mask):
+        inputs = {name: np.ascontiguousarray(t.cpu().numpy())
+                  for name, t in zip(INPUT_NAMES, [query_tok, query_mask, doc_tok, doc_mask])}
+        return torch.from_numpy(self.session.run([OUTPUT_NAME], inputs)[0])
+
+
+def load_exported_ranker(engine, file_pref, thread_qty=None):
+    """Load an exported ranker.
+
+    :param engine:      an inference engine (ENGINE_TORCHSCRIPT or ENGINE_ONNXRUNTIME)
+    :param file_pref:   an exported model file prefix
+    :param thread_qty:  an optional number of inference threads
+    """
+    if engine == ENGINE_TORCHSCRIPT:
+        return TorchScriptRanker(file_pref, thread_qty)
+    elif engine == ENGINE_ONNXRUNTIME:
+        return OnnxRuntimeRanker(file_pref, thread_qty)
+
+    raise Exception('Unsupported inference engine: ' + engine)
@@ -1,5 +1,6 @@
 import inspect
 import argparse
+import torch
 
 import scripts.cedr.data as data
 import scripts.cedr.modeling as modeling
@@ -110,6 +111,32 @@ def create_model_from_args(args):
     return model
 
 
+def load_model_for_inference(args):
+    """Load a complete model or create a model and load its weights (for test-time inference).
+
+    :param args: arguments (see add_model_init_basic_args)
+    :return: a model loaded on CPU
+    """
+    if args.init_model is None:
+        if args.model is not None and args.init_model_weights is not None:
+            model = create_model_from_args(args)
+            print('Loading model weights from:', args.init_model_weights.name)
+            # If we load weights here, we must set strict to True:
+            # this would prevent accidental loading of partial models.
+            # Partial models are sure fine to load during training (as a reasonable
+            # initialization), but not during test time.
+            model.load_state_dict(torch.load(args.init_model_weights.name, map_location='cpu'),
+                                  strict=True)
+        else:
+            raise Exception('Specify the model file: --init_model or model type and model weights')
+    else:
+        print('Loading a complete model from:', args.init_model.name)
+        # The file is loaded by name (rather than from the opened file) to support model reloading
+        model = torch.load(args.init_model.name, map_location='cpu')
+
+    return model
+
+
 def get_model_param_dict(args, model_class):
     """This function iterates over the list of arguments starting with model.
        and checks if the model constructor supports them. It creates
@@ -64,6 +64,12 @@ class BertRanker(torch.nn.Module):
         toks = [self.tokenizer.vocab[t] for t in toks]
         return toks
 
+    def score_candidates(self, query_tok, query_mask, doc_tok, doc_mask):
+        """Score a batch of candidate documents of a single query
+           (see modeling_util.score_candidates).
+        """
+        return modeling_util.score_candidates(self, query_tok, query_mask, doc_tok, doc_mask)
+
     def encode_bert(self, query_tok, query_mask, doc_tok, doc_mask):
         batch_qty, max_qlen = query_tok.shape
         DIFF = 3 # = [CLS] and 2x[SEP]
@@ -76,22 +82,29 @@ class BertRanker(torch.nn.Module):
           batch_coeff = modeling_util.get_batch_avg_coeff(doc_mask, max_doc_tok_len)
           batch_coeff = batch_coeff.view(batch_qty, 1)
 
-        query_toks = torch.cat([query_tok] * sbcount, dim=0)
-        query_mask = torch.cat([query_mask] * sbcount, dim=0)
+        # build BERT input sequences: queries are broadcasted to all sub-batches (rather than
+        # copied) and each input tensor is created using a single concatenation. Note that
+        # we avoid explicit tensor sizes to keep the model traceable (see export_model.py).
+        doc_toks = doc_toks.reshape(sbcount, batch_qty, -1)
+        doc_masks = doc_masks.reshape(sbcount, batch_qty, -1)
+        query_toks = query_tok.unsqueeze(0).expand(sbcount, -1, -1)
+        query_masks = query_mask.unsqueeze(0).expand(sbcount, -1, -1)
+
+        CLSS = torch.full_like(doc_toks[:, :, :1], self.tokenizer.vocab['[CLS]'])
+        SEPS = torch.full_like(doc_toks[:, :, :1], self.tokenizer.vocab['[SEP]'])
+        ONES = torch.ones_like(doc_masks[:, :, :1])
+
+        toks = torch.cat([CLSS, query_toks, SEPS, doc_toks, SEPS], dim=2).flatten(0, 1)
+        mask = torch.cat([ONES, query_masks, ONES, doc_masks, ONES], dim=2).flatten(0, 1)
 
-        CLSS = torch.full_like(query_toks[:, :1], self.tokenizer.vocab['[CLS]'])
-        SEPS = torch.full_like(query_toks[:, :1], self.tokenizer.vocab['[SEP]'])
-        ONES = torch.ones_like(query_mask[:, :1])
-        NILS = torch.zeros_like(query_mask[:, :1])
+        # [CLS] query [SEP] have segment ID 0, document tokens and the final [SEP] have segment ID 1
+        segment_ids = torch.cat([torch.zeros_like(toks[0, :max_qlen+2]),
+                                 torch.ones_like(toks[0, max_qlen+2:])]).expand_as(toks)
 
-        # build BERT input sequences
-        toks = torch.cat([CLSS, query_toks, SEPS, doc_toks, SEPS], dim=1)
-        mask = torch.cat([ONES, query_mask, ONES, doc_masks, ONES], dim=1)
-        segment_ids = torch.cat([NILS] * (2 + max_qlen) + [ONES] * (1 + doc_toks.shape[1]), dim=1)
         toks[toks == -1] = 0 # remove padding (will be masked anyway)
 
         # execute BERT model
-        result = self.bert(toks, segment_ids.long(), mask)
+        result = self.bert(toks, segment_ids, mask)
 
         # extract relevant subsequences for query and doc
         query_results = [r[:batch_qty, 1:max_qlen+1] for r in result]
@@ -188,14 +201,14 @@ class CedrKnrmRanker(BertRanker):
     def forward(self, query_tok, query_mask, doc_tok, doc_mask):
         cls_reps, query_reps, doc_reps = self.encode_bert(query_tok, query_mask, doc_tok, doc_mask)
         simmat = self.simmat(query_reps, doc_reps, query_tok, doc_tok)
-        kernels = self.kernels(simmat)
-        BATCH, KERNELS, VIEWS, QLEN, DLEN = kernels.shape
-        kernels = kernels.reshape(BATCH, KERNELS * VIEWS, QLEN, DLEN)
-        simmat = simmat.reshape(BATCH, 1, VIEWS, QLEN, DLEN) \
-                       .expand(BATCH, KERNELS, VIEWS, QLEN, DLEN) \
-                       .reshape(BATCH, KERNELS * VIEWS, QLEN, DLEN)
-        result = kernels.sum(dim=3) # sum over document
+        # kernel values summed over document (computed without materializing all kernels)
+        result = self.kernels.doc_sum(simmat)
+        BATCH, KERNELS, VIEWS, QLEN = result.shape
+        result = result.reshape(BATCH, KERNELS * VIEWS, QLEN)
         mask = (simmat.sum(dim=3) != 0.) # which query terms are not padding?
+        mask = mask.reshape(BATCH, 1, VIEWS, QLEN) \
+                   .expand(BATCH, KERNELS, VIEWS, QLEN) \
+                   .reshape(BATCH, KERNELS * VIEWS, QLEN)
         result = torch.where(mask, (result + 1e-6).log(), mask.float())
         result = result.sum(dim=2) # sum over query terms
         result = torch.cat([result, cls_reps[-1]], dim=1)
@@ -32,6 +32,24 @@ class CustomBertModel(pytorch_pretrained_bert.BertModel):
         return [embedding_output] + encoded_layers
 
 
+def score_candidates(model, query_tok, query_mask, doc_tok, doc_mask):
+    """Score a batch of candidate documents of a single query using any model
+       that accepts (query_tok, query_mask, doc_tok, doc_mask) batches.
+       The query is padded only once: its tensors are broadcasted to all documents rather than copied.
+
+    :param model:       a model (a BertRanker or an exported ranker)
+    :param query_tok:   a tensor of query token IDs (a single row or a 1-D tensor)
+    :param query_mask:  a query mask (a single row or a 1-D tensor)
+    :param doc_tok:     a batch of document token IDs (one row per document)
+    :param doc_mask:    a batch of document masks
+    :return: a 1-D tensor of scores
+    """
+    batch_qty = doc_tok.shape[0]
+    query_tok = query_tok.reshape(1, -1).expand(batch_qty, -1)
+    query_mask = query_mask.reshape(1, -1).expand(batch_qty, -1)
+    return model(query_tok, query_mask, doc_tok, doc_mask)
+
+
 # This function should produce averaging coefficients compatiable
 # with the split in get_batch_avg_coeff
 def get_batch_avg_coeff(mask, maxlen):
@@ -94,10 +112,12 @@ class PACRRConvMax2dModule(torch.nn.Module):
             simmat = self.pad(simmat)
         conv = self.activation(self.conv(simmat))
         top_filters, _ = conv.max(dim=1)
-        # LB: This a work around for rarely occurring weird cases of very short documents
-        if DLEN < self.k:
-            # padding with zeros the last dim to make it have it at least DLEN elements
-            top_filters = torch.nn.functional.pad(top_filters, (0, self.k - DLEN))
+        # LB: This a work around for rarely occurring weird cases of very short documents:
+        # padding with zeros the last dim to make it have at least k elements.
+        # We pad unconditionally (rather than only when DLEN < k) to keep the
+        # model traceable: filter values are non-negative (ReLU), so extra zeros
+        # do not change the top-k values of longer documents.
+        top_filters = torch.nn.functional.pad(top_filters, (0, self.k - 1))
         top_toks, _ = top_filters.topk(self.k, dim=2)
         result = top_toks.reshape(BATCH, QLEN, self.k)
         return result
@@ -112,24 +132,20 @@ class SimmatModule(torch.nn.Module):
         self._hamming_index = None
 
     def forward(self, query_embed, doc_embed, query_tok, doc_tok):
-        simmat = []
-
-        for a_emb, b_emb in zip(query_embed, doc_embed):
-            BAT, A, B = a_emb.shape[0], a_emb.shape[1], b_emb.shape[1]
-            # embeddings -- cosine similarity matrix
-            a_denom = a_emb.norm(p=2, dim=2).reshape(BAT, A, 1).expand(BAT, A, B) + 1e-9 # avoid 0div
-            b_denom = b_emb.norm(p=2, dim=2).reshape(BAT, 1, B).expand(BAT, A, B) + 1e-9 # avoid 0div
-            perm = b_emb.permute(0, 2, 1)
-            sim = a_emb.bmm(perm)
-            sim = sim / (a_denom * b_denom)
+        # Similarity matrices of all layers are computed at once: BATCH x CHANNELS x QLEN x DLEN
+        a_emb = torch.stack(query_embed, dim=1)
+        b_emb = torch.stack(doc_embed, dim=1)
+        BAT, A, B = a_emb.shape[0], a_emb.shape[2], b_emb.shape[2]
+        # embeddings -- cosine similarity matrix
+        a_emb = a_emb / (a_emb.norm(p=2, dim=3, keepdim=True) + 1e-9) # avoid 0div
+        b_emb = b_emb / (b_emb.norm(p=2, dim=3, keepdim=True) + 1e-9) # avoid 0div
+        sim = torch.matmul(a_emb, b_emb.transpose(2, 3))
 
-            # nullify padding (indicated by -1 by default)
-            nul = torch.zeros_like(sim)
-            sim = torch.where(query_tok.reshape(BAT, A, 1).expand(BAT, A, B) == self.padding, nul, sim)
-            sim = torch.where(doc_tok.reshape(BAT, 1, B).expand(BAT, A, B) == self.padding, nul, sim)
+        # nullify padding (indicated by -1 by default)
+        mask = (query_tok != self.padding).reshape(BAT, 1, A, 1) * \
+               (doc_tok != self.padding).reshape(BAT, 1, 1, B)
 
-            simmat.append(sim)
-        return torch.stack(simmat, dim=1)
+        return sim * mask.to(sim.dtype)
 
 
 class DRMMLogCountHistogram(torch.nn.Module):
@@ -138,28 +154,23 @@ class DRMMLogCountHistogram(torch.nn.Module):
         self.bins = bins
 
     def forward(self, simmat, dtoks, qtoks):
-        # THIS IS SLOW ... Any way to make this faster? Maybe it's not worth doing on GPU?
         BATCH, CHANNELS, QLEN, DLEN = simmat.shape
         # +1e-5 to nudge scores of 1 to above threshold
-        bins = ((simmat + 1.000001) / 2. * (self.bins - 1)).int()
+        bins = ((simmat + 1.000001) / 2. * (self.bins - 1)).long()
+        # guard against cosine values that are (numerically) slightly outside of [-1, 1]
+        bins = bins.clamp(0, self.bins - 1)
         # set weights of 0 for padding (in both query and doc dims)
         weights = ((dtoks != -1).reshape(BATCH, 1, DLEN).expand(BATCH, QLEN, DLEN) * \
                   (qtoks != -1).reshape(BATCH, QLEN, 1).expand(BATCH, QLEN, DLEN)).float()
+        weights = weights.reshape(BATCH, 1, QLEN, DLEN).expand(BATCH, CHANNELS, QLEN, DLEN)
 
-        # no way to batch this... loses gradients here. https://discuss.pytorch.org/t/histogram-function-in-pytorch/5350
-        bins, weights = bins.cpu(), weights.cpu()
-        histogram = []
-        for superbins, w in zip(bins, weights):
-            result = []
-            for b in superbins:
-                result.append(torch.stack([torch.bincount(q, x, self.bins) for q, x in zip(b, w)], dim=0))
-            result = torch.stack(result, dim=0)
-            histogram.append(result)
-        histogram = torch.stack(histogram, dim=0)
+        # All (batch, channel, query term) histograms are computed at once
+        # on the same device as simmat (no gradients w.r.t. bins as before)
+        histogram = torch.zeros(BATCH, CHANNELS, QLEN, self.bins,
+                                dtype=weights.dtype, device=simmat.device)
+        histogram.scatter_add_(3, bins, weights)
 
-        # back to GPU
-        histogram = histogram.to(simmat.device)
-        return (histogram.float() + 1e-5).log()
+        return (histogram + 1e-5).log()
 
 
 class KNRMRbfKernelBank(torch.nn.Module):
@@ -175,6 +186,55 @@ class KNRMRbfKernelBank(torch.nn.Module):
     def forward(self, data):
         return torch.stack([k(data) for k in self.kernels], dim=self.dim)
 
+    def doc_sum(self, data):
+        """Compute kernel values summed over the last (document) dimension.
+           The result is the same as self(data).sum(dim=-1), but full kernel
+           tensors are never materialized (neither in forward nor in backward pass),
+           which greatly reduces the peak memory usage.
+        """
+        if not torch.is_grad_enabled():
+            # No need for the custom backward pass during inference: this branch is also
+            # used for tracing (tracing of custom autograd functions is not supported).
+            return torch.stack([k(data).sum(dim=-1) for k in self.kernels], dim=self.dim)
+        mus = torch.stack([k.mu for k in self.kernels])
+        sigmas = torch.stack([k.sigma for k in self.kernels])
+        return KNRMRbfKernelDocSumFunction.apply(data, mus, sigmas, self.dim)
+
+
+class KNRMRbfKernelDocSumFunction(torch.autograd.Function):
+    """A fused computation of RBF kernels followed by summation over the last dimension.
+       Kernels are processed one by one and the backward pass recomputes kernel values
+       instead of saving them.
+    """
+    @staticmethod
+    def forward(ctx, data, mus, sigmas, dim):
+        ctx.save_for_backward(data, mus, sigmas)
+        ctx.dim = dim
+        res = []
+        for mu, sigma in zip(mus, sigmas):
+            adj = data - mu
+            res.append(torch.exp(-0.5 * adj * adj / sigma / sigma).sum(dim=-1))
+        return torch.stack(res, dim=dim)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        data, mus, sigmas = ctx.saved_tensors
+        grad_data = torch.zeros_like(data) if ctx.needs_input_grad[0] else None
+        grad_mus = torch.zeros_like(mus)
+        grad_sigmas = torch.zeros_like(sigmas)
+        for i, (mu, sigma) in enumerate(zip(mus, sigmas)):
+            adj = data - mu
+            kern = torch.exp(-0.5 * adj * adj / sigma / sigma)
+            # d kern / d mu == kern * (data - mu) / sigma^2 == - d kern / d data
+            grad_mu = grad_output.select(ctx.dim, i).unsqueeze(-1) * kern * adj / (sigma * sigma)
+            if grad_data is not None:
+                grad_data -= grad_mu
+            grad_mus[i] = grad_mu.sum()
+            # d kern / d sigma == kern * (data - mu)^2 / sigma^3
+            grad_sigmas[i] = (grad_mu * adj).sum() / sigma
+
+        return grad_data, grad_mus, grad_sigmas, None
+
 
 class KNRMRbfKernel(torch.nn.Module):
     def __init__(self, initial_mu, initial_sigma, requires_grad=True):
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# An accuracy/latency report for a quantized CEDR model: the script re-scores
+# a validation run using the original (float32) and the quantized model on CPU
+# and prints the difference in evaluation metrics next to the throughput gain.
+import sys
+import argparse
+import torch
+
+sys.path.append('.')
+
+import scripts.cedr.model_init_utils as model_init_utils
+import scripts.cedr.inference_engine as inference_engine
+
+from scripts.cedr.score_run import add_scoring_args, get_score_params, read_scoring_data, score_run
+from scripts.common_eval import METRIC_LIST, getEvalResults
+from scripts.config import DEVICE_CPU
+
+
+def main_cli():
+    parser = argparse.ArgumentParser('Accuracy/latency report for quantized CEDR models')
+
+    add_scoring_args(parser)
+
+    parser.add_argument('--quantize', metavar='quantization mode',
+                        choices=inference_engine.QUANTIZE_LIST, default=inference_engine.QUANTIZE_DYNAMIC_INT8,
+                        help='a quantization mode: ' + ' '.join(inference_engine.QUANTIZE_LIST))
+
+    parser.add_argument('--qrels', metavar='QREL file', help='QREL file',
+                        type=argparse.FileType('rt'), required=True)
+
+    args = parser.parse_args()
+
+    if args.thread_qty is not None:
+        torch.set_num_threads(args.thread_qty)
+
+    try:
+        model = model_init_utils.load_model_for_inference(args)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+
+    # Quantized models can be executed only on CPU, so the original model is also run on CPU
+    model.to(DEVICE_CPU)
+    model.eval()
+    quant_model = inference_engine.quantize_model(model, args.quantize)
+
+    dataset, run = read_scoring_data(args, model)
+    score_params = get_score_params(args, DEVICE_CPU)
+    qrelf = args.qrels.name
+
+    res = {}
+    for name, m in [('float32', model), (args.quantize, quant_model)]:
+        rerank_run, elapsed = score_run(m, score_params, dataset, run, desc=name)
+        pair_qty = sum(len(r) for r in rerank_run.values())
+        metrics = {metric: getEvalResults(False, metric, rerank_run, None, qrelf, useQrelCache=True)
+                   for metric in METRIC_LIST}
+        res[name] = rerank_run, pair_qty / elapsed, metrics
+
+    orig_run, orig_speed, orig_metrics = res['float32']
+    quant_run, quant_speed, quant_metrics = res[args.quantize]
+
+    max_score_diff = max(abs(orig_run[qid][did] - quant_run[qid][did])
+                         for qid in orig_run for did in orig_run[qid])
+
+    print()
+    print('%-12s %12s %12s %12s' % ('', 'float32', args.quantize, 'delta'))
+    for metric in METRIC_LIST:
+        print('%-12s %12.4f %12.4f %+12.4f' % (metric, orig_metrics[metric], quant_metrics[metric],
+                                               quant_metrics[metric] - orig_metrics[metric]))
+    print('%-12s %12.1f %12.1f %11.2fx' % ('pairs/sec', orig_speed, quant_speed, quant_speed / orig_speed))
+    print('Max. absolute score difference: %g' % max_score_diff)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Re-scoring (re-ranking) a run using a trained CEDR model (in a batch mode).
+import sys
+import time
+import argparse
+import torch
+
+from collections import namedtuple
+
+sys.path.append('.')
+
+import scripts.cedr.data as data
+import scripts.cedr.model_init_utils as model_init_utils
+import scripts.cedr.inference_engine as inference_engine
+
+from scripts.cedr.train import run_model
+from scripts.common_eval import METRIC_LIST, readRunDict, writeRunDict, getEvalResults
+from scripts.config import DEVICE_CPU
+
+# A subset of training parameters (see TrainParams in train.py) used by run_model
+ScoreParams = namedtuple('ScoreParams',
+                         ['device_name',
+                          'batch_size_val',
+                          'max_query_len', 'max_doc_len',
+                          'data_worker_qty', 'prefetch_qty', 'pin_memory',
+                          'sort_valid_by_len'])
+
+
+def add_scoring_args(parser):
+    model_init_utils.add_model_init_basic_args(parser, False)
+
+    parser.add_argument('--datafiles', metavar='data files', help='data files: docs & queries',
+                        type=argparse.FileType('rt'), nargs='+', required=True)
+
+    parser.add_argument('--token_cache_dir', metavar='token cache dir',
+                        help='an optional directory to store/load a cache of pre-tokenized queries & documents',
+                        type=str, default=None)
+
+    parser.add_argument('--doc_store_dir', metavar='doc store dir',
+                        help='an optional directory to store/load memory-mapped queries & documents',
+                        type=str, default=None)
+
+    parser.add_argument('--run', metavar='run file', help='a run file to re-rank',
+                        type=argparse.FileType('rt'), required=True)
+
+    parser.add_argument('--max_query_qty', metavar='max # of queries',
+                        type=int, default=0,
+                        help='max # of queries to re-rank: 0 tells to use all data')
+
+    parser.add_argument('--batch_size', metavar='batch size',
+                        type=int, default=32, help='batch size')
+
+    parser.add_argument('--data_worker_qty', metavar='# of data workers',
+                        type=int, default=0,
+                        help='# of worker processes to prefetch batches: 0 tells to prepare batches in the main process')
+
+    parser.add_argument('--prefetch_qty', metavar='# of prefetched batches',
+                        type=int, default=data.DEFAULT_PREFETCH_QTY,
+                        help='max. # of batches prefetched by all data workers')
+
+    parser.add_argument('--pin_memory', action='store_true',
+                        help='pin memory of prefetched batches (for faster non-blocking copying to GPU)')
+
+    parser.add_argument('--sort_by_len', choices=data.SORT_BY_LEN_CHOICES, default=None,
+                        help='sort documents by length (within each query or in the whole run) ' +
+                             'to reduce padding: ' + ','.join(data.SORT_BY_LEN_CHOICES))
+
+    parser.add_argument('--thread_qty', metavar='# of threads',
+                        default=None, type=int,
+                        help='a number of threads used for CPU inference')
+
+
+def get_score_params(args, device_name):
+    return ScoreParams(device_name=device_name,
+                       batch_size_val=args.batch_size,
+                       max_query_len=args.max_query_len, max_doc_len=args.max_doc_len,
+                       data_worker_qty=args.data_worker_qty,
+                       prefetch_qty=args.prefetch_qty,
+                       pin_memory=args.pin_memory,
+                       sort_valid_by_len=args.sort_by_len)
+
+
+def read_scoring_data(args, model):
+    """Read queries, documents, and the run to re-rank.
+
+    :return: a tuple: a dataset, a run dictionary.
+    """
+    dataset = data.read_datafiles(args.datafiles, model=model,
+                                  token_cache_dir=args.token_cache_dir,
+                                  doc_store_dir=args.doc_store_dir)
+    run = readRunDict(args.run.name)
+    if args.max_query_qty > 0:
+        run = {k: run[k] for k in list(run.keys())[0:args.max_query_qty]}
+
+    print('# of queries:', len(run), ' # of query-document pairs:', sum(len(r) for r in run.values()),
+          ' in the file', args.run.name)
+
+    return dataset, run
+
+
+def score_run(model, score_params, dataset, run, desc='scoring'):
+    """Re-score the run and measure the scoring time.
+
+    :return: a tuple: a re-scored run, elapsed time (in seconds).
+    """
+    start_time = time.time()
+    rerank_run = run_model(model, score_params, dataset, run, desc=desc)
+    return rerank_run, time.time() - start_time
+
+
+def main_cli():
+    parser = argparse.ArgumentParser('Re-scoring runs using CEDR models')
+
+    add_scoring_args(parser)
+
+    parser.add_argument('--out_run', metavar='output run', help='an output run file',
+                        type=str, required=True)
+
+    parser.add_argument('--quantize', metavar='quantization mode',
+                        choices=inference_engine.QUANTIZE_LIST, default=None,
+                        help='quantize the model for CPU inference: ' + ' '.join(inference_engine.QUANTIZE_LIST))
+
+    parser.add_argument('--qrels', metavar='QREL file', help='an optional QREL file to evaluate the output run',
+                        type=argparse.FileType('rt'), default=None)
+
+    parser.add_argument('--eval_metric', choices=METRIC_LIST, default=METRIC_LIST[0],
+                        help='Metric list: ' + ','.join(METRIC_LIST),
+                        metavar='eval metric')
+
+    args = parser.parse_args()
+
+    if args.thread_qty is not None:
+        torch.set_num_threads(args.thread_qty)
+
+    try:
+        model = model_init_utils.load_model_for_inference(args)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+
+    device_name = args.device_name
+    if args.quantize is not None:
+        print(f'Quantizing the model: {args.quantize} (quantized models run only on CPU)')
+        model = inference_engine.quantize_model(model, args.quantize)
+        device_name = DEVICE_CPU
+
+    model.to(device_name)
+
+    dataset, run = read_scoring_data(args, model)
+
+    rerank_run, elapsed = score_run(model, get_score_params(args, device_name), dataset, run)
+    pair_qty = sum(len(r) for r in rerank_run.values())
+    print('Scored %d query-document pairs in %.1f sec (%.1f pairs/sec)' % (pair_qty, elapsed, pair_qty / elapsed))
+
+    writeRunDict(rerank_run, args.out_run)
+
+    if args.qrels is not None:
+        res = getEvalResults(False, args.eval_metric, rerank_run, args.out_run, args.qrels.name)
+        print(f'{args.eval_metric}: {res:g}')
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -26,7 +26,7 @@ from scripts.cedr.model_init_utils import MODEL_PARAM_PREF
 import scripts.cedr.model_init_utils as model_init_utils
 
 
-from scripts.common_eval import METRIC_LIST, readQrelsDict, readRunDict, getEvalResults
+from scripts.common_eval import METRIC_LIST, readQrelsDict, readRun, getEvalResults, ColumnarRun, BINARY_RUN_SUFF
 from scripts.config import DEVICE_CPU
 
 from tqdm import tqdm
@@ -87,7 +87,9 @@ TrainParams = namedtuple('TrainParams',
                      'save_epoch_snapshots', 'save_last_snapshot_every_k_batch',
                      'device_name', 'print_grads',
                      'shuffle_train',
-                     'use_external_eval', 'eval_metric'])
+                     'use_external_eval', 'eval_metric',
+                     'data_worker_qty', 'prefetch_qty', 'pin_memory',
+                     'sort_valid_by_len'])
 
 def avg_model_params(model):
     """Average model parameters across all GPUs."""
@@ -150,9 +152,14 @@ def train_iteration(model, sync_barrier,
     else:
         pbar = None
 
-    for record in data.iter_train_pairs(model, train_params.device_name, dataset, train_pairs, train_params.shuffle_train,
-                                        qrels, train_params.backprop_batch_size,
-                                        train_params.max_query_len, train_params.max_doc_len):
+    train_iter = data.iter_train_pairs(model, train_params.device_name, dataset, train_pairs, train_params.shuffle_train,
+                                       qrels, train_params.backprop_batch_size,
+                                       train_params.max_query_len, train_params.max_doc_len,
+                                       worker_qty=train_params.data_worker_qty,
+                                       prefetch_qty=train_params.prefetch_qty,
+                                       pin_memory=train_params.pin_memory)
+
+    for record in train_iter:
         scores = model(record['query_tok'],
                        record['query_mask'],
                        record['doc_tok'],
@@ -221,6 +228,9 @@ def train_iteration(model, sync_barrier,
         pbar.close()
         utils.sync_out_streams()
 
+    if is_master_proc:
+        print('Time spent waiting for training data: %.1f sec' % train_iter.wait_time)
+
     return total_loss / float(total_qty)
 
 
@@ -237,9 +247,11 @@ def validate(model, train_params, dataset, run, qrelf, epoch, model_out_dir):
 
     runf = os.path.join(model_out_dir, f'{epoch}.run')
 
+    # Each validation can run in a separate process, which loads QRELs from the persistent cache
     return getEvalResults(train_params.use_external_eval,
                           eval_metric,
-                          rerank_run, runf, qrelf)
+                          rerank_run, runf, qrelf,
+                          useDiskCache=True)
 
 
 def run_model(model, train_params, dataset, orig_run, desc='valid'):
@@ -247,19 +259,38 @@ def run_model(model, train_params, dataset, orig_run, desc='valid'):
     clean_memory(train_params.device_name)
     with torch.no_grad(), tqdm(total=sum(len(r) for r in orig_run.values()), ncols=80, desc=desc, leave=False) as pbar:
         model.eval()
-        for records in data.iter_valid_records(model,
-                                               train_params.device_name,
-                                               dataset, orig_run,
-                                               train_params.batch_size_val,
-                                               train_params.max_query_len, train_params.max_doc_len):
-            scores = model(records['query_tok'],
-                           records['query_mask'],
-                           records['doc_tok'],
-                           records['doc_mask'])
+        valid_iter = data.iter_valid_records(model,
+                                             train_params.device_name,
+                                             dataset, orig_run,
+                                             train_params.batch_size_val,
+                                             train_params.max_query_len, train_params.max_doc_len,
+                                             worker_qty=train_params.data_worker_qty,
+                                             prefetch_qty=train_params.prefetch_qty,
+                                             pin_memory=train_params.pin_memory,
+                                             sort_by_len=train_params.sort_valid_by_len)
+        for records in valid_iter:
+            if records['single_query']:
+                # All records belong to the same query: the query is encoded only once
+                scores = model.score_candidates(records['query_tok'][0],
+                                                records['query_mask'][0],
+                                                records['doc_tok'],
+                                                records['doc_mask'])
+            else:
+                scores = model(records['query_tok'],
+                               records['query_mask'],
+                               records['doc_tok'],
+                               records['doc_mask'])
             for qid, did, score in zip(records['query_id'], records['doc_id'], scores):
                 rerank_run.setdefault(qid, {})[did] = score.item()
             pbar.update(len(records['query_id']))
 
+    print('Time spent waiting for %s data: %.1f sec' % (desc, valid_iter.wait_time))
+
+    if train_params.sort_valid_by_len is not None:
+        # restore the original order of queries and documents
+        rerank_run = {qid: {did: rerank_run[qid][did] for did in orig_run[qid] if did in rerank_run[qid]}
+                      for qid in orig_run if qid in rerank_run}
+
     return rerank_run
 
 
@@ -387,15 +418,27 @@ def main_cli():
     parser.add_argument('--datafiles', metavar='data files', help='data files: docs & queries',
                         type=argparse.FileType('rt'), nargs='+', required=True)
 
+    parser.add_argument('--token_cache_dir', metavar='token cache dir',
+                        help='an optional directory to store/load a cache of pre-tokenized queries & documents',
+                        type=str, default=None)
+
+    parser.add_argument('--doc_store_dir', metavar='doc store dir',
+                        help='an optional directory to store/load memory-mapped queries & documents',
+                        type=str, default=None)
+
     parser.add_argument('--qrels', metavar='QREL file', help='QREL file',
                         type=argparse.FileType('rt'), required=True)
 
     parser.add_argument('--train_pairs', metavar='paired train data', help='paired train data',
                         type=argparse.FileType('rt'), required=True)
 
-    parser.add_argument('--valid_run', metavar='validation file', help='validation file',
+    parser.add_argument('--valid_run', metavar='validation file',
+                        help=f'validation file: a TREC run or a binary run (with the suffix {BINARY_RUN_SUFF})',
                         type=argparse.FileType('rt'), required=True)
 
+    parser.add_argument('--valid_run_columnar', action='store_true',
+                        help='keep the validation run in the compact columnar format (saves memory for large runs)')
+
     parser.add_argument('--model_out_dir',
                         metavar='model out dir', help='an output directory for the trained model',
                         required=True)
@@ -471,6 +514,21 @@ def main_cli():
                         type=int, default=0,
                         help='max # of validation queries: 0 tells to use all data')
 
+    parser.add_argument('--data_worker_qty', metavar='# of data workers',
+                        type=int, default=0,
+                        help='# of worker processes to prefetch batches: 0 tells to prepare batches in the training process')
+
+    parser.add_argument('--prefetch_qty', metavar='# of prefetched batches',
+                        type=int, default=data.DEFAULT_PREFETCH_QTY,
+                        help='max. # of batches prefetched by all data workers')
+
+    parser.add_argument('--pin_memory', action='store_true',
+                        help='pin memory of prefetched batches (for faster non-blocking copying to GPU)')
+
+    parser.add_argument('--sort_valid_by_len', choices=data.SORT_BY_LEN_CHOICES, default=None,
+                        help='sort validation documents by length (within each query or in the whole run) ' +
+                             'to reduce padding: ' + ','.join(data.SORT_BY_LEN_CHOICES))
+
     parser.add_argument('--no_shuffle_train', action='store_true',
                         help='disabling shuffling of training data')
 
@@ -551,16 +609,21 @@ def main_cli():
     utils.sync_out_streams()
     model.set_grad_checkpoint_param(args.grad_checkpoint_param)
 
-    dataset = data.read_datafiles(args.datafiles)
+    dataset = data.read_datafiles(args.datafiles, model=model,
+                                  token_cache_dir=args.token_cache_dir,
+                                  doc_store_dir=args.doc_store_dir)
     qrelf = args.qrels.name
-    qrels = readQrelsDict(qrelf)
+    qrels = readQrelsDict(qrelf, useDiskCache=True)
     train_pairs_all = data.read_pairs_dict(args.train_pairs)
-    valid_run = readRunDict(args.valid_run.name)
+    valid_run = readRun(args.valid_run.name, columnar=args.valid_run_columnar)
     max_query_val = args.max_query_val
     query_ids = list(valid_run.keys())
     if max_query_val > 0:
         query_ids = query_ids[0:max_query_val]
-        valid_run = {k: valid_run[k] for k in query_ids}
+        if isinstance(valid_run, ColumnarRun):
+            valid_run = valid_run.selectQueries(query_ids)
+        else:
+            valid_run = {k: valid_run[k] for k in query_ids}
 
     print('# of eval. queries:', len(query_ids), ' in the file', args.valid_run.name)
 
@@ -613,6 +676,10 @@ def main_cli():
                                     use_external_eval=args.use_external_eval, eval_metric=args.eval_metric.lower(),
                                     print_grads=args.print_grads,
                                     shuffle_train=not args.no_shuffle_train,
+                                    data_worker_qty=args.data_worker_qty,
+                                    prefetch_qty=args.prefetch_qty,
+                                    pin_memory=args.pin_memory,
+                                    sort_valid_by_len=args.sort_valid_by_len,
                                     optim=args.optim)
 
         train_pair_qty = len(train_pairs_all)
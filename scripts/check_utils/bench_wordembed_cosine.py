@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# This script compares the speed of the vectorized (sparse-matrix) cosine scoring
+# of the word-embedding server with the original (per-document) one and checks
+# that both produce the same scores.
+import os
+import sys
+import time
+import argparse
+import random
+import tempfile
+
+import numpy as np
+
+sys.path.append('.')
+
+from scripts.py_featextr_server.wordembed_cosine_server import CosineSimilQueryHandler
+from scripts.py_featextr_server.python_generated.protocol.ttypes import WordEntryInfo, TextEntryParsed
+from scripts.py_featextr_server.utils import robustCosineSimil
+
+SCORE_TOL = 1e-4
+
+
+# The original scoring code
+def create_doc_embed_orig(handler, is_query, text_entry):
+    if is_query:
+        embeds = handler.queryEmbed
+        embed_map = handler.queryEmbedMap
+    else:
+        embeds = handler.answEmbed
+        embed_map = handler.answEmbedMap
+
+    res = np.zeros_like(embeds[0])
+
+    for winfo in text_entry.entries:
+        vect_mult = winfo.qty
+        if handler.useIDF:
+            vect_mult *= winfo.IDF
+        word = winfo.word
+        if word in embed_map:
+            res += embeds[embed_map[word]] * vect_mult
+
+    return res
+
+
+def compute_scores_orig(handler, query, docs):
+    ret = {}
+    query_embed = create_doc_embed_orig(handler, True, query)
+    for d in docs:
+        doc_embed = create_doc_embed_orig(handler, False, d)
+        ret[d.id] = [robustCosineSimil(doc_embed, query_embed)]
+
+    return ret
+
+
+def gen_entry(entry_id, vocab_qty, oov_qty, max_len):
+    entries = []
+    for _ in range(random.randint(0, max_len)):
+        # Some words are out-of-vocabulary
+        wid = random.randrange(vocab_qty + oov_qty)
+        entries.append(WordEntryInfo(word=f'w{wid}', IDF=random.uniform(0.1, 10), qty=random.randint(1, 5)))
+    return TextEntryParsed(id=entry_id, entries=entries)
+
+
+parser = argparse.ArgumentParser('Benchmarking word-embedding cosine scoring')
+
+parser.add_argument('--vocab_qty', metavar='vocabulary size', help='vocabulary size',
+                    type=int, default=50000)
+parser.add_argument('--dim', metavar='embedding dimensionality', help='embedding dimensionality',
+                    type=int, default=300)
+parser.add_argument('--doc_qty', metavar='# of documents', help='# of documents per request',
+                    type=int, default=1000)
+parser.add_argument('--request_qty', metavar='# of requests', help='# of requests',
+                    type=int, default=10)
+parser.add_argument('--max_query_len', metavar='max. query length', help='max. # of unique query words',
+                    type=int, default=10)
+parser.add_argument('--max_doc_len', metavar='max. document length', help='max. # of unique document words',
+                    type=int, default=200)
+
+args = parser.parse_args()
+print(args)
+
+random.seed(0)
+np.random.seed(0)
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    embed_file = os.path.join(tmp_dir, 'embeds.txt')
+    embeds = np.random.normal(size=(args.vocab_qty, args.dim))
+    with open(embed_file, 'w') as f:
+        for wid in range(args.vocab_qty):
+            f.write(f'w{wid}\t' + '\t'.join('%g' % v for v in embeds[wid]) + '\n')
+
+    handler = CosineSimilQueryHandler(queryEmbedFile=None, docEmbedFile=embed_file, exclusive=False)
+
+oov_qty = args.vocab_qty // 10
+requests = []
+for rid in range(args.request_qty):
+    query = gen_entry(str(rid), args.vocab_qty, oov_qty, args.max_query_len)
+    docs = [gen_entry(str(i), args.vocab_qty, oov_qty, args.max_doc_len) for i in range(args.doc_qty)]
+    # An empty document
+    docs[0].entries = []
+    requests.append((query, docs))
+
+for query, docs in requests:
+    res_orig = compute_scores_orig(handler, query, docs)
+    res_new = handler.computeScoresFromParsedOverride(query, docs)
+    assert res_orig.keys() == res_new.keys()
+    for did, scores in res_orig.items():
+        assert abs(scores[0] - res_new[did][0]) < SCORE_TOL, \
+            f'Score mismatch for query {query.id} doc {did}: {scores[0]} vs {res_new[did][0]}'
+
+print('The scores of the original and the vectorized implementations are identical (up to %g).' % SCORE_TOL)
+
+for name, func in [('original', lambda q, d: compute_scores_orig(handler, q, d)),
+                   ('vectorized', handler.computeScoresFromParsedOverride)]:
+    start_time = time.time()
+    for query, docs in requests:
+        func(query, docs)
+    elapsed = time.time() - start_time
+    print('%s scoring: %.2f ms per request with %d documents' %
+          (name, 1000 * elapsed / args.request_qty, args.doc_qty))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# This script checks that the columnar (vectorized) evaluator produces
+# exactly the same MAP and NDCG values as the original pure-Python one
+# and compares their speed.
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.append('.')
+
+from scripts.common_eval import readQrelsDict, readRunDict, evalRun, ColumnarEvaluator, \
+    MeanAveragePrecision, NormalizedDiscountedCumulativeGain, METRIC_MAP, METRIC_NDCG_PREF
+
+parser = argparse.ArgumentParser('Comparing the columnar and the original evaluators')
+
+parser.add_argument('--qrels', metavar='QREL file', help='QREL file',
+                    type=str, required=True)
+parser.add_argument('--run', metavar='a run file', help='a run file',
+                    type=str, required=True)
+parser.add_argument('--ndcg_k', metavar='NDCG cutoff', help='NDCG cutoff',
+                    type=int, default=20)
+
+args = parser.parse_args()
+print(args)
+
+qrels = readQrelsDict(args.qrels)
+run = readRunDict(args.run)
+
+metric_ndcg = METRIC_NDCG_PREF + str(args.ndcg_k)
+evaluator = ColumnarEvaluator(qrels)
+
+for metric, metric_func in [(METRIC_MAP, MeanAveragePrecision()),
+                            (metric_ndcg, NormalizedDiscountedCumulativeGain(args.ndcg_k))]:
+    start_time = time.time()
+    val_orig = evalRun(run, None, args.qrels, metric_func, useQrelCache=True)
+    time_orig = time.time() - start_time
+
+    start_time = time.time()
+    val_col = evaluator.evalRun(run, metric)
+    time_col = time.time() - start_time
+
+    print('%s original: %.6f (%.3f sec) columnar: %.6f (%.3f sec)' % (metric, val_orig, time_orig, val_col, time_col))
+    assert val_orig == val_col, f'{metric} values are different: {val_orig} vs {val_col}'
+
+query_ids, res = evaluator.evalQueries(run, [METRIC_MAP, metric_ndcg])
+for qid, val_map, val_ndcg in zip(query_ids, res[METRIC_MAP], res[metric_ndcg]):
+    qrel_dict = qrels.get(qid)
+    if qrel_dict is None:
+        continue
+    for val, metric_func in [(val_map, MeanAveragePrecision()),
+                             (val_ndcg, NormalizedDiscountedCumulativeGain(args.ndcg_k))]:
+        rels = [qrel_dict.get(did, 0) for did, _ in sorted(run[qid].items(), key=lambda x: (x[1], x[0]), reverse=True)]
+        assert val == metric_func(rels, qrel_dict), f'Query {qid} values are different'
+
+print('Mean and per-query values are identical, mean MAP: %g' % np.mean(res[METRIC_MAP]))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# This script checks that the vectorized DRMM histogram produces the same output as
+# the original (loop-based) implementation and compares their speed.
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.append('.')
+
+from scripts.cedr.modeling_util import DRMMLogCountHistogram
+from scripts.config import DEVICE_CPU
+
+
+# The original implementation
+def drmm_histogram_orig(nbins, simmat, dtoks, qtoks):
+    BATCH, CHANNELS, QLEN, DLEN = simmat.shape
+    # +1e-5 to nudge scores of 1 to above threshold
+    bins = ((simmat + 1.000001) / 2. * (nbins - 1)).int()
+    # set weights of 0 for padding (in both query and doc dims)
+    weights = ((dtoks != -1).reshape(BATCH, 1, DLEN).expand(BATCH, QLEN, DLEN) * \
+              (qtoks != -1).reshape(BATCH, QLEN, 1).expand(BATCH, QLEN, DLEN)).float()
+
+    bins, weights = bins.cpu(), weights.cpu()
+    histogram = []
+    for superbins, w in zip(bins, weights):
+        result = []
+        for b in superbins:
+            result.append(torch.stack([torch.bincount(q, x, nbins) for q, x in zip(b, w)], dim=0))
+        result = torch.stack(result, dim=0)
+        histogram.append(result)
+    histogram = torch.stack(histogram, dim=0)
+
+    histogram = histogram.to(simmat.device)
+    return (histogram.float() + 1e-5).log()
+
+
+parser = argparse.ArgumentParser('Checking & benchmarking the DRMM histogram')
+
+parser.add_argument('--batch_size', metavar='batch size', help='batch size',
+                    type=int, default=16)
+parser.add_argument('--channels', metavar='# of channels', help='# of channels (BERT layers + 1)',
+                    type=int, default=13)
+parser.add_argument('--query_len', metavar='query length', help='query length',
+                    type=int, default=32)
+parser.add_argument('--doc_len', metavar='document length', help='document length',
+                    type=int, default=476)
+parser.add_argument('--bins', metavar='# of bins', help='# of bins',
+                    type=int, default=11)
+parser.add_argument('--rep_qty', metavar='# of repetitions', help='# of repetitions',
+                    type=int, default=5)
+parser.add_argument('--device_name', metavar='device name', help='device name',
+                    type=str, default=DEVICE_CPU)
+
+args = parser.parse_args()
+print(args)
+
+torch.manual_seed(0)
+
+device_name = args.device_name
+BATCH, CHANNELS, QLEN, DLEN = args.batch_size, args.channels, args.query_len, args.doc_len
+
+simmat = (torch.rand(BATCH, CHANNELS, QLEN, DLEN, device=device_name) * 2 - 1)
+# exact matches and a few padded entries
+simmat[:, :, 0, 0] = 1.
+qtoks = torch.randint(0, 1000, (BATCH, QLEN), device=device_name)
+dtoks = torch.randint(0, 1000, (BATCH, DLEN), device=device_name)
+for b in range(BATCH):
+    qtoks[b, QLEN - b % QLEN:] = -1
+    dtoks[b, DLEN - (7 * b) % DLEN:] = -1
+
+hist = DRMMLogCountHistogram(args.bins).to(device_name)
+
+res_orig = drmm_histogram_orig(args.bins, simmat, dtoks, qtoks)
+res_new = hist(simmat, dtoks, qtoks)
+
+assert res_new.device == simmat.device
+assert res_orig.shape == res_new.shape, f'Shape mismatch {res_orig.shape} vs {res_new.shape}'
+assert torch.allclose(res_orig, res_new), \
+    'Max. difference: %g' % (res_orig - res_new).abs().max().item()
+
+print('The outputs of the original and the vectorized histograms are identical.')
+
+for name, func in [('original', lambda: drmm_histogram_orig(args.bins, simmat, dtoks, qtoks)),
+                   ('vectorized', lambda: hist(simmat, dtoks, qtoks))]:
+    start_time = time.time()
+    for _ in range(args.rep_qty):
+        func()
+    if device_name != DEVICE_CPU:
+        torch.cuda.synchronize(device_name)
+    elapsed = time.time() - start_time
+    print('%s histogram: %.2f ms per batch' % (name, 1000 * elapsed / args.rep_qty))
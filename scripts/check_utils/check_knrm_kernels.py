@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# This script checks that the fused KNRM kernel pooling (used by CEDR-KNRM)
+# produces the same outputs and gradients as the original implementation,
+# which materializes all kernels. On GPU, it also compares peak memory usage.
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.append('.')
+
+from scripts.cedr.modeling_util import KNRMRbfKernelBank
+from scripts.config import DEVICE_CPU
+
+MUS = [-0.9, -0.7, -0.5, -0.3, -0.1, 0.1, 0.3, 0.5, 0.7, 0.9, 1.0]
+SIGMAS = [0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.1, 0.001]
+
+
+# The original kernel pooling code from CedrKnrmRanker.forward
+def pool_orig(kernels, simmat):
+    kernels = kernels(simmat)
+    BATCH, KERNELS, VIEWS, QLEN, DLEN = kernels.shape
+    kernels = kernels.reshape(BATCH, KERNELS * VIEWS, QLEN, DLEN)
+    simmat = simmat.reshape(BATCH, 1, VIEWS, QLEN, DLEN) \
+                   .expand(BATCH, KERNELS, VIEWS, QLEN, DLEN) \
+                   .reshape(BATCH, KERNELS * VIEWS, QLEN, DLEN)
+    result = kernels.sum(dim=3)
+    mask = (simmat.sum(dim=3) != 0.)
+    result = torch.where(mask, (result + 1e-6).log(), mask.float())
+    return result.sum(dim=2)
+
+
+# The fused kernel pooling code from CedrKnrmRanker.forward
+def pool_fused(kernels, simmat):
+    result = kernels.doc_sum(simmat)
+    BATCH, KERNELS, VIEWS, QLEN = result.shape
+    result = result.reshape(BATCH, KERNELS * VIEWS, QLEN)
+    mask = (simmat.sum(dim=3) != 0.)
+    mask = mask.reshape(BATCH, 1, VIEWS, QLEN) \
+               .expand(BATCH, KERNELS, VIEWS, QLEN) \
+               .reshape(BATCH, KERNELS * VIEWS, QLEN)
+    result = torch.where(mask, (result + 1e-6).log(), mask.float())
+    return result.sum(dim=2)
+
+
+def run(func, kernels, simmat, weights, device_name):
+    kernels.zero_grad()
+    simmat = simmat.clone().requires_grad_(True)
+    if device_name != DEVICE_CPU:
+        torch.cuda.synchronize(device_name)
+        torch.cuda.reset_peak_memory_stats(device_name)
+    start_time = time.time()
+    out = func(kernels, simmat)
+    (out * weights).sum().backward()
+    if device_name != DEVICE_CPU:
+        torch.cuda.synchronize(device_name)
+    elapsed = time.time() - start_time
+    peak_mem = torch.cuda.max_memory_allocated(device_name) if device_name != DEVICE_CPU else None
+    grads = [simmat.grad] + [p.grad.clone() for p in kernels.parameters()]
+    return out.detach(), grads, elapsed, peak_mem
+
+
+parser = argparse.ArgumentParser('Checking & benchmarking the fused KNRM kernel pooling')
+
+parser.add_argument('--batch_size', metavar='batch size', help='batch size',
+                    type=int, default=8)
+parser.add_argument('--channels', metavar='# of channels', help='# of channels (BERT layers + 1)',
+                    type=int, default=13)
+parser.add_argument('--query_len', metavar='query length', help='query length',
+                    type=int, default=32)
+parser.add_argument('--doc_len', metavar='document length', help='document length',
+                    type=int, default=476)
+parser.add_argument('--device_name', metavar='device name', help='device name',
+                    type=str, default=DEVICE_CPU)
+
+args = parser.parse_args()
+print(args)
+
+torch.manual_seed(0)
+
+device_name = args.device_name
+BATCH, CHANNELS, QLEN, DLEN = args.batch_size, args.channels, args.query_len, args.doc_len
+
+simmat = torch.rand(BATCH, CHANNELS, QLEN, DLEN, device=device_name) * 2 - 1
+# padding is represented by zero similarity
+simmat[:, :, QLEN // 2:, :] = 0
+simmat[:, :, :, DLEN // 2:] = 0
+weights = torch.rand(BATCH, len(MUS) * CHANNELS, device=device_name)
+
+kernels = KNRMRbfKernelBank(MUS, SIGMAS).to(device_name)
+
+out_orig, grads_orig, time_orig, mem_orig = run(pool_orig, kernels, simmat, weights, device_name)
+out_fused, grads_fused, time_fused, mem_fused = run(pool_fused, kernels, simmat, weights, device_name)
+
+assert torch.allclose(out_orig, out_fused), \
+    'Max. output difference: %g' % (out_orig - out_fused).abs().max().item()
+for g_orig, g_fused in zip(grads_orig, grads_fused):
+    assert torch.allclose(g_orig, g_fused, rtol=1e-4, atol=1e-5), \
+        'Max. gradient difference: %g' % (g_orig - g_fused).abs().max().item()
+
+print('The outputs and gradients of the original and the fused kernel pooling are the same.')
+
+print('original: %.2f ms' % (1000 * time_orig))
+print('fused: %.2f ms' % (1000 * time_fused))
+if device_name != DEVICE_CPU:
+    print('original peak memory: %.1f MB' % (mem_orig / 1024 / 1024))
+    print('fused peak memory: %.1f MB' % (mem_fused / 1024 / 1024))
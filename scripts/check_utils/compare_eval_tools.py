@@ -14,8 +14,11 @@ parser = argparse.ArgumentParser('Comparing external and internal eval tools')
 
 parser.add_argument('--qrels', metavar='QREL file', help='QREL file',
                     type=str, required=True)
-parser.add_argument('--run', metavar='a run file', help='a run file',
+parser.add_argument('--run', metavar='a run file',
+                    help=f'a run file: a TREC run or a binary run (with the suffix {BINARY_RUN_SUFF})',
                     type=str, required=True)
+parser.add_argument('--columnar_run', action='store_true',
+                    help='read the run in the compact columnar format (saves memory for large runs)')
 parser.add_argument('--eps', metavar='max relative ratio',
                     help='a threshold to report query-specific differences',
                     type=float, required=True)
@@ -26,8 +29,8 @@ parser.add_argument('--eval_metric', choices=METRIC_LIST, default=METRIC_LIST[0]
 args = parser.parse_args()
 print(args)
 
-qrels = readQrelsDict(args.qrels)
-run = readRunDict(args.run)
+qrels = readQrelsDict(args.qrels, useDiskCache=True)
+run = readRun(args.run, columnar=args.columnar_run)
 query_ids = list(run.keys())
 
 
@@ -1,12 +1,25 @@
 # Common evaluation routines, including pure-Python computation of NDCG & MAP
 import collections
+import gzip, bz2
+import hashlib
+import heapq
+import os
+import shutil
+import tempfile
+import time
 import numpy as np
 import subprocess
 import math
+from collections.abc import Mapping
+from itertools import chain, groupby, islice
 from tqdm import tqdm
 
 FAKE_RUN_ID = "fake_run"
 
+# Binary runs (see ColumnarRun) are uncompressed numpy .npz archives
+BINARY_RUN_SUFF = '.npz'
+BINARY_RUN_VERSION = 1
+
 METRIC_MAP = 'map'
 # We hardcode 20, b/c it's hardcoded in gdeval.pl
 NDCG_TOP_K = 20
@@ -14,13 +27,35 @@ METRIC_NDCG20 = 'ndcg@20'
 
 METRIC_LIST = [METRIC_MAP, METRIC_NDCG20]
 
+# Additional metrics supported by the columnar evaluator (see ColumnarEvaluator):
+# in addition to fixed names, one can use ndcg@<k> and p@<k> for any k.
+METRIC_MRR = 'mrr'
+METRIC_RECALL = 'recall'
+METRIC_NDCG_PREF = 'ndcg@'
+METRIC_PREC_PREF = 'p@'
+
 QrelEntry = collections.namedtuple('QrelEntry',
                                    'queryId docId relGrade')
 
 RELEVANCE_THRESHOLD = 1e-5
 
+# A maximum size of dense matrices created by ColumnarEvaluator (per chunk of queries)
+DEFAULT_EVAL_MAX_CELL_QTY = 1 << 22
+
 qrelCache = {}
 
+# A persistent (cross-process) QREL cache, which is used only if requested (see readQrelsDict):
+# each QREL file is stored as a set of memory-mappable numpy .npy files. The cache location
+# can be changed using the environment variable QREL_CACHE_DIR_ENV (setting it
+# to an empty string disables the cache). The cache directory can be safely deleted at any time.
+QREL_CACHE_DIR_ENV = 'FLEXNEUART_QREL_CACHE_DIR'
+DEFAULT_QREL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'flexneuart', 'qrels')
+QREL_CACHE_VERSION = 1
+QREL_CACHE_ARRAYS = ['queryIds', 'queryOffsets', 'docIdBuf', 'docIdOffsets', 'grades']
+QREL_CACHE_TMP_PREF = 'tmp_'
+# Temporary entries older than this are considered to be left by killed processes
+QREL_CACHE_TMP_MAX_AGE_SEC = 3600
+
 class NormalizedDiscountedCumulativeGain:
     def __init__(self, k):
         self._k = k
@@ -71,6 +106,212 @@ class MeanAveragePrecision:
         return result / postQty
 
 
+RunRelMatrix = collections.namedtuple('RunRelMatrix',
+                                     'queryIds rels lens')
+
+
+def getRunRelMatrix(run, qrels, chunkSize=4096):
+    """Convert a run into a padded (# of queries x max. # of documents) matrix of relevance
+       grades, where documents of each query are ordered by decreasing scores. Ties are broken
+       in the same way as in getSorteScoresFromScoreDict (by decreasing document IDs).
+       Only relevant documents (with grades above RELEVANCE_THRESHOLD) get non-zero grades.
+
+       Runs are not sorted: instead, the rank of each relevant document is computed
+       as the number of documents with higher scores (plus the number of documents with
+       the same score but larger document IDs).
+
+    :param run:         a run dictionary (of dictionaries)
+    :param qrels:       a QREL dictionary (of dictionaries)
+    :param chunkSize:   a number of relevant documents whose ranks are computed at once
+    :return: a RunRelMatrix object: query IDs are in the order of the run dictionary
+    """
+    queryIds = list(run.keys())
+    queryQty = len(queryIds)
+    lens = np.fromiter((len(run[qid]) for qid in queryIds), dtype=np.int64, count=queryQty)
+    totQty = int(lens.sum())
+    maxLen = int(lens.max()) if queryQty else 0
+
+    scores = np.fromiter(chain.from_iterable(run[qid].values() for qid in queryIds),
+                         dtype=np.float64, count=totQty)
+    starts = np.cumsum(lens) - lens
+    scoreMatrix = np.full((queryQty, maxLen), -np.inf)
+    scoreMatrix[np.repeat(np.arange(queryQty), lens), np.arange(totQty) - np.repeat(starts, lens)] = scores
+
+    # Relevant documents that are present in the run
+    relQueryIdx, relScores, relGrades, relDocIds = [], [], [], []
+    for i, qid in enumerate(queryIds):
+        queryQrelDict = qrels.get(qid)
+        if queryQrelDict is None:
+            continue
+        scoreDict = run[qid]
+        for did, grade in queryQrelDict.items():
+            if grade > RELEVANCE_THRESHOLD and did in scoreDict:
+                relQueryIdx.append(i)
+                relScores.append(scoreDict[did])
+                relGrades.append(grade)
+                relDocIds.append(did)
+
+    relQueryIdx = np.array(relQueryIdx, dtype=np.int64)
+    relScores = np.array(relScores, dtype=np.float64)
+    relRanks = np.zeros(len(relQueryIdx), dtype=np.int64)
+    colIds = np.arange(maxLen)
+
+    for start in range(0, len(relQueryIdx), chunkSize):
+        end = start + chunkSize
+        rowScores = scoreMatrix[relQueryIdx[start:end]]
+        thresh = relScores[start:end, None]
+        relRanks[start:end] = (rowScores > thresh).sum(axis=1)
+        # Padding can be equal to the score only if the latter is -inf, hence, we need to check column IDs
+        tieQty = ((rowScores == thresh) & (colIds < lens[relQueryIdx[start:end], None])).sum(axis=1)
+        # Ties are rare, so we resolve them using regular Python code
+        for k in np.where(tieQty > 1)[0]:
+            pos = start + k
+            score, did = relScores[pos], relDocIds[pos]
+            relRanks[pos] += sum(1 for otherDid, otherScore in run[queryIds[relQueryIdx[pos]]].items()
+                                 if otherScore == score and otherDid > did)
+
+    rels = np.zeros((queryQty, maxLen), dtype=np.int64)
+    rels[relQueryIdx, relRanks] = relGrades
+
+    return RunRelMatrix(queryIds=queryIds, rels=rels, lens=lens)
+
+
+def getQueryChunks_(lens, maxCellQty):
+    """Split queries into chunks of queries with similar result list lengths, so that
+       the padded (# of queries x max. length) matrix of each chunk has at most maxCellQty elements
+       (a chunk can be larger only if it consists of a single query).
+
+    :param lens:        an array of result list lengths
+    :param maxCellQty:  a maximum number of elements in the padded matrix
+    :return: a list of arrays of query indices
+    """
+    order = np.argsort(lens, kind='stable')
+    chunks = []
+    start = 0
+    for end in range(1, len(order) + 1):
+        # lengths are sorted, so the last query of the chunk is the longest one
+        if end == len(order) or (end + 1 - start) * lens[order[end]] > maxCellQty:
+            chunks.append(order[start:end])
+            start = end
+    return chunks
+
+
+class ColumnarEvaluator:
+    """A vectorized evaluator, which computes metrics for many queries of a run at once.
+       MAP and NDCG values are identical (bit-for-bit) to those computed by evalRun with
+       MeanAveragePrecision and NormalizedDiscountedCumulativeGain: to this end,
+       the same (sequential) order of summation is used and logarithms are computed using math.log.
+       As in evalRun, queries missing in QRELs get zero metric values.
+
+       Dense (# of queries x max. # of documents) matrices are created for chunks of queries
+       with similar numbers of documents: the size of each matrix is limited by maxCellQty
+       (unless a single query has more documents). Thus, the memory consumption is proportional
+       to the number of run entries even if the lengths of query result lists vary a lot.
+    """
+    def __init__(self, qrels, maxCellQty=DEFAULT_EVAL_MAX_CELL_QTY):
+        """Constructor.
+
+        :param qrels:       a QREL dictionary (of dictionaries)
+        :param maxCellQty:  a maximum number of elements in a dense matrix of a query chunk
+        """
+        self.qrels = qrels
+        self.maxCellQty = maxCellQty
+
+    def getIDCG_(self, queryIds, k):
+        # This loop goes over QRELs only (which is fast) and uses
+        # the original function, which guarantees identical values.
+        ndcg = NormalizedDiscountedCumulativeGain(k)
+        return np.array([ndcg._dcg(sorted(self.qrels[qid].values(), reverse=True)) if qid in self.qrels else 0.
+                         for qid in queryIds])
+
+    def evalQueries(self, run, metricList):
+        """Compute metric values for each query of the run.
+
+        :param run:         a run dictionary (of dictionaries)
+        :param metricList:  a list of metric names: map, mrr, recall, ndcg@<k>, p@<k>
+        :return: a tuple: a list of query IDs (in the order of the run dictionary), a dictionary
+                 of numpy arrays with per-query metric values indexed by metric names.
+        """
+        queryIds = list(run.keys())
+        lens = np.array([len(run[qid]) for qid in queryIds], dtype=np.int64)
+        res = {metric: np.zeros(len(queryIds)) for metric in metricList}
+
+        for chunkIdx in getQueryChunks_(lens, self.maxCellQty):
+            _, chunkRes = self.evalQueriesDense_({queryIds[i]: run[queryIds[i]] for i in chunkIdx}, metricList)
+            for metric in metricList:
+                res[metric][chunkIdx] = chunkRes[metric]
+
+        return queryIds, res
+
+    def evalQueriesDense_(self, run, metricList):
+        # Ranks of relevant documents are computed using (# of relevant documents x max. length) matrices
+        maxLen = max(len(scoreDict) for scoreDict in run.values())
+        runRels = getRunRelMatrix(run, self.qrels, chunkSize=max(1, min(4096, self.maxCellQty // max(maxLen, 1))))
+        queryIds = runRels.queryIds
+        rels = runRels.rels
+        relMask = rels > RELEVANCE_THRESHOLD
+        queryQty, maxLen = rels.shape
+
+        inQrels = np.array([qid in self.qrels for qid in queryIds], dtype=bool)
+        qrelQty = np.array([len(self.qrels[qid]) if qid in self.qrels else 0 for qid in queryIds])
+        relQty = np.array([sum(rel > RELEVANCE_THRESHOLD for rel in self.qrels[qid].values())
+                           if qid in self.qrels else 0 for qid in queryIds])
+
+        res = {}
+        for metric in metricList:
+            if metric == METRIC_MAP:
+                posQty = np.cumsum(relMask, axis=1).astype(np.float64)
+                precs = np.where(relMask, posQty / np.arange(1., maxLen + 1.), 0.)
+                # Unlike sum(), cumsum() adds numbers sequentially, which is exactly what MeanAveragePrecision does
+                sumPrecs = np.cumsum(precs, axis=1)[:, -1] if maxLen else np.zeros(queryQty)
+                # Note that MeanAveragePrecision divides by the number of all QREL entries (including non-relevant)
+                val = np.divide(sumPrecs, qrelQty, out=np.zeros(queryQty), where=inQrels)
+            elif metric.startswith(METRIC_NDCG_PREF):
+                k = int(metric[len(METRIC_NDCG_PREF):])
+                topRels = rels[:, :k]
+                discounts = np.array([math.log(2. + i) for i in range(topRels.shape[1])])
+                # 2^rel is computed exactly, so it is the same as math.pow(2., rel)
+                gains = np.where(topRels > RELEVANCE_THRESHOLD, np.ldexp(1., topRels) - 1., 0.) / discounts
+                dcg = np.cumsum(gains, axis=1)[:, -1] if topRels.shape[1] else np.zeros(queryQty)
+                idcg = self.getIDCG_(queryIds, k)
+                val = np.divide(dcg, idcg, out=np.zeros(queryQty), where=idcg > 0)
+            elif metric == METRIC_MRR:
+                hasRel = relMask.any(axis=1)
+                firstRelRank = np.argmax(relMask, axis=1) + 1 if maxLen else np.ones(queryQty, dtype=np.int64)
+                val = np.where(hasRel, 1. / firstRelRank, 0.)
+            elif metric.startswith(METRIC_PREC_PREF):
+                k = int(metric[len(METRIC_PREC_PREF):])
+                val = relMask[:, :k].sum(axis=1) / float(k)
+            elif metric == METRIC_RECALL:
+                val = np.divide(relMask.sum(axis=1), relQty, out=np.zeros(queryQty), where=relQty > 0)
+            else:
+                raise Exception('Unsupported metric: ' + metric)
+
+            res[metric] = val
+
+        return queryIds, res
+
+    def evalRun(self, run, metric):
+        """Compute the average metric value over all queries of the run."""
+        _, res = self.evalQueries(run, [metric])
+        return np.mean(res[metric])
+
+
+def openTextFile(fileName, mode='rt'):
+    """Open a regular or a compressed text file (like FileWrapper from data_convert,
+       the compression is determined by the suffix).
+
+    :param fileName:  a name of the file, if it has a '.gz' or '.bz2' extension, we open a compressed stream.
+    :param mode:      open mode such as 'rt' or 'wt'
+    :return: a file object
+    """
+    if fileName.endswith('.gz'):
+        return gzip.open(fileName, mode)
+    if fileName.endswith('.bz2'):
+        return bz2.open(fileName, mode)
+    return open(fileName, mode)
+
+
 def genQrelStr(queryId, docId, relGrade):
     """Produces a string representing one QREL entry
 
@@ -108,16 +349,15 @@ def parseQrelEntry(line):
     return QrelEntry(queryId=parts[0], docId=parts[2], relGrade=int(parts[3]))
 
 
-def readQrels(fileName):
-    """Read and parse QRELs.
+def iterQrels(fileName):
+    """Read and parse QRELs one entry at a time (the file can be compressed).
 
     :param fileName: input file name
-    :return: an array of parsed QREL entries
+    :return: a generator of parsed QREL entries
     """
     ln = 0
-    res = []
 
-    with open(fileName) as f:
+    with openTextFile(fileName) as f:
         for line in tqdm(f, desc='loading qrels (by line)', leave=False):
             ln += 1
             line = line.strip()
@@ -125,11 +365,33 @@ def readQrels(fileName):
                 continue
             try:
                 e = parseQrelEntry(line)
-                res.append(e)
             except:
                 raise Exception('Error parsing QRELs in line: %d' % ln)
+            yield e
 
-    return res
+
+def readQrels(fileName):
+    """Read and parse QRELs.
+
+    :param fileName: input file name
+    :return: an array of parsed QREL entries
+    """
+    return list(iterQrels(fileName))
+
+
+def iterQrelsByQuery(fileName):
+    """Read QRELs one query at a time: entries of each query must be adjacent
+       (which is the case for QREL files generated by our scripts).
+
+    :param fileName: QREL file name
+    :return: a generator of (query ID, dictionary of relevance grades indexed by document IDs) tuples
+    """
+    seenQueryIds = set()
+    for qid, entries in groupby(iterQrels(fileName), key=lambda e: e.queryId):
+        if qid in seenQueryIds:
+            raise Exception(f'QREL entries of query {qid} are not adjacent in file {fileName}')
+        seenQueryIds.add(qid)
+        yield qid, {e.docId: int(e.relGrade) for e in entries}
 
 
 def getSorteScoresFromScoreDict(queryRunDict):
@@ -142,6 +404,18 @@ def getSorteScoresFromScoreDict(queryRunDict):
     return list(sorted(queryRunDict.items(), key=lambda x: (x[1], x[0]), reverse=True))
 
 
+def getTopScoresFromScoreDict(queryRunDict, topK):
+    """Same as getSorteScoresFromScoreDict, but returns at most topK
+       entries (without sorting the whole dictionary).
+
+    :param   queryRunDict: a single-query run info in the dictionary format.
+    :param   topK:         a maximum number of entries to return (None means all entries)
+    """
+    if topK is None:
+        return getSorteScoresFromScoreDict(queryRunDict)
+    return heapq.nlargest(topK, queryRunDict.items(), key=lambda x: (x[1], x[0]))
+
+
 def writeRunDict(runDict, fileName):
     """Write a dictionary-stored run to a file. The input
        is actually a dictionary of dictinoary. The outer
@@ -153,20 +427,33 @@ def writeRunDict(runDict, fileName):
     :param runDict:    a run dictionary
     :param fileName:  an output file name
     """
-    with open(fileName, 'wt') as runfile:
-        for qid in runDict:
-            scores = getSorteScoresFromScoreDict(runDict[qid])
+    writeRunByQuery(runDict.items(), fileName)
+
+
+def writeRunByQuery(queryIter, fileName, topK=None, runId=FAKE_RUN_ID):
+    """A streaming version of writeRunDict: query results are written as soon
+       as they are generated, e.g., by iterRunByQuery. Before writing data,
+       it is resorted within each query (and optionally truncated).
+
+    :param queryIter:  an iterable over (query ID, dictionary of scores indexed by document IDs) tuples
+    :param fileName:   an output file name (if it ends with .gz or .bz2, the output is compressed)
+    :param topK:       an optional maximum number of entries to keep for each query
+    :param runId:      a run ID
+    """
+    with openTextFile(fileName, 'wt') as runfile:
+        for qid, queryRunDict in queryIter:
+            scores = getTopScoresFromScoreDict(queryRunDict, topK)
             for i, (did, score) in enumerate(scores):
-                runfile.write(genRunEntryStr(qid, did, i + 1, score, FAKE_RUN_ID) + '\n')
+                runfile.write(genRunEntryStr(qid, did, i + 1, score, runId) + '\n')
 
 
 def writeQrels(qrelList, fileName):
     """Write a list of QRELs to a file.
 
-    :param qrelList:  a list of parsed QRELs
-    :param fileName:  an output file name
+    :param qrelList:  a list (or any other iterable) of parsed QRELs
+    :param fileName:  an output file name (if it ends with .gz or .bz2, the output is compressed)
     """
-    with open(fileName, 'w') as f:
+    with openTextFile(fileName, 'wt') as f:
         for e in qrelList:
             f.write(qrelEntry2Str(e))
             f.write('\n')
@@ -185,26 +472,191 @@ def genRunEntryStr(queryId, docId, rank, score, runId):
     return f'{queryId} Q0 {docId} {rank} {score} {runId}'
 
 
-def readQrelsDict(fileName):
-    """Read QRELs in the form of a dictionary where keys are query IDs.
+class ColumnarQrels(Mapping):
+    """A read-only QREL mapping from query IDs to the dictionaries of relevance
+       grades (indexed by document IDs), which is backed by a few flat arrays.
+       Entries of the i-th query are located between queryOffsets[i] and queryOffsets[i+1].
+       Document IDs are stored in a single byte buffer (each ID is followed by the newline)
+       and the ID of the j-th entry starts at docIdOffsets[j].
 
-    :param fileName: QREL file name
-    :return: a dictionary of dictionaries
+       Query-specific dictionaries are created on demand (and memoized). Thus, if arrays
+       are memory-mapped (see loadQrelCache), the object is "loaded" almost instantly.
     """
-    result = {}
-    for e in readQrels(fileName):
-        result.setdefault(e.queryId, {})[e.docId] = int(e.relGrade)
-    return result
+    def __init__(self, queryIds, queryOffsets, docIdBuf, docIdOffsets, grades):
+        """Constructor.
+
+        :param queryIds:      a list of unique query IDs
+        :param queryOffsets:  an array of query start offsets (its length is # of queries + 1)
+        :param docIdBuf:      a uint8 array of newline-terminated document IDs
+        :param docIdOffsets:  an array of document ID start offsets in docIdBuf (its length is # of entries + 1)
+        :param grades:        an array of relevance grades
+        """
+        assert len(queryOffsets) == len(queryIds) + 1
+        assert len(docIdOffsets) == len(grades) + 1 == queryOffsets[-1] + 1
+        self.queryIds = queryIds
+        self.queryOffsets = queryOffsets
+        self.docIdBuf = docIdBuf
+        self.docIdOffsets = docIdOffsets
+        self.grades = grades
+        self.queryIdMap = {qid: i for i, qid in enumerate(queryIds)}
+        self.queryDicts_ = {}
+
+    def __getitem__(self, queryId):
+        res = self.queryDicts_.get(queryId)
+        if res is None:
+            i = self.queryIdMap[queryId]
+            start, end = int(self.queryOffsets[i]), int(self.queryOffsets[i + 1])
+            docIds = self.docIdBuf[self.docIdOffsets[start]:self.docIdOffsets[end]].tobytes().decode().split('\n')[:-1]
+            res = self.queryDicts_[queryId] = dict(zip(docIds, self.grades[start:end].tolist()))
+        return res
 
+    def __iter__(self):
+        return iter(self.queryIds)
 
-def readRunDict(fileName):
-    """Read a run file in the form of a dictionary where keys are query IDs.
+    def __len__(self):
+        return len(self.queryIds)
 
-    :param fileName: run file name
-    :return:
+    def __contains__(self, queryId):
+        return queryId in self.queryIdMap
+
+    @staticmethod
+    def fromQrelsDict(qrelDict):
+        """Create columnar QRELs from a QREL dictionary (of dictionaries).
+
+        :param qrelDict:  a QREL dictionary
+        :return: a ColumnarQrels object
+        """
+        queryIds = list(qrelDict.keys())
+        lens = [len(qrelDict[qid]) for qid in queryIds]
+        docIdBuf = np.frombuffer(''.join(did + '\n' for qid in queryIds for did in qrelDict[qid]).encode(),
+                                 dtype=np.uint8)
+        grades = np.fromiter(chain.from_iterable(qrelDict[qid].values() for qid in queryIds),
+                             dtype=np.int32, count=sum(lens))
+        return ColumnarQrels(queryIds,
+                             np.concatenate([[0], np.cumsum(lens, dtype=np.int64)]),
+                             docIdBuf,
+                             np.concatenate([[0], np.where(docIdBuf == ord('\n'))[0] + 1]),
+                             grades)
+
+
+def getQrelCacheDir():
+    """:return: a directory of the persistent QREL cache or None if the cache is disabled"""
+    return os.environ.get(QREL_CACHE_DIR_ENV, DEFAULT_QREL_CACHE_DIR) or None
+
+
+def getQrelCacheEntryName(fileName):
+    """Compute the name of the cache entry for the current version of the QREL file:
+       an entry becomes stale as soon as the file is modified. The file must be stat'ed
+       before it is parsed: otherwise, if the file changes in between, old content
+       could be saved under the key of the new version.
+
+    :param fileName:  a QREL file name
+    :return: a cache entry name: <hash of the absolute path>_<mtime>_<size>_v<cache version>
+    """
+    st = os.stat(fileName)
+    return getQrelCachePrefix_(fileName) + f'{st.st_mtime_ns}_{st.st_size}_v{QREL_CACHE_VERSION}'
+
+
+def getQrelCachePrefix_(fileName):
+    return hashlib.sha1(os.path.abspath(fileName).encode()).hexdigest() + '_'
+
+
+def loadQrelCache(cacheDir, entryName):
+    """Load QRELs from the persistent cache (arrays are memory-mapped).
+
+    :param cacheDir:   a cache directory
+    :param entryName:  a cache entry name (see getQrelCacheEntryName)
+    :return: a ColumnarQrels object or None if the entry does not exist
+    """
+    entryDir = os.path.join(cacheDir, entryName)
+    if not os.path.isdir(entryDir):
+        return None
+    try:
+        # Slicing of regular arrays is faster than that of np.memmap objects (views still use mapped memory)
+        data = {name: np.asarray(np.load(os.path.join(entryDir, name + '.npy'), mmap_mode='r', allow_pickle=False))
+                for name in QREL_CACHE_ARRAYS}
+    except (OSError, ValueError):
+        # An entry can be deleted by another process, which has just cached a newer version of the file
+        return None
+    return ColumnarQrels(decodeStrList_(data['queryIds']),
+                         data['queryOffsets'], data['docIdBuf'], data['docIdOffsets'], data['grades'])
+
+
+def saveQrelCache(cacheDir, entryName, qrels):
+    """Save QRELs to the persistent cache and delete stale cache entries of the same file.
+       Concurrent writers are fine: an entry is written to a temporary directory,
+       which is then (atomically) renamed. Temporary directories left by killed
+       processes are deleted once they are older than QREL_CACHE_TMP_MAX_AGE_SEC.
+
+    :param cacheDir:   a cache directory
+    :param entryName:  a cache entry name (see getQrelCacheEntryName)
+    :param qrels:      a ColumnarQrels object created from the file
+    """
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpDir = tempfile.mkdtemp(dir=cacheDir, prefix=QREL_CACHE_TMP_PREF)
+    try:
+        np.save(os.path.join(tmpDir, 'queryIds.npy'), encodeStrList_(qrels.queryIds))
+        for name in QREL_CACHE_ARRAYS[1:]:
+            np.save(os.path.join(tmpDir, name + '.npy'), getattr(qrels, name))
+        os.rename(tmpDir, os.path.join(cacheDir, entryName))
+    except OSError:
+        # Most likely, another process has created the same entry
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+    # Entry names start with the hash of the file path (followed by '_')
+    prefix = entryName.split('_')[0] + '_'
+    minTmpTime = time.time() - QREL_CACHE_TMP_MAX_AGE_SEC
+    for fn in os.listdir(cacheDir):
+        path = os.path.join(cacheDir, fn)
+        if fn.startswith(prefix) and fn != entryName:
+            shutil.rmtree(path, ignore_errors=True)
+        elif fn.startswith(QREL_CACHE_TMP_PREF):
+            try:
+                if os.path.getmtime(path) < minTmpTime:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                # The directory has just been renamed or deleted by another process
+                pass
+
+
+def readQrelsDict(fileName, useDiskCache=False):
+    """Read QRELs in the form of a dictionary where keys are query IDs.
+       If requested, QRELs are also stored in a persistent cross-process cache
+       (see QREL_CACHE_DIR_ENV), which is used if the file has not changed since
+       (judging by its modification time and size). In this case, the function always
+       returns a read-only ColumnarQrels mapping, which can be used in place of a dictionary.
+
+    :param fileName:      QREL file name
+    :param useDiskCache:  True to use the persistent QREL cache
+    :return: a dictionary of dictionaries (a ColumnarQrels object if useDiskCache is True)
     """
+    cacheDir = getQrelCacheDir() if useDiskCache else None
+    if cacheDir is not None:
+        # The key is computed before parsing: if the file changes while we are reading it,
+        # the entry is saved under the key of the old version, which is never used again.
+        entryName = getQrelCacheEntryName(fileName)
+        qrels = loadQrelCache(cacheDir, entryName)
+        if qrels is not None:
+            return qrels
+
     result = {}
-    with open(fileName) as f:
+    for e in iterQrels(fileName):
+        result.setdefault(e.queryId, {})[e.docId] = int(e.relGrade)
+
+    if useDiskCache:
+        result = ColumnarQrels.fromQrelsDict(result)
+        if cacheDir is not None:
+            try:
+                saveQrelCache(cacheDir, entryName, result)
+            except OSError as e:
+                print(f'Failed to cache QRELs from {fileName} in {cacheDir}: {e}')
+
+    return result
+
+
+def iterRunEntries_(fileName):
+    # Generates (query ID, document ID, score) tuples
+    with openTextFile(fileName) as f:
         for ln, line in enumerate(tqdm(f, desc='loading run (by line)', leave=False)):
             line = line.strip()
             if not line:
@@ -216,13 +668,315 @@ def readRunDict(fileName):
                     f'Invalid line {ln} in run file {fileName} expected 6 white-space separated fields by got: {line}')
 
             qid, _, docid, rank, score, _ = fld
-            result.setdefault(qid, {})[docid] = float(score)
+            yield qid, docid, float(score)
+
+
+def readRunDict(fileName):
+    """Read a run file in the form of a dictionary where keys are query IDs.
+
+    :param fileName: run file name (the file can be compressed)
+    :return:
+    """
+    result = {}
+    for qid, docid, score in iterRunEntries_(fileName):
+        result.setdefault(qid, {})[docid] = score
 
     return result
 
 
+def iterRunByQuery(fileName):
+    """Read a run file one query at a time, so that only a single query
+       is kept in memory. Entries of each query must be adjacent,
+       which is the case for runs produced by writeRunDict and most retrieval tools.
+       As in readRunDict, duplicate entries are merged (the last score wins).
+
+    :param fileName: run file name (the file can be compressed)
+    :return: a generator of (query ID, dictionary of scores indexed by document IDs) tuples
+    """
+    seenQueryIds = set()
+    for qid, entries in groupby(iterRunEntries_(fileName), key=lambda e: e[0]):
+        if qid in seenQueryIds:
+            raise Exception(f'Entries of query {qid} are not adjacent in run file {fileName}')
+        seenQueryIds.add(qid)
+        yield qid, {docid: score for _, docid, score in entries}
+
+
+def encodeStrList_(strList):
+    # IDs in runs cannot contain white spaces, so the newline is a safe separator
+    return np.frombuffer('\n'.join(strList).encode(), dtype=np.uint8)
+
+
+def decodeStrList_(arr):
+    return arr.tobytes().decode().split('\n') if len(arr) else []
+
+
+class ColumnarRun(Mapping):
+    """A compact run representation, which stores all entries in parallel arrays:
+       document indices (int32) and scores (float32), which are grouped by query.
+       Entries of the i-th query are located between queryOffsets[i] and queryOffsets[i+1].
+       Query and document IDs are interned: each unique ID string is stored only once.
+
+       This class is also a read-only mapping from query IDs to the dictionaries of document scores,
+       i.e., it can be used in place of a run dictionary returned by readRunDict (query-specific
+       dictionaries are created on demand). Note that scores are stored as float32 values.
+    """
+    def __init__(self, queryIds, docIds, queryOffsets, docIdx, scores):
+        """Constructor.
+
+        :param queryIds:      a list of unique query IDs
+        :param docIds:        a list of unique document IDs
+        :param queryOffsets:  an array of query start offsets (its length is # of queries + 1)
+        :param docIdx:        an array of document indices (in docIds)
+        :param scores:        an array of scores
+        """
+        assert len(queryOffsets) == len(queryIds) + 1
+        assert len(docIdx) == len(scores) == queryOffsets[-1]
+        self.queryIds = queryIds
+        self.docIds = docIds
+        self.queryOffsets = np.asarray(queryOffsets, dtype=np.int64)
+        self.docIdx = np.asarray(docIdx, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float32)
+        self.queryIdMap = {qid: i for i, qid in enumerate(queryIds)}
+        self.docRanks_ = None
+
+    def __getitem__(self, queryId):
+        docIdx, scores = self.getQueryEntries(queryId)
+        docIds = self.docIds
+        return dict(zip([docIds[i] for i in docIdx.tolist()], scores.tolist()))
+
+    def __iter__(self):
+        return iter(self.queryIds)
+
+    def __len__(self):
+        return len(self.queryIds)
+
+    def __contains__(self, queryId):
+        return queryId in self.queryIdMap
+
+    def entryQty(self):
+        """:return: the total number of run entries"""
+        return len(self.scores)
+
+    def getQueryEntries(self, queryId):
+        """Get query entries in the original (file) order.
+
+        :param queryId:  a query ID
+        :return: a tuple: an array of document indices (in docIds), an array of scores
+        """
+        i = self.queryIdMap[queryId]
+        start, end = self.queryOffsets[i], self.queryOffsets[i + 1]
+        return self.docIdx[start:end], self.scores[start:end]
+
+    def getSortedEntries(self, queryId, topK=None):
+        """Get query entries sorted in the same order as getSorteScoresFromScoreDict does,
+           i.e., by decreasing scores and (for equal scores) by decreasing document IDs.
+
+        :param queryId:  a query ID
+        :param topK:     an optional maximum number of entries to return
+        :return: a list of (document ID, score) tuples
+        """
+        docIdx, scores = self.getSortedArrays_(queryId, topK)
+        docIds = self.docIds
+        return list(zip([docIds[i] for i in docIdx.tolist()], scores.tolist()))
+
+    def getSortedArrays_(self, queryId, topK=None):
+        if self.docRanks_ is None:
+            # Ranks of document IDs in the lexicographic order (to break ties)
+            self.docRanks_ = np.empty(len(self.docIds), dtype=np.int32)
+            self.docRanks_[sorted(range(len(self.docIds)), key=self.docIds.__getitem__)] = \
+                np.arange(len(self.docIds), dtype=np.int32)
+
+        docIdx, scores = self.getQueryEntries(queryId)
+        order = np.lexsort((self.docRanks_[docIdx], scores))[::-1][0:topK]
+        return docIdx[order], scores[order]
+
+    def selectQueries(self, queryIds):
+        """Create a run that contains only the specified queries (in the specified order).
+           The new run shares the document ID list with this one.
+
+        :param queryIds:  a list of query IDs
+        :return: a new ColumnarRun object
+        """
+        queryIdx = np.array([self.queryIdMap[qid] for qid in queryIds], dtype=np.int64)
+        starts, ends = self.queryOffsets[queryIdx], self.queryOffsets[queryIdx + 1]
+        lens = ends - starts
+        entryIdx = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(int(lens.sum()))
+        return ColumnarRun(list(queryIds), self.docIds,
+                           np.concatenate([[0], np.cumsum(lens)]),
+                           self.docIdx[entryIdx], self.scores[entryIdx])
+
+    def toRunDict(self):
+        """:return: a run dictionary (of dictionaries) in the format of readRunDict"""
+        return {qid: self[qid] for qid in self.queryIds}
+
+    @staticmethod
+    def fromRunDict(runDict):
+        """Create a columnar run from a run dictionary (of dictionaries).
+
+        :param runDict:  a run dictionary
+        :return: a ColumnarRun object
+        """
+        queryIds = list(runDict.keys())
+        docIdMap = {}
+        docIdx = np.fromiter(chain.from_iterable((docIdMap.setdefault(did, len(docIdMap)) for did in runDict[qid])
+                                                 for qid in queryIds), dtype=np.int32)
+        scores = np.fromiter(chain.from_iterable(runDict[qid].values() for qid in queryIds),
+                             dtype=np.float32, count=len(docIdx))
+        lens = [len(runDict[qid]) for qid in queryIds]
+        return ColumnarRun(queryIds, list(docIdMap.keys()),
+                           np.concatenate([[0], np.cumsum(lens, dtype=np.int64)]), docIdx, scores)
+
+    @staticmethod
+    def readTrec(fileName, chunkLineQty=100000):
+        """Read a run in the 6-column TREC format. As in readRunDict, entries of the same
+           query do not have to be adjacent and duplicate entries are merged.
+
+        :param fileName:      a run file name (the file can be compressed)
+        :param chunkLineQty:  a number of lines processed at once
+        :return: a ColumnarRun object
+        """
+        queryIdMap, docIdMap = {}, {}
+        queryIdxList, docIdxList, scoreList = [], [], []
+        lineOffset = 0
+
+        with openTextFile(fileName) as f, tqdm(desc='loading run (by chunk)', unit='line', leave=False) as pbar:
+            while True:
+                lines = list(islice(f, chunkLineQty))
+                if not lines:
+                    break
+                fieldQty = np.fromiter(map(len, map(str.split, lines)), dtype=np.int32, count=len(lines))
+                badLines = np.where((fieldQty != 6) & (fieldQty != 0))[0]
+                if len(badLines):
+                    ln = lineOffset + int(badLines[0]) + 1
+                    raise Exception(f'Invalid line {ln} in run file {fileName} expected 6 white-space ' +
+                                    f'separated fields by got: {lines[badLines[0]].strip()}')
+                lineQty = int(np.count_nonzero(fieldQty))
+                # Splitting the whole chunk at once is much faster than collecting fields of each line
+                fld = ''.join(lines).split()
+
+                # Entries of the same query are typically adjacent, so we intern each group only once
+                groupQueryIdx, groupLens = [], []
+                for qid, grp in groupby(fld[0::6]):
+                    groupQueryIdx.append(queryIdMap.setdefault(qid, len(queryIdMap)))
+                    groupLens.append(sum(1 for _ in grp))
+                queryIdxList.append(np.repeat(np.array(groupQueryIdx, dtype=np.int32), groupLens))
+                docIdxList.append(np.fromiter((docIdMap.setdefault(did, len(docIdMap)) for did in fld[2::6]),
+                                              dtype=np.int32, count=lineQty))
+                scoreList.append(np.array(fld[4::6], dtype=np.float32))
+
+                lineOffset += len(lines)
+                pbar.update(len(lines))
+
+        queryIdx = np.concatenate(queryIdxList) if queryIdxList else np.zeros(0, dtype=np.int32)
+        docIdx = np.concatenate(docIdxList) if docIdxList else np.zeros(0, dtype=np.int32)
+        scores = np.concatenate(scoreList) if scoreList else np.zeros(0, dtype=np.float32)
+
+        # Query indices are assigned in the order of appearance, so in a run where
+        # the entries of each query are adjacent they are already sorted.
+        if np.any(queryIdx[1:] < queryIdx[:-1]):
+            order = np.argsort(queryIdx, kind='stable')
+            queryIdx, docIdx, scores = queryIdx[order], docIdx[order], scores[order]
+
+        # Merge duplicate entries in the same way as readRunDict does: an entry
+        # keeps the position of its first occurrence and the score of the last one.
+        keys = queryIdx.astype(np.int64) * len(docIdMap) + docIdx
+        order = np.argsort(keys, kind='stable')
+        sortedKeys = keys[order]
+        isFirst = np.concatenate([[True], sortedKeys[1:] != sortedKeys[:-1]])[0:len(keys)]
+        if not np.all(isFirst):
+            firstPos = np.where(isFirst)[0]
+            lastPos = np.concatenate([firstPos[1:], [len(keys)]]) - 1
+            scores[order[firstPos]] = scores[order[lastPos]]
+            keep = np.zeros(len(keys), dtype=bool)
+            keep[order[firstPos]] = True
+            queryIdx, docIdx, scores = queryIdx[keep], docIdx[keep], scores[keep]
+
+        queryOffsets = np.concatenate([[0], np.cumsum(np.bincount(queryIdx, minlength=len(queryIdMap)))])
+
+        return ColumnarRun(list(queryIdMap.keys()), list(docIdMap.keys()), queryOffsets, docIdx, scores)
+
+    def writeTrec(self, fileName, runId=FAKE_RUN_ID):
+        """Write the run in the 6-column TREC format. As in writeRunDict,
+           entries are sorted within each query.
+
+        :param fileName:  an output file name
+        :param runId:     a run ID
+        """
+        docIds = self.docIds
+        with openTextFile(fileName, 'wt') as runfile:
+            for qid in self.queryIds:
+                docIdx, scores = self.getSortedArrays_(qid)
+                # float32 numbers are printed using the shortest representation
+                runfile.write(''.join(genRunEntryStr(qid, docIds[did], i + 1, score, runId) + '\n'
+                                      for i, (did, score) in enumerate(zip(docIdx.tolist(), scores.astype(str)))))
+
+    def save(self, fileName):
+        """Save the run in the binary format (an uncompressed numpy .npz archive).
+
+        :param fileName:  an output file name
+        """
+        with open(fileName, 'wb') as f:
+            np.savez(f,
+                     version=np.array([BINARY_RUN_VERSION]),
+                     queryIds=encodeStrList_(self.queryIds),
+                     docIds=encodeStrList_(self.docIds),
+                     queryOffsets=self.queryOffsets,
+                     docIdx=self.docIdx,
+                     scores=self.scores)
+
+    @staticmethod
+    def load(fileName):
+        """Load a run saved in the binary format.
+
+        :param fileName:  an input file name
+        :return: a ColumnarRun object
+        """
+        with np.load(fileName, allow_pickle=False) as data:
+            version = int(data['version'][0])
+            if version != BINARY_RUN_VERSION:
+                raise Exception(f'Unsupported binary run version {version} in file {fileName}')
+            return ColumnarRun(decodeStrList_(data['queryIds']), decodeStrList_(data['docIds']),
+                               data['queryOffsets'], data['docIdx'], data['scores'])
+
+
+def isBinaryRunFile(fileName):
+    """:return: True if the run file is in the binary format (judging by its suffix)"""
+    return fileName.endswith(BINARY_RUN_SUFF)
+
+
+def readRun(fileName, columnar=False):
+    """Read a run in either the TREC text or the binary format (judging by the suffix).
+
+    :param fileName:   run file name
+    :param columnar:   True to return a ColumnarRun object rather than a dictionary of dictionaries
+    :return: a ColumnarRun object or a run dictionary
+    """
+    if isBinaryRunFile(fileName):
+        run = ColumnarRun.load(fileName)
+        return run if columnar else run.toRunDict()
+
+    return ColumnarRun.readTrec(fileName) if columnar else readRunDict(fileName)
+
+
+def writeRun(run, fileName):
+    """Write a run (a ColumnarRun object or a run dictionary) in either the TREC text
+       or the binary format (judging by the suffix).
+
+    :param run:       a ColumnarRun object or a run dictionary
+    :param fileName:  an output file name
+    """
+    if isBinaryRunFile(fileName):
+        if not isinstance(run, ColumnarRun):
+            run = ColumnarRun.fromRunDict(run)
+        run.save(fileName)
+    elif isinstance(run, ColumnarRun):
+        run.writeTrec(fileName)
+    else:
+        writeRunDict(run, fileName)
+
+
 def evalRun(rerankRun, runFileName, qrelFileName, metricFunc,
-            saveRun=False, debug=False, useQrelCache=False):
+            saveRun=False, debug=False, useQrelCache=False, useDiskCache=False):
     """Evaluate run stored in a file using QRELs stored in a file.
 
     :param rerankRun:     a run dictionary (of dictionaries)
@@ -230,6 +984,7 @@ def evalRun(rerankRun, runFileName, qrelFileName, metricFunc,
     :param qrelFileName:  a QREL file name
     :param metricFunc:    a metric function or class instance with overloaded __call__
     :param saveRun:       true if we want to save the run
+    :param useDiskCache:  True to use the persistent QREL cache (see readQrelsDict)
     :return:  the average metric value
     """
 
@@ -241,7 +996,7 @@ def evalRun(rerankRun, runFileName, qrelFileName, metricFunc,
     if useQrelCache and qrelFileName in qrelCache:
         qrels = qrelCache[qrelFileName]
     else:
-        qrels = qrelCache[qrelFileName] = readQrelsDict(qrelFileName)
+        qrels = qrelCache[qrelFileName] = readQrelsDict(qrelFileName, useDiskCache=useDiskCache)
 
     resArr = []
 
@@ -274,15 +1029,37 @@ def evalRun(rerankRun, runFileName, qrelFileName, metricFunc,
     return res
 
 
+def evalRunColumnar(rerankRun, qrelFileName, evalMetric, useQrelCache=False, useDiskCache=False):
+    """Evaluate a run using the columnar (vectorized) evaluator: the results are
+       the same as those of evalRun, but the computation is much faster.
+
+    :param rerankRun:     a run dictionary (of dictionaries)
+    :param qrelFileName:  a QREL file name
+    :param evalMetric:    a metric name (see ColumnarEvaluator.evalQueries)
+    :param useQrelCache:  True to cache QRELs (and the evaluator) between calls
+    :param useDiskCache:  True to use the persistent QREL cache (see readQrelsDict)
+    :return:  the average metric value
+    """
+    global qrelCache
+
+    if useQrelCache and qrelFileName in qrelCache:
+        qrels = qrelCache[qrelFileName]
+    else:
+        qrels = qrelCache[qrelFileName] = readQrelsDict(qrelFileName, useDiskCache=useDiskCache)
+
+    return ColumnarEvaluator(qrels).evalRun(rerankRun, evalMetric)
+
+
 def getEvalResults(useExternalEval, evalMetric,
                    rerankRun, runFile, qrelFile,
-                   useQrelCache=False):
+                   useQrelCache=False, useDiskCache=False):
     """Carry out internal or external evaluation.
 
     :param useExternalEval:   True to use external evaluation tools.
     :param evalMetric:        Evaluation metric (from the METRIC_LIST above)
     :param runFile:           A run file to store results for external eval tool.
     :param qrelFile:          A QREL file.
+    :param useDiskCache:      True to use the persistent QREL cache (internal evaluation only).
     :return:  average metric value.
     """
 
@@ -297,15 +1074,11 @@ def getEvalResults(useExternalEval, evalMetric,
 
         return trec_eval(runFile, qrelFile, m)
     else:
-        f = None
-        if evalMetric == METRIC_MAP:
-            f = MeanAveragePrecision()
-        elif evalMetric == METRIC_NDCG20:
-            f = NormalizedDiscountedCumulativeGain(NDCG_TOP_K)
-        else:
+        if evalMetric not in METRIC_LIST:
             raise Exception('Unsupported metric: ' + evalMetric)
 
-        return evalRun(rerankRun, runFile, qrelFile, f, useQrelCache=useQrelCache)
+        return evalRunColumnar(rerankRun, qrelFile, evalMetric,
+                               useQrelCache=useQrelCache, useDiskCache=useDiskCache)
 
 
 def trec_eval(runf, qrelf, metric):
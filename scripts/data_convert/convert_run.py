@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# Converting runs between the TREC text format and the binary (columnar) format.
+# The direction of the conversion is determined by file suffixes.
+import sys
+import argparse
+
+sys.path.append('.')
+
+from scripts.common_eval import readRun, writeRun, BINARY_RUN_SUFF
+
+parser = argparse.ArgumentParser(description='Convert a run between the TREC text and the binary formats.')
+parser.add_argument('--input', metavar='input run', help=f'input run (binary runs have the suffix {BINARY_RUN_SUFF})',
+                    type=str, required=True)
+parser.add_argument('--output', metavar='output run', help=f'output run (binary runs have the suffix {BINARY_RUN_SUFF})',
+                    type=str, required=True)
+
+args = parser.parse_args()
+print(args)
+
+run = readRun(args.input, columnar=True)
+writeRun(run, args.output)
+
+print(f'Converted a run with {len(run)} queries and {run.entryQty()} entries')
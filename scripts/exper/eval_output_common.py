@@ -0,0 +1,383 @@
+#
+# Common evaluation & reporting routines for eval_output.py and eval_output_parallel.py.
+#
+# Metrics can be computed either by external tools (trec_eval and gdeval.pl) or in-process.
+# The in-process evaluator produces (a subset of) the same output lines as these tools,
+# using the same document ordering, tie-breaking, and rounding. Hence, both types of outputs
+# are processed by the same code and produce identical reports.
+#
+import sys
+import math
+import subprocess as sp
+
+import numpy as np
+
+from scripts.common_eval import readRunDict
+
+NUM_REL = 'num_rel'
+NUM_REL_RET = 'num_rel_ret'
+NUM_RET = 'num_ret'
+NUM_Q = 'num_q'
+RUN_ID = 'runid'
+
+ERR20       = 'err20'
+P20         = 'P_20'
+
+MAP         = 'map'
+RECIP_RANK  = 'recip_rank'
+RECALL      = 'recall'
+
+GDEVAL_NDCG20           = 'ndcg20'
+GDEVAL_NDCG20_REPORT    = 'GDEVAL NDCG@20'
+
+METRIC_DICT = {
+    MAP             : 'MAP',
+    RECIP_RANK      : 'MRR',
+    ERR20           : 'ERR@20',
+    P20             : 'P20',
+    RECALL          : 'Recall',
+    GDEVAL_NDCG20   :  GDEVAL_NDCG20_REPORT
+}
+
+FINAL_METR_ORDERED_LIST=[]
+
+NDCG_CUTOFFS = [10, 20, 100]
+
+for k in NDCG_CUTOFFS:
+    nkey = f'ndcg_cut_{k}'
+    METRIC_DICT[nkey] = f'NDCG@{k}'
+    FINAL_METR_ORDERED_LIST.append(nkey)
+
+FINAL_METR_ORDERED_LIST.extend([ERR20, P20, MAP, RECIP_RANK, RECALL, GDEVAL_NDCG20])
+
+# Recall is computed from NUM_REL and NUM_REL_RET
+TREC_EVAL_METR = [k for k in METRIC_DICT.keys() if k not in[RECALL]]
+NUM_REL_TREC_EVAL_METRICS = [NUM_REL, NUM_REL_RET]
+TREC_EVAL_METR.extend(NUM_REL_TREC_EVAL_METRICS)
+
+TREC_EVAL_BIN = 'trec_eval/trec_eval'
+GDEVAL_SCRIPT = 'scripts/exper/gdeval.pl'
+
+# trec_eval defaults: documents with grades >= this level are relevant
+TREC_EVAL_RELEVANCE_LEVEL = 1
+TREC_EVAL_P_CUTOFF = 20
+# gdeval.pl constants
+GDEVAL_K = 20
+GDEVAL_MAX_JUDGMENT = 4
+
+
+def parseTrecEvalResults(lines, metrics):
+    metrics = set(metrics)
+    res = dict()
+    for s in lines:
+        if s == '': continue
+        arr = s.split()
+        if (len(arr) != 3):
+            raise Exception("wrong-format line: '%s'" % s)
+        (metr, qid, val) = arr
+        if not qid in res: res[qid] = dict()
+        entry = res[qid]
+        if metr in metrics:
+            entry[metr] = float(val)
+    return res
+
+
+def parseGdevalResults(lines):
+    res = dict()
+    first = True
+    for s in lines:
+        if s == '': continue
+        if first:
+            first = False
+            continue
+        arr = s.split(',')
+        if (len(arr) != 4):
+            raise Exception("wrong-format line: '%s'" % s)
+        (runid, qid, val1, val2) = arr
+        res[qid] = {GDEVAL_NDCG20: float(val1), ERR20: float(val2)}
+    return res
+
+
+def runExternalEval(qrelFile, trecOut):
+    """Evaluate a run using trec_eval and gdeval.pl.
+
+    :param qrelFile:  a QREL file
+    :param trecOut:   a run file
+    :return: a tuple: trec_eval output lines, gdeval output lines
+    """
+    outputTrecEval = sp.check_output([TREC_EVAL_BIN,
+                                      "-m", "ndcg_cut",
+                                      "-m", "official",
+                                      "-q", qrelFile, trecOut]).decode('utf-8').replace('\t', ' ').split('\n')
+
+    outputGdeval = sp.check_output([GDEVAL_SCRIPT, qrelFile, trecOut]).decode('utf-8').split('\n')
+
+    return outputTrecEval, outputGdeval
+
+
+def getRunId(trecOut):
+    """:return: the run ID from the last non-empty line of the run (this is what gdeval.pl reports)"""
+    runId = '?????'
+    with open(trecOut) as f:
+        for line in f:
+            fld = line.split()
+            if len(fld) == 6:
+                runId = fld[5]
+    return runId
+
+
+def genTrecEvalLine(metric, qid, val):
+    # Integer values (counts) are printed without decimals
+    if isinstance(val, int):
+        return '%-22s %s %d' % (metric, qid, val)
+    if isinstance(val, str):
+        return '%-22s %s %s' % (metric, qid, val)
+    return '%-22s %s %6.4f' % (metric, qid, val)
+
+
+def evalQueryTrecEval(scoreDict, qrelDict):
+    """Compute trec_eval metrics for one query. As in trec_eval:
+       scores are converted to single-precision numbers, ties are broken
+       by decreasing document IDs, and NDCG uses linear gains.
+
+    :param scoreDict:  a dictionary of document scores
+    :param qrelDict:   a dictionary of query relevance grades
+    :return: a dictionary of metric values
+    """
+    docIds = list(scoreDict.keys())
+    scores = np.array(list(scoreDict.values()), dtype=np.float32).tolist()
+    rels = [qrelDict.get(did, -1) for _, did in sorted(zip(scores, docIds), reverse=True)]
+
+    numRel = sum(1 for grade in qrelDict.values() if grade >= TREC_EVAL_RELEVANCE_LEVEL)
+
+    relSoFar = 0
+    sumPrec = 0.0
+    recipRank = 0.0
+    precAtCutoff = 0
+    for i, rel in enumerate(rels):
+        if rel >= TREC_EVAL_RELEVANCE_LEVEL:
+            relSoFar += 1
+            sumPrec += float(relSoFar) / float(i + 1)
+            if relSoFar == 1:
+                recipRank = 1.0 / float(i + 1)
+            if i < TREC_EVAL_P_CUTOFF:
+                precAtCutoff += 1
+
+    res = {NUM_RET: len(rels), NUM_REL: numRel, NUM_REL_RET: relSoFar,
+           MAP: sumPrec / float(numRel) if relSoFar else 0.0,
+           RECIP_RANK: recipRank,
+           P20: float(precAtCutoff) / float(TREC_EVAL_P_CUTOFF)}
+
+    maxCutoff = max(NDCG_CUTOFFS)
+    # Prefix sums are computed sequentially, exactly as trec_eval does it
+    dcg = [0.0]
+    for i, rel in enumerate(rels[0:maxCutoff]):
+        dcg.append(dcg[-1] + rel / math.log2(i + 2) if rel > 0 else dcg[-1])
+    idealDcg = [0.0]
+    for i, grade in enumerate(sorted([grade for grade in qrelDict.values() if grade > 0], reverse=True)[0:maxCutoff]):
+        idealDcg.append(idealDcg[-1] + grade / math.log2(i + 2))
+
+    for k in NDCG_CUTOFFS:
+        val, idealVal = dcg[min(k, len(dcg) - 1)], idealDcg[min(k, len(idealDcg) - 1)]
+        res[f'ndcg_cut_{k}'] = val / idealVal if idealVal > 0 else val
+
+    return res
+
+
+TREC_EVAL_QUERY_METR_ORDERED_LIST = [NUM_RET, NUM_REL, NUM_REL_RET, MAP, RECIP_RANK, P20] + \
+                                    [f'ndcg_cut_{k}' for k in NDCG_CUTOFFS]
+# These are summed rather than averaged over queries
+TREC_EVAL_SUM_METR = [NUM_RET, NUM_REL, NUM_REL_RET]
+
+
+def runTrecEvalInternal(run, qrels, runId):
+    """Compute a subset of "trec_eval -m ndcg_cut -m official -q" metrics in-process.
+
+    :param run:     a run dictionary (of dictionaries)
+    :param qrels:   a QREL dictionary (of dictionaries)
+    :param runId:   a run ID
+    :return: output lines in the trec_eval format
+    """
+    # trec_eval evaluates (and averages over) queries that are present in both files
+    # in the order of (byte-wise) sorted query IDs
+    queryIds = sorted([qid for qid in run if qid in qrels])
+    if not queryIds:
+        raise Exception('No queries with both results and relevance info')
+
+    lines = []
+    totals = {metric: 0 if metric in TREC_EVAL_SUM_METR else 0.0 for metric in TREC_EVAL_QUERY_METR_ORDERED_LIST}
+    for qid in queryIds:
+        queryRes = evalQueryTrecEval(run[qid], qrels[qid])
+        for metric in TREC_EVAL_QUERY_METR_ORDERED_LIST:
+            lines.append(genTrecEvalLine(metric, qid, queryRes[metric]))
+            totals[metric] += queryRes[metric]
+
+    lines.append(genTrecEvalLine(RUN_ID, 'all', runId))
+    lines.append(genTrecEvalLine(NUM_Q, 'all', len(queryIds)))
+    for metric in TREC_EVAL_QUERY_METR_ORDERED_LIST:
+        val = totals[metric]
+        lines.append(genTrecEvalLine(metric, 'all', val if metric in TREC_EVAL_SUM_METR else val / len(queryIds)))
+
+    return lines
+
+
+def gdevalDCG(gains):
+    res = 0.0
+    for i, gain in enumerate(gains[0:GDEVAL_K]):
+        res += (2. ** gain - 1) / math.log(i + 2)
+    return res
+
+
+def gdevalERR(gains):
+    res = 0.0
+    decay = 1.0
+    for i, gain in enumerate(gains[0:GDEVAL_K]):
+        r = (2. ** gain - 1) / (2. ** GDEVAL_MAX_JUDGMENT)
+        res += r * decay / (i + 1)
+        decay *= (1 - r)
+    return res
+
+
+def runGdevalInternal(run, qrels, runId):
+    """Compute gdeval.pl metrics (NDCG@20 and ERR@20) in-process. As in gdeval.pl,
+       documents are ordered by decreasing (double-precision) scores and then by decreasing
+       document IDs, gains are exponential, and only queries with positive judgments are evaluated.
+
+    :param run:     a run dictionary (of dictionaries)
+    :param qrels:   a QREL dictionary (of dictionaries)
+    :param runId:   a run ID
+    :return: output lines in the gdeval.pl format
+    """
+    for qid, qrelDict in qrels.items():
+        if qrelDict and max(qrelDict.values()) > GDEVAL_MAX_JUDGMENT:
+            raise Exception(f'QREL format error: a judgment for query {qid} exceeds {GDEVAL_MAX_JUDGMENT}')
+
+    lines = [f'runid,topic,ndcg@{GDEVAL_K},err@{GDEVAL_K}']
+    ndcgTotal, errTotal, topicQty = 0.0, 0.0, 0
+
+    for qid in sorted(run.keys()):
+        judgments = {did: grade for did, grade in qrels.get(qid, {}).items() if grade > 0}
+        if not judgments:
+            continue
+
+        scoreDict = run[qid]
+        gains = [judgments.get(did, 0) for _, did in sorted(zip(scoreDict.values(), scoreDict.keys()), reverse=True)]
+
+        ndcg = gdevalDCG(gains) / gdevalDCG(sorted(judgments.values(), reverse=True))
+        err = gdevalERR(gains)
+        ndcgTotal += ndcg
+        errTotal += err
+        topicQty += 1
+        lines.append('%s,%s,%.5f,%.5f' % (runId, qid, ndcg, err))
+
+    if topicQty > 0:
+        lines.append('%s,amean,%.5f,%.5f' % (runId, ndcgTotal / topicQty, errTotal / topicQty))
+    else:
+        lines.append('%s,amean,0.00000,0.0000' % runId)
+
+    return lines
+
+
+def runInternalEval(qrels, trecOut):
+    """Evaluate a run in-process: the output is the same as that of trec_eval and gdeval.pl
+       for all the metrics in FINAL_METR_ORDERED_LIST (and supporting counts).
+
+    :param qrels:     a QREL dictionary (of dictionaries)
+    :param trecOut:   a run file
+    :return: a tuple: trec_eval output lines, gdeval output lines
+    """
+    run = readRunDict(trecOut)
+    runId = getRunId(trecOut)
+
+    # Outputs of both tools end with a newline, so their split outputs end with an empty line
+    return runTrecEvalInternal(run, qrels, runId) + [''], runGdevalInternal(run, qrels, runId) + ['']
+
+
+def processEvalOutput(outputTrecEval, outputGdeval, outPrefix='', label='', saveTrecEval=True):
+    """Compute final metric values from trec_eval and gdeval outputs, print the report
+       and (optionally) save the report files.
+
+    :param outputTrecEval:  trec_eval output lines
+    :param outputGdeval:    gdeval output lines
+    :param outPrefix:       a prefix of report files (or an empty string not to save them)
+    :param label:           a label of the TSV report entry
+    :param saveTrecEval:    False not to save the trec_eval output (e.g., if it is
+                            produced by the in-process evaluator and is, thus, incomplete)
+    """
+    resTrecEvalAll = parseTrecEvalResults(outputTrecEval, TREC_EVAL_METR)
+    resTrecEval=resTrecEvalAll['all']
+
+    #print('trec_eval results parsed:', resTrecEval)
+
+    # Some manipulations are required for these metrics
+    res = {RECALL : float(resTrecEval[NUM_REL_RET]) / resTrecEval[NUM_REL]}
+
+    # Just "pass-through" metric with results coming directly from trec_eval
+    for k in FINAL_METR_ORDERED_LIST:
+        if k in resTrecEval:
+            res[k] = resTrecEval[k]
+
+    resGdevalAll = parseGdevalResults(outputGdeval)
+    resGdeval=resGdevalAll['amean']
+
+    #print('gdeval results parsed:', resGdeval)
+
+    res[ERR20] = resGdeval[ERR20]
+    res[GDEVAL_NDCG20] = resGdeval[GDEVAL_NDCG20]
+
+    queryQty = 0
+
+    # Previously it was used to compute percentiles,
+    # currently it just prints a warning and computes the number of queries
+    for qid, entry in resTrecEvalAll.items():
+        if qid == 'all': continue
+        queryQty += 1
+
+        numRel = entry[NUM_REL]
+
+        if numRel <= 0:
+            print("Warning: No relevant documents for qid=%s numRel=%d" % (qid, numRel))
+
+
+    if len(resTrecEvalAll) != len(resGdevalAll):
+        print("Warning: The number of query entries returned by trec_eval and gdeval are different!")
+
+    reportText = f"# of queries:    {queryQty}\n"
+
+    maxl = 0
+    for k in FINAL_METR_ORDERED_LIST:
+        maxl = max(len(METRIC_DICT[k]), maxl)
+
+    for k in FINAL_METR_ORDERED_LIST:
+        name = METRIC_DICT[k] + ': ' + ''.join([' '] * (maxl - len(METRIC_DICT[k])))
+        reportText += (name + '%f') % res[k] + '\n'
+
+    sys.stdout.write(reportText)
+    if outPrefix != '':
+        fRep = open(outPrefix + '.rep', 'w')
+        fRep.write(reportText)
+        fRep.close()
+        fTSV = open(outPrefix + '.tsv', 'a')
+
+        header = ["Label", "queryQty"]
+        data = [label, str(queryQty)]
+
+        for k in FINAL_METR_ORDERED_LIST:
+            header.append(METRIC_DICT[k])
+            data.append('%f' % res[k])
+
+        fTSV.write('\t'.join(header) + '\n')
+        fTSV.write('\t'.join(data) + '\n')
+
+        fTSV.close()
+
+        if saveTrecEval:
+            fTrecEval = open(outPrefix + '.trec_eval', 'w')
+            for line in outputTrecEval:
+                fTrecEval.write(line.rstrip() + '\n')
+            fTrecEval.close()
+
+        fGdeval = open(outPrefix + '.gdeval', 'w')
+        for line in outputGdeval:
+            fGdeval.write(line.rstrip() + '\n')
+        fGdeval.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# An in-process replacement of eval_output.py, which evaluates multiple runs
+# against the same QREL file in parallel (QRELs are read only once) without
+# calling trec_eval and gdeval.pl. It produces the same report files.
+import sys
+import argparse
+import multiprocessing
+
+sys.path.append('.')
+
+from scripts.common_eval import readQrelsDict
+from scripts.exper.eval_output_common import runInternalEval, runExternalEval, processEvalOutput
+
+SEP_LINE = '-' * 80
+
+parser = argparse.ArgumentParser(description='Evaluate multiple runs in parallel and generate reports.')
+parser.add_argument('--qrels', metavar='QREL file', help='QREL file',
+                    type=str, required=True)
+parser.add_argument('--runs', metavar='run files', help='TREC-format run files',
+                    type=str, nargs='+', required=True)
+parser.add_argument('--report_prefs', metavar='report prefixes',
+                    help='optional prefixes of report files (one per run)',
+                    type=str, nargs='*', default=[])
+parser.add_argument('--labels', metavar='labels',
+                    help='report labels (one per run, mandatory if report prefixes are specified)',
+                    type=str, nargs='*', default=[])
+parser.add_argument('--proc_qty', metavar='# of processes', help='# of evaluation processes',
+                    type=int, default=multiprocessing.cpu_count())
+parser.add_argument('--use_external_eval', action='store_true',
+                    help='use trec_eval and gdeval.pl (in parallel) instead of the in-process evaluator: ' +
+                         'the latter computes only the measures used in reports and, hence, ' +
+                         'does not write .trec_eval files')
+
+args = parser.parse_args()
+
+runQty = len(args.runs)
+if args.report_prefs and len(args.report_prefs) != runQty:
+    print('The number of report prefixes should be equal to the number of runs!')
+    sys.exit(1)
+if len(args.labels) != len(args.report_prefs):
+    print('Specify one label per report prefix!')
+    sys.exit(1)
+
+# QRELs are read once and passed to each worker when it starts
+qrels = None
+
+
+def initWorker(workerQrels):
+    global qrels
+    qrels = workerQrels
+
+
+class RunEvalWorker:
+    def __init__(self, qrelFile, useExternalEval):
+        self.qrelFile = qrelFile
+        self.useExternalEval = useExternalEval
+
+    def __call__(self, trecOut):
+        if self.useExternalEval:
+            return runExternalEval(self.qrelFile, trecOut)
+        return runInternalEval(qrels, trecOut)
+
+
+procQty = max(1, min(args.proc_qty, runQty))
+print(f'Evaluating {runQty} runs using {procQty} processes')
+
+with multiprocessing.Pool(processes=procQty,
+                          initializer=initWorker,
+                          initargs=(None if args.use_external_eval else readQrelsDict(args.qrels, useDiskCache=True),)) as pool:
+    # Reports are generated in the main process in the order of runs
+    for i, (outputTrecEval, outputGdeval) in enumerate(pool.imap(RunEvalWorker(args.qrels, args.use_external_eval),
+                                                                 args.runs)):
+        print(SEP_LINE)
+        print(f'Run: {args.runs[i]}')
+        print(SEP_LINE)
+        outPrefix, label = (args.report_prefs[i], args.labels[i]) if args.report_prefs else ('', '')
+        processEvalOutput(outputTrecEval, outputGdeval, outPrefix, label,
+                          saveTrecEval=args.use_external_eval)
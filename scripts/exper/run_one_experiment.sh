@@ -490,17 +490,22 @@ qrels="$inputDataDir/$testPart/$QREL_FILE"
 rm -f "${reportDir}/out_*"
 
 if [ "$skipEval" != "1" ] ; then
+  evalRuns=()
+  evalReportPrefs=()
+  evalLabels=()
   for oneN in $testCandQtyListSpaceSep ; do
-    echo "$SEP_DEBUG_LINE"
-    echo "N=$oneN"
-    echo "$SEP_DEBUG_LINE"
-    reportPref="${reportDir}/out_${oneN}"
-
-    scripts/exper/eval_output.py "$qrels"  "${trecRunDir}/run_${oneN}" "$reportPref" "$oneN"
+    evalRuns+=("${trecRunDir}/run_${oneN}")
+    evalReportPrefs+=("${reportDir}/out_${oneN}")
+    evalLabels+=("$oneN")
   done
 
-  echo "Bzipping trec_eval output in the directory: ${reportDir}"
-  bzip2 ${reportDir}/*.trec_eval
+  # All runs are evaluated in parallel by the in-process evaluator, which computes
+  # only the measures used in reports: hence, no .trec_eval files are produced.
+  scripts/exper/eval_output_parallel.py --qrels "$qrels" \
+                                        --runs "${evalRuns[@]}" \
+                                        --report_prefs "${evalReportPrefs[@]}" \
+                                        --labels "${evalLabels[@]}"
+
   echo "Bzipping gdeval output in the directory: ${reportDir}"
   bzip2 ${reportDir}/*.gdeval
 fi
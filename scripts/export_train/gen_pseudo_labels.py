@@ -7,28 +7,49 @@ import sys
 
 sys.path.append('.')
 
-from scripts.common_eval import readRunDict, writeQrels, QrelEntry, getSorteScoresFromScoreDict
+from scripts.common_eval import readRun, iterRunByQuery, writeQrels, QrelEntry, \
+                                getTopScoresFromScoreDict, BINARY_RUN_SUFF
 
 parser = argparse.ArgumentParser('Exporting a neural Model1 model to a GIZA format (to run on CPU)')
 
 parser.add_argument('--input_run', metavar='input run file',
-                    required=True, type=str, help='input run file')
+                    required=True, type=str,
+                    help=f'input run file: a (possibly compressed) TREC run or a binary run (with the suffix {BINARY_RUN_SUFF})')
 parser.add_argument('--out_qrels', metavar='output QREL file',
                     required=True, type=str, help='output QREL file')
 parser.add_argument('--top_k', metavar='top k',
                     required=True, type=int, help='top k entries to use as psedo relevant labels')
 parser.add_argument('--grade', metavar='grade',
                     default=1, type=int, help='a grade for the relevance item')
+parser.add_argument('--columnar_run', action='store_true',
+                    help='read the run in the compact columnar format (saves memory for large runs)')
+parser.add_argument('--stream_run', action='store_true',
+                    help='read a TREC run one query at a time (constant memory, but entries of each query must be adjacent)')
 
 args = parser.parse_args()
 
-inp_run = readRunDict(args.input_run)
+if args.stream_run and args.columnar_run:
+    print('Options --stream_run and --columnar_run are mutually exclusive!')
+    sys.exit(1)
 
-qrels = []
 
-for qid, run_dict in inp_run.items():
-    for did, score in getSorteScoresFromScoreDict(run_dict)[0: args.top_k]:
-        qrels.append(QrelEntry(queryId=qid, docId=did, relGrade=args.grade))
+def gen_top_entries():
+    if args.stream_run:
+        for qid, query_run in iterRunByQuery(args.input_run):
+            yield qid, getTopScoresFromScoreDict(query_run, args.top_k)
+    else:
+        inp_run = readRun(args.input_run, columnar=args.columnar_run)
+        for qid in inp_run:
+            if args.columnar_run:
+                yield qid, inp_run.getSortedEntries(qid, args.top_k)
+            else:
+                yield qid, getTopScoresFromScoreDict(inp_run[qid], args.top_k)
 
 
-writeQrels(qrels, args.out_qrels)
+def gen_qrels():
+    for qid, top_entries in gen_top_entries():
+        for did, score in top_entries:
+            yield QrelEntry(queryId=qid, docId=did, relGrade=args.grade)
+
+
+writeQrels(gen_qrels(), args.out_qrels)
@@ -0,0 +1,90 @@
+import numpy as np
+
+# Thrift files are generated from
+# ./src/main/java/edu/cmu/lti/oaqa/flexneuart/embed/external/protocol.thrift
+#
+
+from scripts.py_embed_server.python_generated.protocol.ExternalEmbedder import Processor
+from scripts.py_embed_server.python_generated.protocol.ttypes import EmbeddingException
+
+from scripts.py_featextr_server.base_server import getTransportFactory, getProtocolFactory, \
+    TRANSPORT_BUFFERED, TRANSPORT_FRAMED, PROTOCOL_BINARY, DEFAULT_NON_BLOCKING_THREAD_QTY
+
+from thrift.transport import TSocket
+from thrift.server import TServer
+from thrift.server.TNonblockingServer import TNonblockingServer
+
+from threading import Lock
+
+SAMPLE_EMBED_HOST = '127.0.0.1'
+SAMPLE_EMBED_PORT = 8081
+
+
+class BaseEmbedHandler:
+    def __init__(self, exclusive=True):
+        self.lock_ = Lock() if exclusive else None
+        if self.lock_ is not None:
+            print('Locking the base server for single-threaded processing')
+        else:
+            print('NOT locking the base server for multi-threaded processing')
+
+    def embedDocuments(self, docs):
+        try:
+            if self.lock_ is not None:
+                with self.lock_:
+                    embeds = self.computeDocEmbedsOverride(docs)
+            else:
+                embeds = self.computeDocEmbedsOverride(docs)
+            # Embeddings are computed in float32, but Thrift supports only doubles
+            return np.asarray(embeds, dtype=np.float32).tolist()
+        except Exception as e:
+            raise EmbeddingException(str(e))
+
+    def embedQuery(self, query):
+        try:
+            if self.lock_ is not None:
+                with self.lock_:
+                    embed = self.computeQueryEmbedOverride(query)
+            else:
+                embed = self.computeQueryEmbedOverride(query)
+            return np.asarray(embed, dtype=np.float32).tolist()
+        except Exception as e:
+            raise EmbeddingException(str(e))
+
+    # Both functions need to be implemented in a child class
+
+    # This function receives a list of raw-text documents and returns a float32
+    # matrix (or a list of vectors) with one row per document
+    def computeDocEmbedsOverride(self, docs):
+        raise EmbeddingException('Document embedding is not supported by this server!')
+
+    # This function receives a raw-text query and returns a float32 vector
+    def computeQueryEmbedOverride(self, query):
+        raise EmbeddingException('Query embedding is not supported by this server!')
+
+
+# This function starts the server and takes over the program control
+def startEmbedServer(host, port, multiThreaded, embedHandler,
+                     transport=TRANSPORT_BUFFERED, protocol=PROTOCOL_BINARY,
+                     nonBlocking=False, nonBlockingThreadQty=DEFAULT_NON_BLOCKING_THREAD_QTY):
+    processor = Processor(embedHandler)
+
+    serverSocket = TSocket.TServerSocket(host=host, port=port)
+    tfactory = getTransportFactory(transport)
+    pfactory = getProtocolFactory(protocol)
+    print(f'Transport: {transport} protocol: {protocol}')
+
+    if nonBlocking:
+        if transport != TRANSPORT_FRAMED:
+            raise Exception('The non-blocking server requires the framed transport')
+        print(f'Starting a non-blocking server with {nonBlockingThreadQty} processing threads...')
+        server = TNonblockingServer(processor, serverSocket, pfactory, pfactory, threads=nonBlockingThreadQty)
+    elif multiThreaded:
+        print('Starting a multi-threaded server...')
+        server = TServer.TThreadedServer(processor, serverSocket, tfactory, pfactory)
+    else:
+        print('Starting a single-threaded server...')
+        server = TServer.TSimpleServer(processor, serverSocket, tfactory, pfactory)
+
+    server.serve()
+    print('done.')
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# A bulk embedding mode: encode a complete JSONL collection (can be compressed)
+# and store embeddings in a memory-mapped float32 matrix (a .npy file) accompanied
+# by the list of document IDs (one ID per line, in the order of matrix rows).
+# The matrix can be opened via numpy.load(<file>, mmap_mode='r') and passed
+# directly to, e.g., NMSLIB addDataPointBatch for indexing.
+import sys
+import argparse
+import numpy as np
+
+from tqdm import tqdm
+
+sys.path.append('.')
+
+from scripts.py_embed_server.encoders import addEncoderArgs, createEncoderFromArgs
+from scripts.data_convert.convert_common import jsonlGen
+from scripts.config import DOCID_FIELD, TEXT_FIELD_NAME
+
+EMBED_MATRIX_SUFF = '.npy'
+EMBED_IDS_SUFF = '.ids'
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def iterChunks(fileName, fieldName, chunkSize):
+    docIds, texts = [], []
+    for e in jsonlGen(fileName):
+        docIds.append(e[DOCID_FIELD])
+        texts.append(e.get(fieldName, ''))
+        if len(docIds) == chunkSize:
+            yield docIds, texts
+            docIds, texts = [], []
+    if docIds:
+        yield docIds, texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Embedding a JSONL collection into a memory-mapped matrix.')
+
+    addEncoderArgs(parser)
+
+    parser.add_argument('--input', metavar='input JSONL file', help='input JSONL file (can be compressed)',
+                        type=str, required=True)
+    parser.add_argument('--field_name', metavar='field name', help='a name of the field to embed',
+                        type=str, default=TEXT_FIELD_NAME)
+    parser.add_argument('--out_pref', metavar='output prefix',
+                        help=f'an output prefix: suffixes {EMBED_MATRIX_SUFF} and {EMBED_IDS_SUFF} are added automatically',
+                        type=str, required=True)
+    parser.add_argument('--chunk_size', metavar='chunk size', help='# of documents read & embedded at once',
+                        type=int, default=DEFAULT_CHUNK_SIZE)
+
+    args = parser.parse_args()
+    print(args)
+
+    encoder = createEncoderFromArgs(args)
+
+    # The first pass only counts documents to create a matrix of a proper size
+    docQty = sum(1 for _ in tqdm(jsonlGen(args.input), desc='counting documents'))
+    print('# of documents:', docQty, 'embedding dimensionality:', encoder.dim)
+
+    embeds = np.lib.format.open_memmap(args.out_pref + EMBED_MATRIX_SUFF, mode='w+',
+                                       dtype=np.float32, shape=(docQty, encoder.dim))
+    start = 0
+    with open(args.out_pref + EMBED_IDS_SUFF, 'w') as outIds, tqdm(total=docQty, desc='embedding documents') as pbar:
+        for docIds, texts in iterChunks(args.input, args.field_name, args.chunk_size):
+            embeds[start:start + len(docIds)] = encoder.embed(texts, args.batch_size)
+            start += len(docIds)
+            for did in docIds:
+                outIds.write(did + '\n')
+            pbar.update(len(docIds))
+
+    assert start == docQty, f'The number of documents changed: expected {docQty}, but got {start}'
+    embeds.flush()
+    del embeds
+
+
+if __name__ == '__main__':
+    main()
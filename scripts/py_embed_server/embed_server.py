@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# An embedding server (ExternalEmbedder) for dense candidate generation:
+# it encodes queries and documents using either averaged word embeddings
+# or BERT (with the [CLS] or mean pooling).
+import sys
+import argparse
+
+sys.path.append('.')
+
+from scripts.py_embed_server.base_server import BaseEmbedHandler, startEmbedServer
+from scripts.py_embed_server.encoders import addEncoderArgs, createEncoderFromArgs, DEFAULT_BATCH_SIZE
+from scripts.py_featextr_server.base_server import addServerTransportArgs
+
+
+class EncoderEmbedHandler(BaseEmbedHandler):
+    # Exclusive==True means that only one embed* function is executed at at time
+    def __init__(self, encoder, exclusive, batchSize=DEFAULT_BATCH_SIZE, debugPrint=False):
+        super().__init__(exclusive)
+
+        self.encoder = encoder
+        self.batchSize = batchSize
+        self.debugPrint = debugPrint
+        print('Embedding dimensionality:', encoder.dim)
+
+    def computeDocEmbedsOverride(self, docs):
+        if self.debugPrint:
+            print('Embedding # of documents:', len(docs))
+        return self.encoder.embed(docs, self.batchSize)
+
+    def computeQueryEmbedOverride(self, query):
+        if self.debugPrint:
+            print('Embedding query:', query)
+        return self.encoder.embed([query], self.batchSize)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serving embedding models.')
+
+    addEncoderArgs(parser)
+
+    parser.add_argument('--debug_print', action='store_true',
+                        help='Provide debug output')
+
+    parser.add_argument('--port', metavar='server port',
+                        required=True, type=int,
+                        help='Server port')
+
+    parser.add_argument('--host', metavar='server host',
+                        default='127.0.0.1', type=str,
+                        help='server host addr to bind the port')
+
+    addServerTransportArgs(parser)
+
+    args = parser.parse_args()
+
+    encoder = createEncoderFromArgs(args)
+
+    # Similarly to the CEDR server, neural models are executed by one thread at a time
+    multiThreaded = False
+    startEmbedServer(args.host, args.port, multiThreaded,
+                     EncoderEmbedHandler(encoder=encoder,
+                                         exclusive=True,
+                                         batchSize=args.batch_size,
+                                         debugPrint=args.debug_print),
+                     transport=args.transport, protocol=args.protocol,
+                     nonBlocking=args.non_blocking, nonBlockingThreadQty=args.non_blocking_thread_qty)
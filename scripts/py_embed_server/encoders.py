@@ -0,0 +1,155 @@
+#
+# Text encoders producing dense (float32) query and document embeddings.
+#
+import torch
+import numpy as np
+import pytorch_pretrained_bert
+
+from scripts.py_featextr_server.utils import loadEmbeddings, createEmbedMap
+from scripts.cedr.data import PAD_CODE
+from scripts.cedr.modeling_util import CustomBertModel
+from scripts.config import BERT_BASE_MODEL, DEVICE_CPU
+
+ENCODER_WORD_EMBED_AVG = 'word_embed_avg'
+ENCODER_BERT_CLS = 'bert_cls'
+ENCODER_BERT_MEAN = 'bert_mean'
+
+ENCODER_LIST = [ENCODER_WORD_EMBED_AVG, ENCODER_BERT_CLS, ENCODER_BERT_MEAN]
+
+DEFAULT_MAX_LEN = 512
+DEFAULT_BATCH_SIZE = 32
+
+
+class WordEmbedAvgEncoder:
+    """An encoder that averages embeddings of (white-space separated) words.
+       Texts without known words are encoded as zero vectors.
+    """
+    def __init__(self, embedFile):
+        print('Loading word embeddings from: ' + embedFile)
+        words, self.embeds = loadEmbeddings(embedFile)
+        self.embedMap = createEmbedMap(words)
+        self.dim = self.embeds.shape[1]
+
+    def embed(self, texts, batchSize=DEFAULT_BATCH_SIZE):
+        """Encode texts.
+
+        :param texts:       a list of texts
+        :param batchSize:   a batch size (unused)
+        :return: a float32 numpy array of the shape (# of texts, dim)
+        """
+        res = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            ids = [self.embedMap[w] for w in text.split() if w in self.embedMap]
+            if ids:
+                res[i] = self.embeds[ids].mean(axis=0, dtype=np.float32)
+        return res
+
+
+class BertEncoder:
+    """A BERT encoder, which uses either the [CLS] token embedding or the average
+       of token embeddings from the last layer.
+    """
+    def __init__(self, bert, tokenizer, pooling, maxLen=DEFAULT_MAX_LEN, deviceName=DEVICE_CPU):
+        """Constructor.
+
+        :param bert:        a BERT model (CustomBertModel)
+        :param tokenizer:   a BERT tokenizer
+        :param pooling:     ENCODER_BERT_CLS or ENCODER_BERT_MEAN
+        :param maxLen:      a max. input length in tokens (including [CLS] and [SEP])
+        :param deviceName:  a device name
+        """
+        assert pooling in [ENCODER_BERT_CLS, ENCODER_BERT_MEAN], f'Invalid pooling: {pooling}'
+        self.bert = bert
+        self.tokenizer = tokenizer
+        self.pooling = pooling
+        self.maxLen = maxLen
+        self.deviceName = deviceName
+        self.dim = bert.config.hidden_size
+
+        self.bert.to(deviceName)
+        self.bert.eval()
+
+    def tokenize(self, text):
+        toks = self.tokenizer.tokenize(text)[:self.maxLen - 2]
+        return [self.tokenizer.vocab['[CLS]']] + [self.tokenizer.vocab[t] for t in toks] + \
+               [self.tokenizer.vocab['[SEP]']]
+
+    def embed(self, texts, batchSize=DEFAULT_BATCH_SIZE):
+        """Encode texts. To reduce padding, texts are batched in the order of their lengths.
+
+        :param texts:       a list of texts
+        :param batchSize:   a batch size
+        :return: a float32 numpy array of the shape (# of texts, dim)
+        """
+        toks = [self.tokenize(text) for text in texts]
+        order = sorted(range(len(toks)), key=lambda i: len(toks[i]))
+        res = np.zeros((len(texts), self.dim), dtype=np.float32)
+
+        with torch.no_grad():
+            for start in range(0, len(order), batchSize):
+                batchIds = order[start:start + batchSize]
+                maxLen = max(len(toks[i]) for i in batchIds)
+                batchToks = np.full((len(batchIds), maxLen), PAD_CODE, dtype=np.int64)
+                for k, i in enumerate(batchIds):
+                    batchToks[k, :len(toks[i])] = toks[i]
+                batchToks = torch.from_numpy(batchToks).to(self.deviceName)
+                mask = (batchToks != PAD_CODE).float()
+                batchToks[batchToks == PAD_CODE] = 0
+
+                out = self.bert(batchToks, torch.zeros_like(batchToks), mask)[-1]
+                if self.pooling == ENCODER_BERT_CLS:
+                    embeds = out[:, 0]
+                else:
+                    embeds = (out * mask.unsqueeze(-1)).sum(dim=1) / mask.sum(dim=1, keepdim=True)
+
+                res[batchIds] = embeds.float().cpu().numpy()
+
+        return res
+
+
+def addEncoderArgs(parser):
+    parser.add_argument('--encoder', metavar='encoder type',
+                        choices=ENCODER_LIST, required=True,
+                        help='encoder type: ' + ' '.join(ENCODER_LIST))
+
+    parser.add_argument('--embed_file', metavar='word embeddings',
+                        default=None, type=str,
+                        help='a word embedding file, text or binary *.npy (for the word-embedding encoder)')
+
+    parser.add_argument('--bert_model', metavar='BERT model',
+                        default=BERT_BASE_MODEL, type=str,
+                        help='a BERT model name or directory (for BERT encoders)')
+
+    parser.add_argument('--init_model', metavar='CEDR model',
+                        default=None, type=str,
+                        help='a complete CEDR model: if specified, its BERT encoder and tokenizer are used ' +
+                             'instead of --bert_model')
+
+    parser.add_argument('--max_len', metavar='max. length',
+                        default=DEFAULT_MAX_LEN, type=int,
+                        help='max. input length in BERT tokens')
+
+    parser.add_argument('--device_name', metavar='CUDA device name or cpu', default=DEVICE_CPU,
+                        help='The name of the CUDA device to use')
+
+    parser.add_argument('--batch_size', metavar='batch size',
+                        default=DEFAULT_BATCH_SIZE, type=int,
+                        help='batch size')
+
+
+def createEncoderFromArgs(args):
+    if args.encoder == ENCODER_WORD_EMBED_AVG:
+        if args.embed_file is None:
+            raise Exception('Specify the word embedding file: --embed_file')
+        return WordEmbedAvgEncoder(args.embed_file)
+
+    if args.init_model is not None:
+        print('Loading BERT from the CEDR model:', args.init_model)
+        model = torch.load(args.init_model, map_location='cpu')
+        bert, tokenizer = model.bert, model.tokenizer
+    else:
+        print('Loading BERT model:', args.bert_model)
+        bert = CustomBertModel.from_pretrained(args.bert_model)
+        tokenizer = pytorch_pretrained_bert.BertTokenizer.from_pretrained(args.bert_model)
+
+    return BertEncoder(bert, tokenizer, args.encoder, maxLen=args.max_len, deviceName=args.device_name)
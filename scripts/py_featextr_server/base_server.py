@@ -1,50 +1,321 @@
+import os
 import sys
+import time
+import queue
+import signal
+import multiprocessing
 
 # Thrift files are generated from
 # ./src/main/java/edu/cmu/lti/oaqa/flexneuart/letor/external/protocol.thrift
 #
 
-from scripts.py_featextr_server.python_generated.protocol.ExternalScorer import Processor
+from scripts.py_featextr_server.python_generated.protocol.ExternalScorer import Processor, Client
 from scripts.py_featextr_server.python_generated.protocol.ttypes import ScoringException
 
 from thrift.transport import TSocket
 from thrift.transport import TTransport
 from thrift.protocol import TBinaryProtocol
+from thrift.protocol import TCompactProtocol
 from thrift.server import TServer
+from thrift.server.TProcessPoolServer import TProcessPoolServer
+from thrift.server.TNonblockingServer import TNonblockingServer
 
-from threading import Lock
+from scripts.py_featextr_server.score_cache import ScoreCache, getScoreKey, SCORE_CACHE_REPORT_INTERVAL
+from scripts.py_featextr_server.server_metrics import ServerMetrics, startMetricsHttpServer, startMetricsDumps, \
+    METRIC_REQUEST_MS, METRIC_QUEUE_WAIT_MS, METRIC_COMPUTE_MS, METRIC_SERIALIZE_MS, \
+    METRIC_MICRO_BATCH_DOCS, METRIC_MICRO_BATCH_REQUESTS, DEFAULT_METRICS_DUMP_INTERVAL
+
+from threading import Lock, Thread, local
+from multiprocessing import Value
+from concurrent.futures import Future
 
 SAMPLE_HOST = '127.0.0.1'
 SAMPLE_PORT = 8080
 
+# A maximum time (in milliseconds) a request waits for other requests to be batched with
+DEFAULT_MICRO_BATCH_LATENCY_MS = 10
+
+# Transports & protocols: a client (e.g., the Java FeatExtractorExternalApacheThrift)
+# must use the same transport and protocol as the server.
+# The buffered transport is wire-compatible with a raw socket transport.
+TRANSPORT_BUFFERED = 'buffered'
+TRANSPORT_FRAMED = 'framed'
+TRANSPORT_LIST = [TRANSPORT_BUFFERED, TRANSPORT_FRAMED]
+
+PROTOCOL_BINARY = 'binary'
+PROTOCOL_COMPACT = 'compact'
+PROTOCOL_LIST = [PROTOCOL_BINARY, PROTOCOL_COMPACT]
+
+DEFAULT_NON_BLOCKING_THREAD_QTY = 10
+
+
+class MicroBatchDispatcher:
+    """A micro-batching dispatcher: it coalesces requests arriving concurrently
+       (from different server threads) into a single batch, which is processed
+       by a single call of the batch function in a dedicated thread. Then, results
+       are handed back to the waiting requests.
+
+       A batch is processed as soon as either the total number of documents reaches
+       the maximum batch size or the latency budget (counted from the arrival of the first
+       request in the batch) is exhausted. Requests are never split: a single request with more
+       than maxBatchSize documents is processed as a separate batch.
+    """
+    def __init__(self, batchFunc, maxBatchSize, latencyBudgetMs=DEFAULT_MICRO_BATCH_LATENCY_MS, metrics=None):
+        """Constructor.
+
+        :param batchFunc:         a function that accepts a list of (query, documents) tuples
+                                  and returns a list of results (one result per tuple)
+        :param maxBatchSize:      a maximum total number of documents in a batch
+        :param latencyBudgetMs:   a maximum time (in ms) a request waits for other requests
+        :param metrics:           an optional ServerMetrics object to record queue waits and batch sizes
+        """
+        self.batchFunc = batchFunc
+        self.maxBatchSize = maxBatchSize
+        self.latencyBudget = latencyBudgetMs / 1000.0
+        self.metrics = metrics
+        print('Micro-batching: max. batch size %d latency budget %g ms' % (maxBatchSize, latencyBudgetMs))
+
+        self.start()
+
+    def start(self):
+        """Start the dispatching thread. Threads do not survive forking,
+           so this function needs to be called again in a forked worker process.
+        """
+        self.queue_ = queue.Queue()
+        self.thread_ = Thread(target=self.processQueue_, daemon=True)
+        self.thread_.start()
+
+    def submit(self, query, docs):
+        """Submit the request and wait for its result."""
+        fut = Future()
+        self.queue_.put((time.time(), query, docs, fut))
+        return fut.result()
+
+    def processQueue_(self):
+        # A request that did not fit into the previous batch
+        nextReq = None
+        while True:
+            batch = []
+            try:
+                req = nextReq if nextReq is not None else self.queue_.get()
+                nextReq = None
+
+                batch.append(req)
+                arrivalTime, _, docs, _ = req
+                docQty = len(docs)
+                deadline = arrivalTime + self.latencyBudget
+
+                while docQty < self.maxBatchSize:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        req = self.queue_.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    docs = req[2]
+                    if docQty + len(docs) > self.maxBatchSize:
+                        nextReq = req
+                        break
+                    batch.append(req)
+                    docQty += len(docs)
+
+                self.processBatch_(batch)
+            except Exception as e:
+                # The dispatching thread must never die: otherwise, all pending
+                # and future requests would wait for their results forever.
+                print('Micro-batch dispatching error:', e)
+                self.failRequests_(batch + ([nextReq] if nextReq is not None else []), e)
+                nextReq = None
+
+    def processBatch_(self, batch):
+        try:
+            if self.metrics is not None:
+                startTime = time.time()
+                for arrivalTime, _, _, _ in batch:
+                    self.metrics.observe(METRIC_QUEUE_WAIT_MS, 1000 * (startTime - arrivalTime))
+                self.metrics.observe(METRIC_MICRO_BATCH_REQUESTS, len(batch))
+                self.metrics.observe(METRIC_MICRO_BATCH_DOCS, sum(len(docs) for _, _, docs, _ in batch))
+            results = self.batchFunc([(query, docs) for _, query, docs, _ in batch])
+            assert len(results) == len(batch), 'The batch function should return one result per request'
+            for (_, _, _, fut), res in zip(batch, results):
+                fut.set_result(res)
+        except Exception as e:
+            self.failRequests_(batch, e)
+
+    @staticmethod
+    def failRequests_(batch, e):
+        for _, _, _, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+
 
 class BaseQueryHandler:
-    def __init__(self, exclusive=True):
+    def __init__(self, exclusive=True,
+                 microBatchMaxSize=0, microBatchLatencyMs=DEFAULT_MICRO_BATCH_LATENCY_MS,
+                 scoreCacheSize=0, scoreCacheFile=None, modelFingerprint=''):
+        """Constructor.
+
+        :param exclusive:             True to process only one request (or one micro-batch) at a time
+        :param microBatchMaxSize:     if > 0, raw-text requests arriving concurrently are coalesced into
+                                      micro-batches with at most this number of documents
+                                      (this requires a multi-threaded server)
+        :param microBatchLatencyMs:   a maximum time (in ms) a request waits for other requests to be batched with
+        :param scoreCacheSize:        a maximum number of in-memory entries in the score cache
+        :param scoreCacheFile:        an optional on-disk score cache file
+                                      (the cache is enabled if scoreCacheSize > 0 or the file is specified)
+        :param modelFingerprint:      a model fingerprint, which is a part of each cache key:
+                                      it must change whenever the model or its configuration changes
+        """
         self.lock_ = Lock() if exclusive else None
         if self.lock_ is not None:
             print('Locking the base server for single-threaded processing')
         else:
             print('NOT locking the base server for multi-threaded processing')
 
+        # Metrics are always collected, but they are exposed only on request (see startQueryServer)
+        self.metrics = ServerMetrics()
+        # Handler time of the current request: it is used to compute the (de)serialization time
+        self.threadLocal_ = local()
+
+        self.dispatcher_ = None
+        if microBatchMaxSize > 0:
+            self.dispatcher_ = MicroBatchDispatcher(self.computeScoresFromRawBatch_,
+                                                    microBatchMaxSize, microBatchLatencyMs,
+                                                    metrics=self.metrics)
+
+        self.workerId = None
+        self.modelFingerprint = modelFingerprint
+        self.scoreCache_ = None
+        if scoreCacheSize > 0 or scoreCacheFile is not None:
+            print('Model fingerprint:', modelFingerprint)
+            self.scoreCache_ = ScoreCache(scoreCacheSize, scoreCacheFile)
+
+    def initWorker(self, workerId):
+        """This function is called in each worker process of the pre-forked server
+           (after forking). Child classes can override it, e.g., to limit the number of
+           threads used by each worker, but they need to call the parent function.
+
+        :param workerId: a worker number (from zero)
+        """
+        self.workerId = workerId
+        if self.dispatcher_ is not None:
+            self.dispatcher_.start()
+
     def getScoresFromParsed(self, query, docs):
+        startTime = time.time()
         try:
-            if self.lock_ is not None:
-                with self.lock_:
-                    return self.computeScoresFromParsedOverride(query, docs)
-            else:
-                return self.computeScoresFromParsedOverride(query, docs)
+            if self.scoreCache_ is not None:
+                return self.getScoresCached_(self.parsedEntryToKeyStr(query),
+                                             [self.parsedEntryToKeyStr(e) for e in docs],
+                                             self.getScoresFromParsedUncached_, query, docs)
+            return self.getScoresFromParsedUncached_(query, docs)
         except Exception as e:
             raise ScoringException(str(e))
+        finally:
+            self.recordRequest_(startTime, len(docs))
 
     def getScoresFromRaw(self, query, docs):
+        startTime = time.time()
         try:
-            if self.lock_ is not None:
-                with self.lock_:
-                    return self.computeScoresFromRawOverride(query, docs)
-            else:
-                return self.computeScoresFromRawOverride(query, docs)
+            if self.scoreCache_ is not None:
+                return self.getScoresCached_(query.text, [e.text for e in docs],
+                                             self.getScoresFromRawUncached_, query, docs)
+            return self.getScoresFromRawUncached_(query, docs)
         except Exception as e:
             raise ScoringException(str(e))
+        finally:
+            self.recordRequest_(startTime, len(docs))
+
+    def recordRequest_(self, startTime, docQty):
+        handlerMs = 1000 * (time.time() - startTime)
+        self.threadLocal_.handlerMs = handlerMs
+        self.metrics.observe(METRIC_REQUEST_MS, handlerMs)
+        # Requests can be processed concurrently: the request counter
+        # is updated (and returned) while holding the metrics lock
+        requestQty = self.metrics.countRequest(docQty)
+        if self.scoreCache_ is not None and requestQty % SCORE_CACHE_REPORT_INTERVAL == 0:
+            print(self.scoreCache_.statsStr())
+
+    def getHandlerMs(self):
+        """:return: the handler time (in ms) of the last request processed by the current thread"""
+        return getattr(self.threadLocal_, 'handlerMs', 0.0)
+
+    def runExclusive_(self, func, *args, recordWait=True):
+        """Run the function while holding the lock (if the handler is exclusive)
+           and record waiting & computation times."""
+        if self.lock_ is not None:
+            startTime = time.time()
+            with self.lock_:
+                if recordWait:
+                    self.metrics.observe(METRIC_QUEUE_WAIT_MS, 1000 * (time.time() - startTime))
+                with self.metrics.timer(METRIC_COMPUTE_MS):
+                    return func(*args)
+        else:
+            with self.metrics.timer(METRIC_COMPUTE_MS):
+                return func(*args)
+
+    def getScoresFromParsedUncached_(self, query, docs):
+        return self.runExclusive_(self.computeScoresFromParsedOverride, query, docs)
+
+    def getScoresFromRawUncached_(self, query, docs):
+        if self.dispatcher_ is not None:
+            return self.dispatcher_.submit(query, docs)
+        return self.runExclusive_(self.computeScoresFromRawOverride, query, docs)
+
+    def getScoresCached_(self, queryStr, docStrs, computeFunc, query, docs):
+        """Retrieve scores from the cache and compute only missing ones."""
+        modelFingerprint = self.modelFingerprint
+        keys = [getScoreKey(modelFingerprint, queryStr, e.id, docStr) for e, docStr in zip(docs, docStrs)]
+        scores = self.scoreCache_.get(keys)
+
+        missDocs = [e for e, score in zip(docs, scores) if score is None]
+        if missDocs:
+            missScores = computeFunc(query, missDocs)
+            newKeys, newScores = [], []
+            for i, e in enumerate(docs):
+                if scores[i] is None and e.id in missScores:
+                    scores[i] = missScores[e.id]
+                    newKeys.append(keys[i])
+                    newScores.append(scores[i])
+            # If the model was reloaded in the meantime, scores may have been computed
+            # by the new model: such scores must not be cached under the old fingerprint.
+            if modelFingerprint == self.modelFingerprint:
+                self.scoreCache_.put(newKeys, newScores)
+
+        return {e.id: score for e, score in zip(docs, scores) if score is not None}
+
+    def getScoreCacheStats(self):
+        """:return: a dictionary with score cache hit/miss counters or None if the cache is disabled"""
+        return self.scoreCache_.getStats() if self.scoreCache_ is not None else None
+
+    def computeScoresFromRawBatch_(self, requests):
+        # Queue waiting times of micro-batched requests are recorded by the dispatcher
+        return self.runExclusive_(self.computeScoresFromRawBatchOverride, requests, recordWait=False)
+
+    def runLocked(self, func, *args):
+        """Run the function while holding the lock (if the handler is exclusive)
+           without recording any metrics (e.g., to warm up a reloaded model)."""
+        if self.lock_ is not None:
+            with self.lock_:
+                return func(*args)
+        return func(*args)
+
+    def swapModel(self, swapFunc, modelFingerprint):
+        """Atomically replace the model: the function waits for the request
+           (or the micro-batch) being processed (if the handler is exclusive).
+
+        :param swapFunc:            a function that replaces the model
+        :param modelFingerprint:    a fingerprint of the new model
+        """
+        if self.lock_ is not None:
+            with self.lock_:
+                swapFunc()
+                self.modelFingerprint = modelFingerprint
+        else:
+            swapFunc()
+            self.modelFingerprint = modelFingerprint
+        print('Swapped in the model with the fingerprint:', modelFingerprint)
 
     def textEntryToStr(self, te):
         arr = []
@@ -52,6 +323,10 @@ class BaseQueryHandler:
             arr.append('%s %g %d ' % (winfo.word, winfo.IDF, winfo.qty))
         return te.id + ' '.join(arr)
 
+    def parsedEntryToKeyStr(self, te):
+        """A string representation of a parsed entry (without the ID) used to compute score cache keys."""
+        return ' '.join(['%s:%g:%d' % (winfo.word, winfo.IDF, winfo.qty) for winfo in te.entries])
+
     def concatTextEntryWords(self, te):
         arr = [winfo.word for winfo in te.entries]
         return ' '.join(arr)
@@ -63,21 +338,229 @@ class BaseQueryHandler:
     def computeScoresFromRawOverride(self, query, docs):
         raise ScoringException('Raw-text fields are not supported by this server!')
 
+    # This function is used for micro-batching: it receives a list of (query, docs)
+    # tuples and returns a list of results. Child classes can override it to score
+    # documents of several queries in a single model call.
+    def computeScoresFromRawBatchOverride(self, requests):
+        return [self.computeScoresFromRawOverride(query, docs) for query, docs in requests]
+
+
+def getWorkerCpus(workerId, workerQty):
+    """Split CPUs available to the process into workerQty contiguous groups of
+       (nearly) equal size and return the group of the worker. When CPUs of each NUMA node
+       are numbered contiguously (which is typical), using a multiple of the number of NUMA nodes
+       as the number of workers places each worker on a single node.
+       If there are fewer CPUs than workers, CPUs are assigned in a round-robin fashion.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < workerQty:
+        return [cpus[workerId % len(cpus)]]
+    start = len(cpus) * workerId // workerQty
+    end = len(cpus) * (workerId + 1) // workerQty
+    return cpus[start:end]
+
+
+def setReloadSignalHandler(queryHandler, reloadFunc, sig=signal.SIGHUP):
+    """Install a signal handler that reloads the model in a background thread
+       (the server keeps processing requests using the old model meanwhile).
+       The main process of the pre-forked server forwards the signal to all worker
+       processes, which reload their models independently.
+
+       Note that in the pre-forked mode each worker loads its own private copy of the new model,
+       i.e., the copy-on-write sharing of the model loaded before forking is lost: after a reload
+       the server needs (roughly) workerQty times more memory for the model. To restore sharing,
+       restart the server.
+
+    :param queryHandler:  a query handler
+    :param reloadFunc:    a function that loads and swaps in the model
+    :param sig:           a signal number
+    """
+    reloadLock = Lock()
+
+    def reloadThread():
+        try:
+            reloadFunc()
+        except Exception as e:
+            print('Failed to reload the model (the old model is kept):', e)
+        finally:
+            reloadLock.release()
+
+    def signalHandler(signum, frame):
+        workers = multiprocessing.active_children()
+        if queryHandler.workerId is None and workers:
+            print(f'Forwarding the reload signal to {len(workers)} worker processes: ' +
+                  'each worker will load a private (not shared) copy of the model')
+            for w in workers:
+                os.kill(w.pid, signum)
+            return
+        if not reloadLock.acquire(blocking=False):
+            print('The model is already being reloaded, ignoring the signal')
+            return
+        print(f'Process {os.getpid()} is reloading the model...')
+        Thread(target=reloadThread, daemon=True).start()
+
+    signal.signal(sig, signalHandler)
+    print(f'Send the signal {signal.Signals(sig).name} to the process {os.getpid()} to reload the model')
+
+
+def instrumentProcessor(processor, queryHandler):
+    """Wrap processing functions of the Thrift processor to record the (de)serialization
+       time, i.e., the processing time minus the time spent in the handler."""
+    # The generated processor dispatches calls via this (name -> function) map
+    for name, func in list(processor._processMap.items()):
+        def timedFunc(proc, seqid, iprot, oprot, func=func):
+            startTime = time.time()
+            func(proc, seqid, iprot, oprot)
+            totalMs = 1000 * (time.time() - startTime)
+            queryHandler.metrics.observe(METRIC_SERIALIZE_MS, max(0.0, totalMs - queryHandler.getHandlerMs()))
+
+        processor._processMap[name] = timedFunc
+
+
+def startMetricsReporting(queryHandler, host, metricsPort, metricsFile, metricsInterval, workerId=None):
+    """Expose metrics via HTTP and/or periodic JSON dumps (if the port and/or the file are specified).
+       Each worker of the pre-forked server uses its own port (metricsPort + workerId)
+       and its own file (with the worker number suffix)."""
+    def extraFunc():
+        res = {}
+        if workerId is not None:
+            res['worker_id'] = workerId
+        cacheStats = queryHandler.getScoreCacheStats()
+        if cacheStats is not None:
+            res['score_cache'] = cacheStats
+        return res
+
+    if metricsPort is not None:
+        startMetricsHttpServer(queryHandler.metrics, host,
+                               metricsPort + (workerId if workerId is not None else 0),
+                               extraFunc=extraFunc)
+    if metricsFile is not None:
+        startMetricsDumps(queryHandler.metrics,
+                          metricsFile + (f'.{workerId}' if workerId is not None else ''),
+                          metricsInterval, extraFunc=extraFunc)
+
+
+def getTransportFactory(transport):
+    if transport == TRANSPORT_BUFFERED:
+        return TTransport.TBufferedTransportFactory()
+    elif transport == TRANSPORT_FRAMED:
+        return TTransport.TFramedTransportFactory()
+
+    raise Exception('Unsupported transport: ' + transport)
 
-# This function starts the server and takes over the program control
-def startQueryServer(host, port, multiThreaded, queryHandler):
+
+def getProtocolFactory(protocol):
+    # Accelerated protocols use a C extension (if it is available), but they are
+    # wire-compatible with respective pure-Python protocols
+    if protocol == PROTOCOL_BINARY:
+        return TBinaryProtocol.TBinaryProtocolAcceleratedFactory()
+    elif protocol == PROTOCOL_COMPACT:
+        return TCompactProtocol.TCompactProtocolAcceleratedFactory()
+
+    raise Exception('Unsupported protocol: ' + protocol)
+
+
+def addScoreCacheArgs(parser):
+    """Add score cache options to the argument parser of a server."""
+    parser.add_argument('--score_cache_size', metavar='score cache size',
+                        default=0, type=int,
+                        help='a maximum number of query-document scores cached in memory (0 disables caching ' +
+                             'unless the on-disk cache file is specified)')
+
+    parser.add_argument('--score_cache_file', metavar='score cache file',
+                        default=None, type=str,
+                        help='an optional file to persist query-document scores between runs')
+
+
+def addServerTransportArgs(parser):
+    """Add transport and protocol options to the argument parser of a server."""
+    parser.add_argument('--transport', metavar='thrift transport',
+                        choices=TRANSPORT_LIST, default=TRANSPORT_BUFFERED,
+                        help='thrift transport: ' + ' '.join(TRANSPORT_LIST))
+
+    parser.add_argument('--protocol', metavar='thrift protocol',
+                        choices=PROTOCOL_LIST, default=PROTOCOL_BINARY,
+                        help='thrift protocol: ' + ' '.join(PROTOCOL_LIST))
+
+    parser.add_argument('--non_blocking', action='store_true',
+                        help='use a non-blocking server (it requires the framed transport)')
+
+    parser.add_argument('--non_blocking_thread_qty', metavar='# of threads',
+                        default=DEFAULT_NON_BLOCKING_THREAD_QTY, type=int,
+                        help='# of threads processing requests in the non-blocking server')
+
+
+def createClient(host, port, transport=TRANSPORT_BUFFERED, protocol=PROTOCOL_BINARY):
+    """Create a client of the scoring server.
+
+    :return: a tuple: a transport object (it needs to be opened and closed by the caller), a client.
+    """
+    sock = TSocket.TSocket(host, port)
+    transp = getTransportFactory(transport).getTransport(sock)
+    return transp, Client(getProtocolFactory(protocol).getProtocol(transp))
+
+
+# This function starts the server and takes over the program control.
+# If workerQty > 1, the server pre-forks workerQty processes, which accept
+# connections on a shared socket (each worker processes one connection at a time).
+# Workers are created using the fork start method (the default one on Linux).
+# In this mode, the query handler (and its model) are created before forking and
+# are shared by worker processes in the copy-on-write mode. To use the pre-forked mode
+# with GPUs, a handler should defer the device initialization till the initWorker call.
+#
+# If nonBlocking is True, the server uses a single I/O thread to handle all
+# connections and a pool of nonBlockingThreadQty threads to process requests.
+# The non-blocking server works only with the framed transport.
+#
+# Metrics (see server_metrics.py) are served via HTTP if metricsPort is specified
+# and/or are periodically dumped to metricsFile (each pre-forked worker reports its own metrics).
+def startQueryServer(host, port, multiThreaded, queryHandler, workerQty=1, pinWorkers=False,
+                     transport=TRANSPORT_BUFFERED, protocol=PROTOCOL_BINARY,
+                     nonBlocking=False, nonBlockingThreadQty=DEFAULT_NON_BLOCKING_THREAD_QTY,
+                     metricsPort=None, metricsFile=None, metricsInterval=DEFAULT_METRICS_DUMP_INTERVAL):
     processor = Processor(queryHandler)
+    instrumentProcessor(processor, queryHandler)
+
+    serverSocket = TSocket.TServerSocket(host=host, port=port)
+    tfactory = getTransportFactory(transport)
+    pfactory = getProtocolFactory(protocol)
+    print(f'Transport: {transport} protocol: {protocol}')
+
+    if nonBlocking:
+        if transport != TRANSPORT_FRAMED:
+            raise Exception('The non-blocking server requires the framed transport')
+        if workerQty > 1:
+            raise Exception('The non-blocking server cannot be pre-forked')
+        print(f'Starting a non-blocking server with {nonBlockingThreadQty} processing threads...')
+        server = TNonblockingServer(processor, serverSocket, pfactory, pfactory, threads=nonBlockingThreadQty)
+    elif workerQty > 1:
+        print(f'Starting a pre-forked server with {workerQty} worker processes...')
+        server = TProcessPoolServer(processor, serverSocket, tfactory, pfactory)
+        server.setNumWorkers(workerQty)
 
-    transport = TSocket.TServerSocket(host=host, port=port)
-    tfactory = TTransport.TBufferedTransportFactory()
-    pfactory = TBinaryProtocol.TBinaryProtocolFactory()
+        workerCounter = Value('i', 0)
 
-    if multiThreaded:
+        def postForkCallback():
+            with workerCounter.get_lock():
+                workerId = workerCounter.value
+                workerCounter.value += 1
+            if pinWorkers:
+                cpus = getWorkerCpus(workerId, workerQty)
+                os.sched_setaffinity(0, cpus)
+                print(f'Worker {workerId} pid {os.getpid()} is pinned to CPUs: {cpus}')
+            queryHandler.initWorker(workerId)
+            startMetricsReporting(queryHandler, host, metricsPort, metricsFile, metricsInterval, workerId)
+
+        server.setPostForkCallback(postForkCallback)
+    elif multiThreaded:
         print('Starting a multi-threaded server...')
-        server = TServer.TThreadedServer(processor, transport, tfactory, pfactory)
+        server = TServer.TThreadedServer(processor, serverSocket, tfactory, pfactory)
     else:
         print('Starting a single-threaded server...')
-        server = TServer.TSimpleServer(processor, transport, tfactory, pfactory)
+        server = TServer.TSimpleServer(processor, serverSocket, tfactory, pfactory)
+
+    if nonBlocking or workerQty <= 1:
+        startMetricsReporting(queryHandler, host, metricsPort, metricsFile, metricsInterval)
 
     server.serve()
     print('done.')
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# A benchmark client that sends (synthetic) scoring requests to a scoring server
+# from several concurrent threads and reports latency percentiles and throughput.
+import sys
+import time
+import random
+import argparse
+
+import numpy as np
+
+from threading import Thread
+
+sys.path.append('.')
+
+from scripts.py_featextr_server.python_generated.protocol.ttypes import \
+    WordEntryInfo, TextEntryParsed, TextEntryRaw
+
+from scripts.py_featextr_server.base_server import SAMPLE_PORT, SAMPLE_HOST, createClient, \
+    TRANSPORT_LIST, TRANSPORT_BUFFERED, PROTOCOL_LIST, PROTOCOL_BINARY
+
+VOCAB_SIZE = 10000
+
+
+def genText(rand, wordQty):
+    return ' '.join('word%d' % rand.randrange(VOCAB_SIZE) for _ in range(wordQty))
+
+
+def genRequest(rand, args, reqId):
+    queryText = genText(rand, args.query_len)
+    docTexts = [genText(rand, args.doc_len) for _ in range(args.doc_qty)]
+    if args.parsed:
+        def parsed(entryId, text):
+            return TextEntryParsed(entryId, [WordEntryInfo(word=w, IDF=1.0, qty=1) for w in text.split()])
+        return parsed(str(reqId), queryText), [parsed(str(i), t) for i, t in enumerate(docTexts)]
+
+    return TextEntryRaw(str(reqId), queryText), [TextEntryRaw(str(i), t) for i, t in enumerate(docTexts)]
+
+
+def runThread(threadId, args, requests, latencies):
+    transport, client = None, None
+    for reqId in range(threadId, len(requests), args.thread_qty):
+        query, docs = requests[reqId]
+        startTime = time.time()
+        # Similarly to the Java client, we open a new connection for each request
+        # unless the connection reuse is requested explicitly
+        if transport is None:
+            transport, client = createClient(args.host, args.port, args.transport, args.protocol)
+            transport.open()
+        if args.parsed:
+            res = client.getScoresFromParsed(query, docs)
+        else:
+            res = client.getScoresFromRaw(query, docs)
+        if not args.reuse_conn:
+            transport.close()
+            transport = None
+        latencies[reqId] = time.time() - startTime
+        assert len(res) == len(docs), f'Expected {len(docs)} scores, but got {len(res)}'
+
+    if transport is not None:
+        transport.close()
+
+
+parser = argparse.ArgumentParser(description='A benchmark client for scoring servers.')
+
+parser.add_argument('--host', metavar='server host',
+                    default=SAMPLE_HOST, type=str,
+                    help='server host')
+parser.add_argument('--port', metavar='server port',
+                    default=SAMPLE_PORT, type=int,
+                    help='server port')
+parser.add_argument('--transport', metavar='thrift transport',
+                    choices=TRANSPORT_LIST, default=TRANSPORT_BUFFERED,
+                    help='thrift transport (should be the same as the server one): ' + ' '.join(TRANSPORT_LIST))
+parser.add_argument('--protocol', metavar='thrift protocol',
+                    choices=PROTOCOL_LIST, default=PROTOCOL_BINARY,
+                    help='thrift protocol (should be the same as the server one): ' + ' '.join(PROTOCOL_LIST))
+parser.add_argument('--thread_qty', metavar='# of threads',
+                    default=4, type=int,
+                    help='# of concurrent client threads')
+parser.add_argument('--request_qty', metavar='# of requests',
+                    default=100, type=int,
+                    help='total # of requests')
+parser.add_argument('--doc_qty', metavar='# of documents',
+                    default=1000, type=int,
+                    help='# of candidate documents per request')
+parser.add_argument('--query_len', metavar='query length',
+                    default=8, type=int,
+                    help='# of words in a query')
+parser.add_argument('--doc_len', metavar='document length',
+                    default=100, type=int,
+                    help='# of words in a document')
+parser.add_argument('--parsed', action='store_true',
+                    help='send parsed rather than raw-text entries')
+parser.add_argument('--reuse_conn', action='store_true',
+                    help='reuse a connection for all requests of a thread')
+parser.add_argument('--seed', metavar='random seed',
+                    default=0, type=int,
+                    help='random seed')
+
+args = parser.parse_args()
+print(args)
+
+rand = random.Random(args.seed)
+requests = [genRequest(rand, args, reqId) for reqId in range(args.request_qty)]
+latencies = [None] * args.request_qty
+
+threads = [Thread(target=runThread, args=(threadId, args, requests, latencies))
+           for threadId in range(args.thread_qty)]
+
+startTime = time.time()
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+elapsed = time.time() - startTime
+
+latencies = [e for e in latencies if e is not None]
+if len(latencies) < args.request_qty:
+    print(f'{args.request_qty - len(latencies)} requests failed!')
+    sys.exit(1)
+
+latencies = 1000 * np.array(latencies)
+
+print('# of requests: %d # of threads: %d elapsed: %.2f sec' % (len(latencies), args.thread_qty, elapsed))
+print('throughput: %.1f requests/sec %.1f docs/sec' % (len(latencies) / elapsed,
+                                                       len(latencies) * args.doc_qty / elapsed))
+print('latency (ms): mean %.1f p50 %.1f p90 %.1f p99 %.1f max %.1f' %
+      (latencies.mean(),
+       np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99),
+       latencies.max()))
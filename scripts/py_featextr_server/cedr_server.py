@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import os
 import sys
 import argparse
 import torch
@@ -7,12 +8,23 @@ import time
 sys.path.append('.')
 
 from scripts.py_featextr_server.python_generated.protocol.ttypes import TextEntryRaw
-from scripts.py_featextr_server.base_server import BaseQueryHandler, startQueryServer
+from scripts.py_featextr_server.base_server import BaseQueryHandler, startQueryServer, addServerTransportArgs, \
+                                                    addScoreCacheArgs, setReloadSignalHandler, \
+                                                    DEFAULT_MICRO_BATCH_LATENCY_MS
+from scripts.py_featextr_server.server_metrics import addMetricsArgs, ServerMetrics, \
+    METRIC_TOKENIZE_MS, METRIC_FORWARD_MS, METRIC_MODEL_BATCH_SIZE
+from scripts.py_featextr_server.score_cache import getFileFingerprint
 
 import scripts.cedr.model_init_utils as model_init_utils
 import scripts.cedr.data as data
+import scripts.cedr.inference_engine as inference_engine
 
 DEFAULT_BATCH_SIZE = 32
+# A synthetic request used to warm up a (re)loaded model
+WARM_UP_QUERY_WORD = 'query'
+WARM_UP_DOC_WORD = 'document'
+# How many times we try to load the model if the model file(s) keep changing while loading
+MODEL_LOAD_MAX_ATTEMPT_QTY = 5
 
 class CedrQueryHandler(BaseQueryHandler):
     # Exclusive==True means that only one getScores
@@ -22,23 +34,76 @@ class CedrQueryHandler(BaseQueryHandler):
                     batchSize, deviceName,
                     maxQueryLen, maxDocLen,
                     exclusive,
-                    debugPrint=False):
-        super().__init__(exclusive=exclusive)
+                    sortByLen=False,
+                    debugPrint=False,
+                    microBatchMaxSize=0,
+                    microBatchLatencyMs=DEFAULT_MICRO_BATCH_LATENCY_MS,
+                    workerThreadQty=None,
+                    scoreCacheSize=0, scoreCacheFile=None, modelFingerprint=''):
+        super().__init__(exclusive=exclusive,
+                         microBatchMaxSize=microBatchMaxSize,
+                         microBatchLatencyMs=microBatchLatencyMs,
+                         scoreCacheSize=scoreCacheSize,
+                         scoreCacheFile=scoreCacheFile,
+                         modelFingerprint=modelFingerprint)
 
         self.debugPrint = debugPrint
+        self.workerThreadQty = workerThreadQty
         self.batchSize = batchSize
+        self.sortByLen = sortByLen
 
         self.maxQueryLen = maxQueryLen
         self.maxDocLen = maxDocLen
         self.deviceName = deviceName
         print('Maximum query/document len %d/%d device: %s' % (self.maxQueryLen, self.maxDocLen, self.deviceName))
 
-        self.model = model
-
-        self.model.to(self.deviceName)
+        self.model = self.prepareModel_(model)
 
+    def prepareModel_(self, model):
+        model.to(self.deviceName)
         # need to be in the eval mode
-        self.model.eval()
+        model.eval()
+        return model
+
+    def reloadModel(self, model, modelFingerprint):
+        """Warm up a new model on a synthetic batch and swap it in. This function is
+           called from a background thread, while the old model keeps serving requests.
+
+           Peak memory: until the swap, weights of both models reside on the device,
+           i.e., the device needs memory for two copies of the model weights. However,
+           the warm-up is carried out while holding the handler lock: the old and the new
+           models are never executed simultaneously, so activations of only one batch
+           are allocated at a time (and the old model does not serve requests during the warm-up).
+           If the device cannot hold two models, restart the server instead.
+
+        :param model:             a new model
+        :param modelFingerprint:  a fingerprint of the new model
+        """
+        model = self.prepareModel_(model)
+        print('Warming up the new model...')
+        startTime = time.time()
+        # The synthetic batch is not recorded in the server metrics
+        self.runLocked(self.scoreBatch_, model, [self.getWarmUpRequest_()], ServerMetrics())
+        print('Warm-up took %.3f sec' % (time.time() - startTime))
+
+        def swapFunc():
+            self.model = model
+
+        self.swapModel(swapFunc, modelFingerprint)
+
+    def getWarmUpRequest_(self):
+        # A batch of maximum-length documents should trigger all memory allocations
+        query = TextEntryRaw('warm_up', ' '.join([WARM_UP_QUERY_WORD] * self.maxQueryLen))
+        docText = ' '.join([WARM_UP_DOC_WORD] * self.maxDocLen)
+        docs = [TextEntryRaw(str(i), docText) for i in range(self.batchSize)]
+        return query, docs
+
+    def initWorker(self, workerId):
+        super().initWorker(workerId)
+        # Each worker of the pre-forked server should use only its share of CPU cores
+        if self.workerThreadQty is not None:
+            torch.set_num_threads(self.workerThreadQty)
+            print(f'Worker {workerId} uses {self.workerThreadQty} threads')
 
     def computeScoresFromParsedOverride(self, query, docs):
         queryRaw = TextEntryRaw(query.id, self.concatTextEntryWords(query))
@@ -49,42 +114,86 @@ class CedrQueryHandler(BaseQueryHandler):
         return self.computeScoresFromRawOverride(queryRaw, docsRaw)
 
     def computeScoresFromRawOverride(self, query, docs):
-        print('Processing query:', query.id, query.text, '# of docs: ', len(docs))
+        return self.computeScoresFromRawBatchOverride([(query, docs)])[0]
 
-        queryData = {query.id: query.text}
-        # Run maps queries to arrays of document IDs see iter_valid_records (train.py)
-        run = {query.id: [e.id for e in docs]}
+    def computeScoresFromRawBatchOverride(self, requests):
+        return self.scoreBatch_(self.model, requests, self.metrics)
 
-        docData = {}
-        for e in docs:
-            docData[e.id] = e.text
+    def scoreBatch_(self, model, requests, metrics):
+        for query, docs in requests:
+            print('Processing query:', query.id, query.text, '# of docs: ', len(docs))
 
-        sampleRet = {}
+        # Query (and document) IDs of different requests can coincide,
+        # hence, we use request numbers as internal query IDs.
+        queryData = {}
+        docData = {}
+        # Run maps queries to arrays of document IDs see iter_valid_records (train.py)
+        run = {}
+        with metrics.timer(METRIC_TOKENIZE_MS):
+            for reqId, (query, docs) in enumerate(requests):
+                qid = str(reqId)
+                queryData[qid] = query.text
+                run[qid] = []
+                for e in docs:
+                    did = (qid, e.id)
+                    run[qid].append(did)
+                    # When documents are sorted by length, we tokenize them in advance,
+                    # so that the batch iterator does not need to tokenize them again.
+                    docData[did] = model.tokenize(e.text) if self.sortByLen else e.text
+
+        sampleRet = [{} for _ in requests]
 
         if docData:
 
             # based on the code from run_model function (train.py)
             dataSet = queryData, docData
+            # Documents are sorted within each query (request) rather than across the whole
+            # micro-batch: thus, batches mostly contain documents of a single query,
+            # which are scored using score_candidates.
+            sortByLen = data.SORT_BY_LEN_QUERY if self.sortByLen else None
             # must disable gradient computation to greatly reduce memory requirements and speed up things
             with torch.no_grad():
-                for records in data.iter_valid_records(self.model, self.deviceName, dataSet, run,
-                                                       self.batchSize,
-                                                       self.maxQueryLen, self.maxDocLen):
-                    scores = self.model(records['query_tok'],
-                                        records['query_mask'],
-                                        records['doc_tok'],
-                                        records['doc_mask'])
-
-                    # tolist() works much faster compared to extracting scores
-                    # one by one using .item()
-                    scores = scores.tolist()
-
-                    for qid, did, score in zip(records['query_id'], records['doc_id'], scores):
+                batchIter = iter(data.iter_valid_records(model, self.deviceName, dataSet, run,
+                                                         self.batchSize,
+                                                         self.maxQueryLen, self.maxDocLen,
+                                                         sort_by_len=sortByLen))
+                while True:
+                    # The batch iterator tokenizes (unless documents are already tokenized) and pads lazily
+                    with metrics.timer(METRIC_TOKENIZE_MS):
+                        records = next(batchIter, None)
+                    if records is None:
+                        break
+
+                    queryIds = records['query_id']
+                    metrics.observe(METRIC_MODEL_BATCH_SIZE, len(queryIds))
+                    with metrics.timer(METRIC_FORWARD_MS):
+                        if records['single_query']:
+                            # All records belong to the same query: the query is encoded only once
+                            scores = model.score_candidates(records['query_tok'][0],
+                                                            records['query_mask'][0],
+                                                            records['doc_tok'],
+                                                            records['doc_mask'])
+                        else:
+                            scores = model(records['query_tok'],
+                                           records['query_mask'],
+                                           records['doc_tok'],
+                                           records['doc_mask'])
+
+                        # tolist() works much faster compared to extracting scores
+                        # one by one using .item(). It also waits for the GPU to finish.
+                        scores = scores.tolist()
+
+                    for qid, (_, did), score in zip(queryIds, records['doc_id'], scores):
                         if self.debugPrint:
-                            print(score, did, docData[did])
+                            print(score, did, docData[(qid, did)])
                         # Note that each element must be an array, b/c
                         # we can generate more than one feature per document!
-                        sampleRet[did] = [score]
+                        sampleRet[int(qid)][did] = [score]
+
+            if self.sortByLen:
+                # restore the original order of documents
+                sampleRet = [{e.id: res[e.id] for e in docs if e.id in res}
+                             for res, (_, docs) in zip(sampleRet, requests)]
 
         if self.debugPrint:
             print('All scores:', sampleRet)
@@ -92,6 +201,61 @@ class CedrQueryHandler(BaseQueryHandler):
         return sampleRet
 
 
+def getModelFiles(args):
+    if args.engine != inference_engine.ENGINE_EAGER:
+        suff = inference_engine.EXPORT_TORCHSCRIPT_SUFF if args.engine == inference_engine.ENGINE_TORCHSCRIPT \
+                else inference_engine.EXPORT_ONNX_SUFF
+        return [args.exported_model + suff]
+    if args.init_model is not None:
+        return [args.init_model.name]
+    return [args.init_model_weights.name]
+
+
+def loadModel(args):
+    """Load (and possibly quantize) the model specified by command line arguments."""
+    if args.engine != inference_engine.ENGINE_EAGER:
+        print(f'Loading the exported model {args.exported_model} engine: {args.engine}')
+        return inference_engine.load_exported_ranker(args.engine, args.exported_model, args.thread_qty)
+
+    model = model_init_utils.load_model_for_inference(args)
+    if args.quantize is not None:
+        print(f'Quantizing the model: {args.quantize} (quantized models run only on CPU)')
+        model = inference_engine.quantize_model(model, args.quantize)
+    return model
+
+
+def getModelFingerprint(args):
+    # Scores depend on the model weights as well as on the inference configuration
+    print('Computing the model fingerprint...')
+    modelFingerprint = getFileFingerprint(getModelFiles(args),
+                                          extra=f'cedr {args.model} {args.engine} {args.quantize} ' +
+                                                f'{args.max_query_len} {args.max_doc_len}')
+    print('Model fingerprint:', modelFingerprint)
+    return modelFingerprint
+
+
+def loadModelWithFingerprint(args):
+    """Load the model and compute the fingerprint of exactly the model files that were loaded.
+
+       The model file(s) can be replaced while we load them (e.g., train.py saves a new model.best).
+       Thus, we fingerprint the files before and after loading and retry if the fingerprints differ.
+       Otherwise, the score cache could return scores of a different model.
+
+    :param args: parsed command line arguments
+    :return: a tuple (model, model fingerprint)
+    """
+    for attempt in range(MODEL_LOAD_MAX_ATTEMPT_QTY):
+        modelFingerprint = getModelFingerprint(args)
+        model = loadModel(args)
+        if getModelFingerprint(args) == modelFingerprint:
+            return model, modelFingerprint
+        print(f'The model file(s) changed while loading, attempt {attempt + 1} of {MODEL_LOAD_MAX_ATTEMPT_QTY}')
+        del model
+
+    raise Exception('The model file(s) keep changing, failed to load the model ' +
+                    f'after {MODEL_LOAD_MAX_ATTEMPT_QTY} attempts')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Serving CEDR models.')
 
@@ -104,6 +268,44 @@ if __name__ == '__main__':
                         default=DEFAULT_BATCH_SIZE, type=int,
                         help='batch size')
 
+    parser.add_argument('--sort_by_len', action='store_true',
+                        help='sort documents of each query by length before batching (to reduce padding)')
+
+    parser.add_argument('--engine', metavar='inference engine',
+                        choices=inference_engine.ENGINE_LIST, default=inference_engine.ENGINE_EAGER,
+                        help='inference engine: ' + ' '.join(inference_engine.ENGINE_LIST) +
+                             ' (non-eager engines require a model exported using scripts/cedr/export_model.py)')
+
+    parser.add_argument('--exported_model', metavar='exported model prefix',
+                        default=None, type=str,
+                        help='a file prefix of the exported model (used with non-eager engines)')
+
+    parser.add_argument('--thread_qty', metavar='# of threads',
+                        default=None, type=int,
+                        help='a number of inference threads (used with non-eager engines and pre-forked workers)')
+
+    parser.add_argument('--quantize', metavar='quantization mode',
+                        choices=inference_engine.QUANTIZE_LIST, default=None,
+                        help='quantize the model for CPU inference (eager engine only): ' +
+                             ' '.join(inference_engine.QUANTIZE_LIST))
+
+    parser.add_argument('--micro_batch_size', metavar='max. micro-batch size',
+                        default=0, type=int,
+                        help='if > 0, coalesce concurrent requests into micro-batches with at most ' +
+                             'this number of documents (the server becomes multi-threaded)')
+
+    parser.add_argument('--micro_batch_latency_ms', metavar='micro-batch latency budget',
+                        default=DEFAULT_MICRO_BATCH_LATENCY_MS, type=float,
+                        help='a maximum time (in ms) a request waits for other requests to be batched with')
+
+    parser.add_argument('--worker_qty', metavar='# of workers',
+                        default=1, type=int,
+                        help='if > 1, pre-fork this number of worker processes (CPU-only). ' +
+                             'Workers share the model, but after a reload (SIGHUP) each worker has its own copy.')
+
+    parser.add_argument('--pin_workers', action='store_true',
+                        help='pin each pre-forked worker process to its own subset of CPUs')
+
     parser.add_argument('--port', metavar='server port',
                         required=True, type=int,
                         help='Server port')
@@ -112,30 +314,77 @@ if __name__ == '__main__':
                         default='127.0.0.1', type=str,
                         help='server host addr to bind the port')
 
+    addServerTransportArgs(parser)
+
+    addScoreCacheArgs(parser)
+
+    addMetricsArgs(parser)
+
 
     args = parser.parse_args()
 
-    if args.init_model is None:
-        if args.model is not None and args.init_model_weights is not None:
-            model = model_init_utils.create_model_from_args(args)
-            print('Loading model weights from:', args.init_model_weights.name)
-            # If we load weights here, we must set strict to True:
-            # this would prevent accidental loading of partial models.
-            # Partial models are sure fine to load during training (as a reasonable
-            # initialization), but not during test time.
-            model.load_state_dict(torch.load(args.init_model_weights.name, map_location='cpu'),
-                                  strict=True)
-        else:
-            print('Specify the model file: --init_model or model type and model weights')
+    workerThreadQty = None
+    if args.worker_qty > 1:
+        if args.micro_batch_size > 0:
+            print('Micro-batching is not supported by the pre-forked server')
+            sys.exit(1)
+        if args.engine == inference_engine.ENGINE_ONNXRUNTIME:
+            print('The onnxruntime engine is not supported by the pre-forked server')
+            sys.exit(1)
+        # Pre-forked workers share the model loaded on CPU before forking,
+        # each worker uses its share of CPU cores.
+        args.device_name = inference_engine.DEVICE_CPU
+        workerThreadQty = args.thread_qty
+        if workerThreadQty is None:
+            workerThreadQty = max(1, len(os.sched_getaffinity(0)) // args.worker_qty)
+
+    if args.engine != inference_engine.ENGINE_EAGER:
+        if args.exported_model is None:
+            print('Specify the exported model prefix: --exported_model')
+            sys.exit(1)
+        if args.quantize is not None:
+            print('Quantization is supported only by the eager engine')
             sys.exit(1)
-    else:
-        model = torch.load(args.init_model, map_location='cpu')
-
-    multiThreaded = False  # if we set to True, we can often run out of CUDA memory.
-    startQueryServer(args.host, args.port, multiThreaded, CedrQueryHandler(model=model,
-                                                                           batchSize=args.batch_size,
-                                                                           debugPrint=args.debug_print,
-                                                                           deviceName=args.device_name,
-                                                                           maxQueryLen=args.max_query_len,
-                                                                           maxDocLen=args.max_doc_len,
-                                                                           exclusive=not multiThreaded))
+        args.device_name = inference_engine.DEVICE_CPU
+    elif args.quantize is not None:
+        args.device_name = inference_engine.DEVICE_CPU
+
+    try:
+        model, modelFingerprint = loadModelWithFingerprint(args)
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+
+    # Without micro-batching, the server is single-threaded: if we set multiThreaded to True,
+    # we can often run out of CUDA memory. With micro-batching, the server needs to be
+    # multi-threaded to accept concurrent requests, but the model is still called
+    # by only one thread at a time (the handler remains exclusive).
+    multiThreaded = args.micro_batch_size > 0
+    queryHandler = CedrQueryHandler(model=model,
+                                    batchSize=args.batch_size,
+                                    debugPrint=args.debug_print,
+                                    deviceName=args.device_name,
+                                    maxQueryLen=args.max_query_len,
+                                    maxDocLen=args.max_doc_len,
+                                    sortByLen=args.sort_by_len,
+                                    microBatchMaxSize=args.micro_batch_size,
+                                    microBatchLatencyMs=args.micro_batch_latency_ms,
+                                    workerThreadQty=workerThreadQty,
+                                    scoreCacheSize=args.score_cache_size,
+                                    scoreCacheFile=args.score_cache_file,
+                                    modelFingerprint=modelFingerprint,
+                                    exclusive=True)
+
+    # The model is reloaded from the same file(s), e.g., after train.py saved a new model.best
+    def reloadModel():
+        model, modelFingerprint = loadModelWithFingerprint(args)
+        queryHandler.reloadModel(model, modelFingerprint)
+
+    setReloadSignalHandler(queryHandler, reloadModel)
+
+    startQueryServer(args.host, args.port, multiThreaded, queryHandler,
+                     workerQty=args.worker_qty, pinWorkers=args.pin_workers,
+                     transport=args.transport, protocol=args.protocol,
+                     nonBlocking=args.non_blocking, nonBlockingThreadQty=args.non_blocking_thread_qty,
+                     metricsPort=args.metrics_port, metricsFile=args.metrics_file,
+                     metricsInterval=args.metrics_interval)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# A one-time conversion of Glove-vector text embeddings into the binary format,
+# which can be memory-mapped by word-embedding servers.
+import sys
+import argparse
+
+sys.path.append('.')
+
+from scripts.py_featextr_server.utils import convertEmbeddingsToBinary, \
+    BINARY_EMBED_MATRIX_SUFF, BINARY_EMBED_VOCAB_SUFF, BINARY_EMBED_DTYPE_LIST
+
+parser = argparse.ArgumentParser(description='Convert text word embeddings to the binary memory-mappable format.')
+
+parser.add_argument('--input', metavar='input file', help='input text embedding file',
+                    type=str, required=True)
+parser.add_argument('--output', metavar='output file',
+                    help=f'output matrix file (must end with {BINARY_EMBED_MATRIX_SUFF}): ' +
+                         f'the vocabulary is saved to the file with the suffix {BINARY_EMBED_VOCAB_SUFF}',
+                    type=str, required=True)
+parser.add_argument('--dtype', metavar='data type', help='data type: ' + ' '.join(BINARY_EMBED_DTYPE_LIST),
+                    choices=BINARY_EMBED_DTYPE_LIST, default=BINARY_EMBED_DTYPE_LIST[0])
+
+args = parser.parse_args()
+print(args)
+
+qty, dim = convertEmbeddingsToBinary(args.input, args.output, dtype=args.dtype)
+
+print(f'Converted {qty} embeddings of dimensionality {dim}')
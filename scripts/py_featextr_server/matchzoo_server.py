@@ -7,7 +7,8 @@ import pandas as pd
 
 sys.path.append('.')
 
-from scripts.py_featextr_server.base_server import BaseQueryHandler, startQueryServer
+from scripts.py_featextr_server.base_server import BaseQueryHandler, startQueryServer, addServerTransportArgs
+from scripts.py_featextr_server.server_metrics import addMetricsArgs
 
 
 class MatchZooQueryHandler(BaseQueryHandler):
@@ -88,9 +89,17 @@ if __name__ == '__main__':
                         default='127.0.0.1', type=str,
                         help='server host addr to bind the port')
 
+    addServerTransportArgs(parser)
+
+    addMetricsArgs(parser)
+
     args = parser.parse_args()
 
     multiThreaded = False  #
     startQueryServer(args.host, args.port, multiThreaded, MatchZooQueryHandler(modelDir=args.model,
                                                                                dtProcDir=args.dtproc_model,
-                                                                               debugPrint=args.debug_print))
+                                                                               debugPrint=args.debug_print),
+                     transport=args.transport, protocol=args.protocol,
+                     nonBlocking=args.non_blocking, nonBlockingThreadQty=args.non_blocking_thread_qty,
+                     metricsPort=args.metrics_port, metricsFile=args.metrics_file,
+                     metricsInterval=args.metrics_interval)
@@ -2,30 +2,31 @@
 # This is a sample client that retrieves query-document scores from a sample server
 
 import sys
+import argparse
 
 sys.path.append('.')
 
-from scripts.py_featextr_server.python_generated.protocol.ExternalScorer import Client
 from scripts.py_featextr_server.python_generated.protocol.ttypes import \
     WordEntryInfo, TextEntryParsed, TextEntryRaw
 
-from thrift.transport import TSocket
-from thrift.transport import TTransport
-from thrift.protocol import TBinaryProtocol
+from scripts.py_featextr_server.base_server import SAMPLE_PORT, SAMPLE_HOST, createClient, \
+    TRANSPORT_LIST, TRANSPORT_BUFFERED, PROTOCOL_LIST, PROTOCOL_BINARY
 
-from scripts.py_featextr_server.base_server import SAMPLE_PORT, SAMPLE_HOST
+parser = argparse.ArgumentParser(description='A sample scoring client.')
 
-# Make socket
-transport = TSocket.TSocket(SAMPLE_HOST, SAMPLE_PORT)
+parser.add_argument('--transport', metavar='thrift transport',
+                    choices=TRANSPORT_LIST, default=TRANSPORT_BUFFERED,
+                    help='thrift transport (should be the same as the server one): ' + ' '.join(TRANSPORT_LIST))
 
-# Buffering is critical. Raw sockets are very slow
-transport = TTransport.TBufferedTransport(transport)
+parser.add_argument('--protocol', metavar='thrift protocol',
+                    choices=PROTOCOL_LIST, default=PROTOCOL_BINARY,
+                    help='thrift protocol (should be the same as the server one): ' + ' '.join(PROTOCOL_LIST))
 
-# Wrap in a protocol
-protocol = TBinaryProtocol.TBinaryProtocol(transport)
+args = parser.parse_args()
 
-# Create a client to use the protocol encoder
-client = Client(protocol)
+# Create a client using a buffered (buffering is critical: raw sockets are very slow)
+# or a framed transport.
+transport, client = createClient(SAMPLE_HOST, SAMPLE_PORT, args.transport, args.protocol)
 
 # Connect!
 transport.open()
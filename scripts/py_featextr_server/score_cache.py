@@ -0,0 +1,153 @@
+#
+# A cache of query-document scores for scoring servers: a bounded in-memory LRU cache,
+# which can be backed by an on-disk key-value store (an SQLite file), so that repeated
+# experiments can skip computing scores for already seen query-document pairs.
+#
+import os
+import hashlib
+import sqlite3
+import numpy as np
+
+from collections import OrderedDict
+from threading import Lock
+
+SCORE_CACHE_KEY_SIZE = 16
+FILE_HASH_CHUNK_SIZE = 1024 * 1024
+# Print cache statistics every this number of requests
+SCORE_CACHE_REPORT_INTERVAL = 100
+
+
+def getFileFingerprint(fileNames, extra=''):
+    """Compute a fingerprint of the file(s) content and additional (e.g., model configuration) parameters.
+
+    :param fileNames:   a list of file names
+    :param extra:       an additional string to hash
+    :return: a fingerprint hex string
+    """
+    h = hashlib.sha1()
+    for fn in fileNames:
+        with open(fn, 'rb') as f:
+            while True:
+                chunk = f.read(FILE_HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+    h.update(extra.encode())
+    return h.hexdigest()
+
+
+def getScoreKey(fingerprint, queryText, docId, docText):
+    """Compute a cache key of a query-document pair.
+
+    :param fingerprint:   a model fingerprint
+    :param queryText:     a query text (or a string representation of a parsed query)
+    :param docId:         a document ID
+    :param docText:       a document text (or a string representation of a parsed document)
+    :return: a binary key
+    """
+    h = hashlib.blake2b(digest_size=SCORE_CACHE_KEY_SIZE)
+    for s in [fingerprint, queryText, docId, docText]:
+        s = s.encode()
+        # the length prevents collisions of different concatenations
+        h.update(len(s).to_bytes(8, 'little'))
+        h.update(s)
+    return h.digest()
+
+
+class ScoreCache:
+    """A thread-safe bounded LRU cache of scores (lists of floats) with an optional
+       on-disk SQLite store. All computed scores are written to the disk store, while
+       the most recently used ones are also kept in memory.
+
+       The SQLite connection is opened lazily in each process: hence, the cache can be
+       shared by worker processes of the pre-forked server.
+    """
+    def __init__(self, maxSize, fileName=None):
+        """Constructor.
+
+        :param maxSize:   a maximum number of in-memory entries
+        :param fileName:  an optional file name of the on-disk store
+        """
+        self.maxSize = maxSize
+        self.fileName = fileName
+        self.lock_ = Lock()
+        self.cache_ = OrderedDict()
+        self.memHitQty = 0
+        self.diskHitQty = 0
+        self.missQty = 0
+        self.conn_ = None
+        self.connPid_ = None
+        print(f'Score cache: max. # of in-memory entries: {maxSize} on-disk store: {fileName}')
+
+    def getConn_(self):
+        if self.fileName is None:
+            return None
+        pid = os.getpid()
+        if self.conn_ is None or self.connPid_ != pid:
+            # A connection cannot be shared across processes
+            self.conn_ = sqlite3.connect(self.fileName, timeout=60, check_same_thread=False)
+            self.conn_.execute('CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, val BLOB)')
+            self.conn_.commit()
+            self.connPid_ = pid
+        return self.conn_
+
+    def putMem_(self, key, val):
+        self.cache_[key] = val
+        self.cache_.move_to_end(key)
+        while len(self.cache_) > self.maxSize:
+            self.cache_.popitem(last=False)
+
+    def get(self, keys):
+        """Retrieve scores for a list of keys.
+
+        :return: a list of scores: None is returned for keys that are missing in the cache
+        """
+        res = [None] * len(keys)
+        with self.lock_:
+            diskKeys = []
+            for i, key in enumerate(keys):
+                val = self.cache_.get(key)
+                if val is not None:
+                    self.cache_.move_to_end(key)
+                    res[i] = val
+                    self.memHitQty += 1
+                else:
+                    diskKeys.append(i)
+
+            conn = self.getConn_()
+            if conn is not None and diskKeys:
+                for i in diskKeys:
+                    row = conn.execute('SELECT val FROM scores WHERE key=?', (keys[i],)).fetchone()
+                    if row is not None:
+                        res[i] = np.frombuffer(row[0], dtype=np.float64).tolist()
+                        self.putMem_(keys[i], res[i])
+                        self.diskHitQty += 1
+
+            self.missQty += sum(e is None for e in res)
+
+        return res
+
+    def put(self, keys, vals):
+        """Add scores to the cache."""
+        with self.lock_:
+            for key, val in zip(keys, vals):
+                self.putMem_(key, val)
+
+            conn = self.getConn_()
+            if conn is not None:
+                conn.executemany('INSERT OR REPLACE INTO scores (key, val) VALUES (?, ?)',
+                                 [(key, np.array(val, dtype=np.float64).tobytes()) for key, val in zip(keys, vals)])
+                conn.commit()
+
+    def getStats(self):
+        """:return: a dictionary with hit/miss counters"""
+        with self.lock_:
+            return {'mem_hits': self.memHitQty, 'disk_hits': self.diskHitQty, 'misses': self.missQty,
+                    'mem_entries': len(self.cache_)}
+
+    def statsStr(self):
+        stats = self.getStats()
+        totalQty = stats['mem_hits'] + stats['disk_hits'] + stats['misses']
+        hitRate = (stats['mem_hits'] + stats['disk_hits']) / max(totalQty, 1)
+        return 'Score cache: memory hits %d disk hits %d misses %d hit rate %.3f' % \
+               (stats['mem_hits'], stats['disk_hits'], stats['misses'], hitRate)
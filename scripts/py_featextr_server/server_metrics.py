@@ -0,0 +1,225 @@
+#
+# Lightweight instrumentation of scoring servers: histograms of per-request latencies
+# (broken down by processing stages) and sizes, which can be exposed via a local HTTP
+# endpoint (in the Prometheus text format as well as in JSON) and/or periodically
+# dumped to a JSON file.
+#
+import os
+import json
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency histograms (in milliseconds)
+METRIC_REQUEST_MS = 'request_ms'              # total time spent in the handler
+METRIC_QUEUE_WAIT_MS = 'queue_wait_ms'        # waiting for the handler lock or in the micro-batching queue
+METRIC_COMPUTE_MS = 'compute_ms'              # computing scores (without waiting)
+METRIC_TOKENIZE_MS = 'tokenize_ms'            # tokenization and batch preparation (neural models)
+METRIC_FORWARD_MS = 'forward_ms'              # model forward passes (neural models)
+METRIC_SERIALIZE_MS = 'serialize_ms'          # Thrift (de)serialization of arguments and results
+# Size histograms
+METRIC_DOCS_PER_REQUEST = 'docs_per_request'
+METRIC_MODEL_BATCH_SIZE = 'model_batch_size'  # documents in a single model call
+METRIC_MICRO_BATCH_DOCS = 'micro_batch_docs'
+METRIC_MICRO_BATCH_REQUESTS = 'micro_batch_requests'
+
+LATENCY_BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096]
+
+SIZE_METRIC_LIST = [METRIC_DOCS_PER_REQUEST, METRIC_MODEL_BATCH_SIZE,
+                    METRIC_MICRO_BATCH_DOCS, METRIC_MICRO_BATCH_REQUESTS]
+
+METRIC_NAME_PREFIX = 'flexneuart_'
+QUANTILE_LIST = [0.5, 0.9, 0.99]
+
+DEFAULT_METRICS_DUMP_INTERVAL = 60
+
+
+class Histogram:
+    """A (not thread-safe) histogram with fixed buckets: quantiles are estimated
+       using linear interpolation inside buckets.
+    """
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        # The last counter is for the "+Inf" bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.qty = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, val):
+        # the first bucket whose upper bound is >= val
+        self.counts[bisect_left(self.buckets, val)] += 1
+        self.qty += 1
+        self.sum += val
+        self.max = max(self.max, val)
+
+    def quantile(self, q):
+        if self.qty == 0:
+            return 0.0
+        rank = q * self.qty
+        cumQty = 0
+        for i, qty in enumerate(self.counts):
+            if qty > 0 and cumQty + qty >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - cumQty) / qty
+            cumQty += qty
+        return self.max
+
+    def toDict(self):
+        res = {'count': self.qty, 'sum': self.sum,
+               'mean': self.sum / self.qty if self.qty else 0.0,
+               'max': self.max}
+        for q in QUANTILE_LIST:
+            res['p%d' % round(100 * q)] = self.quantile(q)
+        res['buckets'] = {str(b): qty for b, qty in zip(self.buckets + ['+Inf'], self.counts)}
+        return res
+
+
+class ServerMetrics:
+    """A thread-safe registry of histograms and counters."""
+    def __init__(self):
+        self.lock_ = Lock()
+        self.startTime = time.time()
+        self.histograms_ = {}
+        self.requestQty = 0
+        self.docQty = 0
+
+    def observe(self, name, val):
+        with self.lock_:
+            hist = self.histograms_.get(name)
+            if hist is None:
+                hist = self.histograms_[name] = \
+                    Histogram(SIZE_BUCKETS if name in SIZE_METRIC_LIST else LATENCY_BUCKETS_MS)
+            hist.observe(val)
+
+    def countRequest(self, docQty):
+        """:return: the number of requests including this one"""
+        with self.lock_:
+            self.requestQty += 1
+            self.docQty += docQty
+            requestQty = self.requestQty
+        self.observe(METRIC_DOCS_PER_REQUEST, docQty)
+        return requestQty
+
+    @contextmanager
+    def timer(self, name):
+        """A context manager that records the execution time (in ms) of the block."""
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, 1000 * (time.time() - startTime))
+
+    def snapshot(self):
+        """:return: a dictionary with all the counters and histograms"""
+        with self.lock_:
+            uptime = time.time() - self.startTime
+            return {'pid': os.getpid(),
+                    'uptime_sec': uptime,
+                    'request_qty': self.requestQty,
+                    'doc_qty': self.docQty,
+                    'requests_per_sec': self.requestQty / max(uptime, 1e-9),
+                    'docs_per_sec': self.docQty / max(uptime, 1e-9),
+                    'histograms': {name: hist.toDict() for name, hist in sorted(self.histograms_.items())}}
+
+    def toText(self):
+        """:return: metrics in the Prometheus text exposition format"""
+        snap = self.snapshot()
+        lines = []
+        for name in ['uptime_sec', 'request_qty', 'doc_qty']:
+            lines.append(f'{METRIC_NAME_PREFIX}{name} {snap[name]}')
+        for name, hist in snap['histograms'].items():
+            fullName = METRIC_NAME_PREFIX + name
+            lines.append(f'# TYPE {fullName} histogram')
+            cumQty = 0
+            for bound, qty in hist['buckets'].items():
+                cumQty += qty
+                lines.append(f'{fullName}_bucket{{le="{bound}"}} {cumQty}')
+            lines.append(f'{fullName}_sum {hist["sum"]}')
+            lines.append(f'{fullName}_count {hist["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def startMetricsHttpServer(metrics, host, port, extraFunc=None):
+    """Start an HTTP server (in a background thread) that returns metrics in the
+       Prometheus text format (/metrics) or in JSON (/metrics.json).
+
+    :param metrics:     a ServerMetrics object
+    :param host:        a host address to bind to
+    :param port:        a port
+    :param extraFunc:   an optional function returning a dictionary of additional JSON entries
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, contentType = metrics.toText(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, contentType = json.dumps(getMetricsDict(metrics, extraFunc), indent=2), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Do not print each metrics request
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Metrics are available at http://{host}:{port}/metrics and http://{host}:{port}/metrics.json')
+    return server
+
+
+def startMetricsDumps(metrics, fileName, intervalSec=DEFAULT_METRICS_DUMP_INTERVAL, extraFunc=None):
+    """Periodically dump metrics (in JSON) to a file (in a background thread).
+       The file is replaced atomically, so it can be read at any time.
+
+    :param metrics:       a ServerMetrics object
+    :param fileName:      an output file name
+    :param intervalSec:   a dump interval in seconds
+    :param extraFunc:     an optional function returning a dictionary of additional JSON entries
+    """
+    def dumpLoop():
+        while True:
+            time.sleep(intervalSec)
+            tmpFileName = fileName + '.tmp'
+            with open(tmpFileName, 'w') as f:
+                json.dump(getMetricsDict(metrics, extraFunc), f, indent=2)
+            os.replace(tmpFileName, fileName)
+
+    Thread(target=dumpLoop, daemon=True).start()
+    print(f'Metrics are dumped to {fileName} every {intervalSec} sec')
+
+
+def getMetricsDict(metrics, extraFunc=None):
+    res = metrics.snapshot()
+    if extraFunc is not None:
+        res.update(extraFunc())
+    return res
+
+
+def addMetricsArgs(parser):
+    parser.add_argument('--metrics_port', metavar='metrics port',
+                        default=None, type=int,
+                        help='if specified, metrics are served via HTTP at this port (the pre-forked server ' +
+                             'uses consecutive ports: one per worker)')
+
+    parser.add_argument('--metrics_file', metavar='metrics file',
+                        default=None, type=str,
+                        help='if specified, metrics are periodically dumped to this JSON file (the pre-forked ' +
+                             'server adds the worker number as a suffix)')
+
+    parser.add_argument('--metrics_interval', metavar='metrics dump interval',
+                        default=DEFAULT_METRICS_DUMP_INTERVAL, type=float,
+                        help='an interval (in seconds) between metrics dumps')
@@ -1,15 +1,96 @@
 import pandas as pd
 import numpy as np
 
+# The binary embedding format consists of a (memory-mappable) numpy matrix
+# <prefix>.npy and the vocabulary file <prefix>.vocab (one word per line).
+BINARY_EMBED_MATRIX_SUFF = '.npy'
+BINARY_EMBED_VOCAB_SUFF = '.vocab'
+BINARY_EMBED_DTYPE_LIST = ['float32', 'float16']
 
-# Loads embeddings stored in Glove-vector text format
+
+def isBinaryEmbedFile(fileName):
+    return fileName.endswith(BINARY_EMBED_MATRIX_SUFF)
+
+
+def getBinaryEmbedVocabFile(fileName):
+    return fileName[:-len(BINARY_EMBED_MATRIX_SUFF)] + BINARY_EMBED_VOCAB_SUFF
+
+
+def getEmbedFileList(fileName):
+    """:return: a list of all files storing embeddings (in either the text or the binary format)"""
+    if isBinaryEmbedFile(fileName):
+        return [fileName, getBinaryEmbedVocabFile(fileName)]
+    return [fileName]
+
+
+# Loads embeddings stored either in Glove-vector text format or in the binary format.
+# Binary embeddings are memory-mapped (read-only): they are loaded nearly instantly
+# and the same physical pages are shared by all processes using the same file.
 def loadEmbeddings(fileName, sep='\t'):
+    if isBinaryEmbedFile(fileName):
+        return loadEmbeddingsBinary(fileName)
     dtFrame = pd.read_csv(fileName, sep=sep, header=None)
     words = dtFrame[0].values
     dtFrame.drop(0, axis=1, inplace=True)
     return words, dtFrame.values.astype(np.float32)
 
 
+def loadEmbeddingsBinary(fileName):
+    with open(getBinaryEmbedVocabFile(fileName)) as f:
+        words = np.array([line.rstrip('\n') for line in f], dtype=object)
+    embeds = np.load(fileName, mmap_mode='r')
+    if len(words) != embeds.shape[0]:
+        raise Exception(f'The number of words ({len(words)}) does not match the number ' +
+                        f'of embeddings ({embeds.shape[0]}) in {fileName}')
+    return words, embeds
+
+
+def convertEmbeddingsToBinary(inpFileName, outFileName, dtype='float32', sep='\t'):
+    """Convert Glove-vector text embeddings to the binary format. The input file is read
+       twice (first to obtain the matrix size), but it is never loaded into memory completely.
+
+    :param inpFileName:   an input text file
+    :param outFileName:   an output matrix file name (must end with .npy)
+    :param dtype:         a type of the output matrix: float32 or float16
+    :param sep:           a column separator of the input file
+    """
+    if not isBinaryEmbedFile(outFileName):
+        raise Exception(f'The output file name must end with {BINARY_EMBED_MATRIX_SUFF}')
+
+    qty = 0
+    dim = None
+    with open(inpFileName) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            lineDim = len(line.rstrip('\n').split(sep)) - 1
+            if dim is None:
+                dim = lineDim
+            elif dim != lineDim:
+                raise Exception(f'Inconsistent dimensionality in line {qty + 1}: {lineDim} vs {dim}')
+            qty += 1
+
+    if dim is None:
+        raise Exception(f'No embeddings found in {inpFileName}')
+
+    embeds = np.lib.format.open_memmap(outFileName, mode='w+', dtype=dtype, shape=(qty, dim))
+
+    with open(inpFileName) as inpFile, open(getBinaryEmbedVocabFile(outFileName), 'w') as vocabFile:
+        row = 0
+        for line in inpFile:
+            if not line.strip():
+                continue
+            fields = line.rstrip('\n').split(sep)
+            vocabFile.write(fields[0] + '\n')
+            embeds[row] = np.array(fields[1:], dtype=np.float32)
+            row += 1
+
+    embeds.flush()
+    del embeds
+
+    return qty, dim
+
+
 def createEmbedMap(words):
     res = dict()
     for i in range(len(words)):
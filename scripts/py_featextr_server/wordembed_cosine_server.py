@@ -4,17 +4,32 @@ import argparse
 
 sys.path.append('.')
 
-from scripts.py_featextr_server.base_server import BaseQueryHandler, startQueryServer
+from scripts.py_featextr_server.base_server import BaseQueryHandler, startQueryServer, addServerTransportArgs, \
+                                                    addScoreCacheArgs
+from scripts.py_featextr_server.server_metrics import addMetricsArgs
+from scripts.py_featextr_server.score_cache import getFileFingerprint
 
 import numpy as np
+from scipy import sparse
 
-from scripts.py_featextr_server.utils import loadEmbeddings, createEmbedMap, robustCosineSimil
+from scripts.py_featextr_server.utils import loadEmbeddings, createEmbedMap, getEmbedFileList
+
+COSINE_EPS = 1e-10
 
 # Exclusive==True means that only one getScores
 # function is executed at at time
 class CosineSimilQueryHandler(BaseQueryHandler):
-    def __init__(self, queryEmbedFile, docEmbedFile, exclusive, debugPrint=False, useIDF=True):
-        super().__init__(exclusive)
+    def __init__(self, queryEmbedFile, docEmbedFile, exclusive, debugPrint=False, useIDF=True,
+                 scoreCacheSize=0, scoreCacheFile=None):
+        modelFingerprint = ''
+        if scoreCacheSize > 0 or scoreCacheFile is not None:
+            embedFiles = getEmbedFileList(docEmbedFile) + \
+                         (getEmbedFileList(queryEmbedFile) if queryEmbedFile is not None else [])
+            modelFingerprint = getFileFingerprint(embedFiles,
+                                                  extra=f'wordembed_cosine {queryEmbedFile is not None} {useIDF}')
+        super().__init__(exclusive,
+                         scoreCacheSize=scoreCacheSize, scoreCacheFile=scoreCacheFile,
+                         modelFingerprint=modelFingerprint)
 
         self.debugPrint = debugPrint
         self.useIDF = useIDF
@@ -39,8 +54,14 @@ class CosineSimilQueryHandler(BaseQueryHandler):
                 arr.append('%s %g %d ' % (winfo.word, winfo.IDF, winfo.qty))
         return 'docId=' + te.id + ' ' + ' '.join(arr)
 
-    def createDocEmbed(self, isQuery, textEntry):
+    def createDocEmbedMatrix(self, isQuery, textEntries):
+        """Embed a list of parsed entries at once: a sparse (entry x vocabulary) matrix
+           of word weights is multiplied by the dense embedding matrix.
 
+        :param isQuery:       True if entries are queries
+        :param textEntries:   a list of parsed text entries
+        :return: a dense matrix, where each row is a weighted sum of word embeddings
+        """
         if isQuery:
             embeds = self.queryEmbed
             embedMap = self.queryEmbedMap
@@ -48,42 +69,49 @@ class CosineSimilQueryHandler(BaseQueryHandler):
             embeds = self.answEmbed
             embedMap = self.answEmbedMap
 
-        zerov = np.zeros_like(embeds[0])
-        res = zerov
-
-        for winfo in textEntry.entries:
-            vectMult = winfo.qty
-            if self.useIDF:
-                vectMult *= winfo.IDF
-            word = winfo.word
-            if word in embedMap:
-                res += embeds[embedMap[word]] * vectMult
+        rows, cols, vals = [], [], []
+        for i, textEntry in enumerate(textEntries):
+            for winfo in textEntry.entries:
+                wordId = embedMap.get(winfo.word)
+                if wordId is not None:
+                    vectMult = winfo.qty
+                    if self.useIDF:
+                        vectMult *= winfo.IDF
+                    rows.append(i)
+                    cols.append(wordId)
+                    vals.append(vectMult)
+
+        # Weights of repeating (row, col) pairs are summed up. Results are always
+        # float32 (even if memory-mapped embeddings are stored as float16).
+        weights = sparse.csr_matrix((np.array(vals, dtype=np.float32), (rows, cols)),
+                                    shape=(len(textEntries), embeds.shape[0]))
+        return weights @ embeds
 
-        return res
+    def createDocEmbed(self, isQuery, textEntry):
+        return self.createDocEmbedMatrix(isQuery, [textEntry])[0]
 
     # This function overrides the parent class
     def computeScoresFromParsedOverride(self, query, docs):
         if self.debugPrint:
             print('getScores', query.id, self.textEntryToStr(query))
-        ret = {}
         queryEmbed = self.createDocEmbed(True, query)
         if self.debugPrint:
             print(queryEmbed)
-        for d in docs:
-            if self.debugPrint:
+        docEmbeds = self.createDocEmbedMatrix(False, docs)
+        if self.debugPrint:
+            for d, docEmbed in zip(docs, docEmbeds):
                 print(self.textEntryToStr(d))
-            docEmbed = self.createDocEmbed(False, d)
-            if self.debugPrint:
                 print(docEmbed)
-            # Regular cosine deals poorly with all-zero vectors
-            simil = robustCosineSimil(docEmbed, queryEmbed)
-            # simil = (1-cosine(docEmbed, queryEmbed))
 
-            # Note that each element must be an array, b/c
-            # we can generate more than one feature per document!
-            ret[d.id] = [simil]
+        # Regular cosine deals poorly with all-zero vectors:
+        # hence, norms are bounded from below in the same way as in robustCosineSimil
+        queryNorm = max(np.linalg.norm(queryEmbed), COSINE_EPS)
+        docNorms = np.maximum(np.linalg.norm(docEmbeds, axis=1), COSINE_EPS)
+        simils = (docEmbeds @ queryEmbed) / (docNorms * queryNorm)
 
-        return ret
+        # Note that each element must be an array, b/c
+        # we can generate more than one feature per document!
+        return {d.id: [float(simil)] for d, simil in zip(docs, simils)}
 
 
 if __name__ == '__main__':
@@ -91,15 +119,22 @@ if __name__ == '__main__':
 
     parser.add_argument('--query_embed', metavar='query embeddings',
                         default=None, type=str,
-                        help='Optional query embeddings file')
+                        help='Optional query embeddings file (text or binary *.npy)')
 
     parser.add_argument('--doc_embed', metavar='doc embeddings',
                         required=True, type=str,
-                        help='document embeddings file')
+                        help='document embeddings file (text or binary *.npy)')
 
     parser.add_argument('--debug_print', action='store_true',
                         help='Provide debug output')
 
+    parser.add_argument('--worker_qty', metavar='# of workers',
+                        default=1, type=int,
+                        help='if > 1, pre-fork this number of worker processes')
+
+    parser.add_argument('--pin_workers', action='store_true',
+                        help='pin each pre-forked worker process to its own subset of CPUs')
+
     parser.add_argument('--port', metavar='server port',
                         required=True, type=int,
                         help='Server port')
@@ -108,6 +143,12 @@ if __name__ == '__main__':
                         default='127.0.0.1', type=str,
                         help='server host addr to bind the port')
 
+    addServerTransportArgs(parser)
+
+    addScoreCacheArgs(parser)
+
+    addMetricsArgs(parser)
+
     args = parser.parse_args()
 
     multiThreaded = True
@@ -115,4 +156,11 @@ if __name__ == '__main__':
                      CosineSimilQueryHandler(exclusive=False,
                                              queryEmbedFile=args.query_embed,
                                              docEmbedFile=args.doc_embed,
-                                             debugPrint=args.debug_print))
+                                             debugPrint=args.debug_print,
+                                             scoreCacheSize=args.score_cache_size,
+                                             scoreCacheFile=args.score_cache_file),
+                     workerQty=args.worker_qty, pinWorkers=args.pin_workers,
+                     transport=args.transport, protocol=args.protocol,
+                     nonBlocking=args.non_blocking, nonBlockingThreadQty=args.non_blocking_thread_qty,
+                     metricsPort=args.metrics_port, metricsFile=args.metrics_file,
+                     metricsInterval=args.metrics_interval)
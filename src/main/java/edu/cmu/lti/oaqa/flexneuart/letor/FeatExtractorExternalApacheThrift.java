@@ -22,6 +22,9 @@ import java.util.Map;
 
 
 import org.apache.thrift.protocol.TBinaryProtocol;
+import org.apache.thrift.protocol.TCompactProtocol;
+import org.apache.thrift.protocol.TProtocol;
+import org.apache.thrift.transport.TFramedTransport;
 import org.apache.thrift.transport.TSocket;
 import org.apache.thrift.transport.TTransport;
 import org.checkerframework.checker.units.qual.m;
@@ -67,6 +70,13 @@ public class FeatExtractorExternalApacheThrift extends SingleFieldFeatExtractor
   public static String UNK_WORD = "unkWord";
   
   public static String PARSED_AS_RAW = "sendParsedAsRaw";
+  
+  /*
+   * The transport & protocol must be the same as the ones used by the server:
+   * see options --transport and --protocol of the Python servers.
+   */
+  public static String FRAMED_TRANSPORT = "framedTransport";
+  public static String COMPACT_PROTOCOL = "compactProtocol";
 
   public FeatExtractorExternalApacheThrift(FeatExtrResourceManager resMngr, OneFeatExtrConf conf) throws Exception {
     super(resMngr, conf);
@@ -87,6 +97,10 @@ public class FeatExtractorExternalApacheThrift extends SingleFieldFeatExtractor
     
     mUseWordSeq = conf.getParamBool(POSITIONAL);
     
+    mFramedTransport = conf.getParamBool(FRAMED_TRANSPORT);
+    
+    mCompactProtocol = conf.getParamBool(COMPACT_PROTOCOL);
+    
     mSimilObj = new  BM25SimilarityLuceneNorm(BM25SimilarityLucene.DEFAULT_BM25_K1, 
                                               BM25SimilarityLucene.DEFAULT_BM25_B, 
                                               mFieldIndex);
@@ -142,10 +156,14 @@ public class FeatExtractorExternalApacheThrift extends SingleFieldFeatExtractor
      * SOTA neural models. 
      */
     TTransport transp = new TSocket(mHost, mPort);
+    if (mFramedTransport) {
+      transp = new TFramedTransport(transp);
+    }
     transp.open();
      
     try {
-      Client clnt = new Client(new TBinaryProtocol(transp));
+      TProtocol protocol = mCompactProtocol ? new TCompactProtocol(transp) : new TBinaryProtocol(transp);
+      Client clnt = new Client(protocol);
       
       res = initResultSet(cands, getFeatureQty()); 
 
@@ -277,6 +295,9 @@ public class FeatExtractorExternalApacheThrift extends SingleFieldFeatExtractor
   
   final boolean                      mTextAsRaw;
   
+  final boolean                      mFramedTransport;
+  final boolean                      mCompactProtocol;
+  
   @Override
   public String getName() {
     return this.getClass().getName();